@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark: disk usage, metadata reads and extraction of the installed
+parts of a graphics pack stored as a folder compared to zip and tar.gz
+archives, and reading the init files of an archive after its raws, as an
+install does."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+import fileops
+import packarchive
+from lnp import PACK_INIT_FILES, PyLNP
+from settings import file_cache
+
+def make_pack(root, raw_files, art_files):
+    """Creates a graphics pack with <raw_files> raw files in each of
+    raw/graphics and raw/objects, <art_files> images and an extra folder
+    that is not installed."""
+    rng = random.Random(0)
+    words = [
+        '[CREATURE_TILE:{0}]'.format(i).encode('ascii') for i in range(200)]
+    for folder in ('graphics', 'objects'):
+        os.makedirs(os.path.join(root, 'raw', folder))
+        for i in range(raw_files):
+            with open(os.path.join(
+                    root, 'raw', folder, 'raw{0}.txt'.format(i)), 'wb') as f:
+                f.write(b'\n'.join(rng.choice(words) for _ in range(400)))
+    os.makedirs(os.path.join(root, 'data', 'art'))
+    for i in range(art_files):
+        with open(os.path.join(
+                root, 'data', 'art', 'tile{0}.png'.format(i)), 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n' + os.urandom(65536))
+    os.makedirs(os.path.join(root, 'data', 'init'))
+    for name in PACK_INIT_FILES:
+        with open(os.path.join(root, 'data', 'init', name), 'w') as f:
+            f.write('[FONT:tile0.png]\n[GRAPHICS_FONT:tile1.png]\n' * 50)
+    os.makedirs(os.path.join(root, 'extra'))
+    with open(os.path.join(root, 'extra', 'screenshots.bin'), 'wb') as f:
+        f.write(os.urandom(4 * 1048576))
+
+def make_archives(pack, work):
+    """Returns the paths of zip and tar.gz archives of <pack>."""
+    result = []
+    zip_path = os.path.join(work, 'pack.zip')
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as z:
+        for relative, _ in fileops.scan_tree(pack)[1]:
+            z.write(os.path.join(pack, relative), 'Pack/' + relative)
+    result.append(zip_path)
+    tar_path = os.path.join(work, 'pack.tar.gz')
+    with tarfile.open(tar_path, 'w:gz') as t:
+        t.add(pack, 'Pack')
+    result.append(tar_path)
+    return result
+
+def disk_usage(path):
+    """Returns the disk space used by a file or folder, in bytes."""
+    if os.path.isfile(path):
+        paths = [path]
+    else:
+        paths = [
+            os.path.join(path, r) for r, _ in fileops.scan_tree(path)[1]]
+    total = 0
+    for p in paths:
+        st = os.stat(p)
+        total += getattr(st, 'st_blocks', 0) * 512 or st.st_size
+    return total
+
+def installed(relative):
+    """Returns True for the parts of a pack written by an install."""
+    return relative.startswith(('raw/', 'data/art/')) or relative in [
+        'data/init/' + n for n in PACK_INIT_FILES]
+
+def install_folder(pack, target):
+    """Copies the installed parts of a folder pack."""
+    fileops.copy_tree(
+        os.path.join(pack, 'raw'), os.path.join(target, 'raw'))
+    fileops.copy_tree(
+        os.path.join(pack, 'data', 'art'), os.path.join(target, 'data', 'art'))
+    os.makedirs(os.path.join(target, 'data', 'init'))
+    for name in PACK_INIT_FILES:
+        fileops.copy_file(
+            os.path.join(pack, 'data', 'init', name),
+            os.path.join(target, 'data', 'init', name))
+
+def install_archive(path, target):
+    """Streams the installed parts of an archive pack."""
+    with packarchive.PackArchive(path) as archive:
+        archive.extract(target, installed)
+
+def reread_archive(path, target):
+    """Reads the last file of an archive pack, then its init files."""
+    # pylint:disable=unused-argument
+    with packarchive.PackArchive(path) as archive:
+        archive.read(list(archive.members)[-1])
+        archive.read_files(lambda r: r in [
+            'data/init/' + n for n in PACK_INIT_FILES])
+
+def best(func, path, target, repeat=3):
+    """Returns the best time of <repeat> calls of func(path, target)."""
+    times = []
+    for _ in range(repeat):
+        file_cache.invalidate()
+        start = time.time()
+        func(path, target)
+        times.append(time.time() - start)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+    return min(times)
+
+def main():
+    """Runs the benchmark and prints a table of results."""
+    work = tempfile.mkdtemp()
+    try:
+        pack = os.path.join(work, 'Pack')
+        make_pack(pack, 500, 200)
+        target = os.path.join(work, 'target')
+        print('{0:>12} {1:>12} {2:>12} {3:>12} {4:>12}'.format(
+            'pack', 'disk (MiB)', 'metadata', 'install', 'reread'))
+        rows = [('folder', pack, install_folder)] + [
+            (os.path.basename(p), p, install_archive)
+            for p in make_archives(pack, work)]
+        for name, path, install in rows:
+            metadata = best(
+                lambda p, _: PyLNP.read_pack_info(p), path, target)
+            reread = '-'
+            if install is install_archive:
+                reread = '{0:.3f}s'.format(best(reread_archive, path, target))
+            print('{0:>12} {1:>12.1f} {2:>11.3f}s {3:>11.3f}s {4:>12}'.format(
+                name, disk_usage(path) / 1048576.0, metadata,
+                best(install, path, target), reread))
+    finally:
+        shutil.rmtree(work)
+
+if __name__ == "__main__":
+    main()
+
+# vim:expandtab
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark: copying and removing a tree of thousands of small files with
+distutils.dir_util compared to the fileops engine."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+import fileops
+
+try:
+    import distutils.dir_util as dir_util
+except ImportError:  # Removed in Python 3.12
+    dir_util = None
+
+def make_tree(root, dirs, files_per_dir, size):
+    """Creates <dirs> directories of <files_per_dir> files of <size> bytes."""
+    data = b'x' * size
+    for d in range(dirs):
+        directory = os.path.join(root, 'dir{0}'.format(d))
+        os.makedirs(directory)
+        for f in range(files_per_dir):
+            with open(os.path.join(
+                    directory, 'file{0}.txt'.format(f)), 'wb') as out:
+                out.write(data)
+
+def timed(source, target, module, repeat=3):
+    """Returns the best times taken by module.copy_tree and
+    module.remove_tree for copying <source> to <target> and removing it."""
+    copy_times = []
+    remove_times = []
+    for _ in range(repeat):
+        start = time.time()
+        module.copy_tree(source, target)
+        copy_times.append(time.time() - start)
+        start = time.time()
+        module.remove_tree(target)
+        remove_times.append(time.time() - start)
+    return min(copy_times), min(remove_times)
+
+def main():
+    """Runs the benchmark and prints a table of results."""
+    if dir_util is None:
+        print('distutils is not available; timing fileops only.')
+    work = tempfile.mkdtemp()
+    try:
+        print('{0:>8} {1:>12} {2:>12} {3:>12} {4:>12}'.format(
+            'files', 'copy_tree', 'fileops', 'remove_tree', 'fileops'))
+        for dirs, files_per_dir in ((10, 100), (50, 100), (100, 100)):
+            source = os.path.join(work, 'source')
+            make_tree(source, dirs, files_per_dir, 2048)
+            target = os.path.join(work, 'target')
+            if dir_util is not None:
+                old_copy, old_remove = timed(source, target, dir_util)
+            else:
+                old_copy = old_remove = float('nan')
+            new_copy, new_remove = timed(source, target, fileops)
+            print('{0:>8} {1:>11.3f}s {2:>11.3f}s {3:>11.3f}s {4:>11.3f}s'
+                  .format(dirs * files_per_dir, old_copy, new_copy,
+                          old_remove, new_remove))
+            shutil.rmtree(source)
+    finally:
+        shutil.rmtree(work)
+
+if __name__ == "__main__":
+    main()
+
+# vim:expandtab
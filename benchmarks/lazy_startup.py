@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark: showing the option controls at startup with every option read
+first compared to deferring options whose files are not read yet, as the GUI
+does until its window is shown. Also checks that the deferred startup update
+does not touch the raws, and times the deferred update run afterwards."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+import settings
+from settings import DFConfiguration, file_cache
+from tkgui import binding
+
+class Control(object):
+    """Stands in for a button showing an option."""
+    def __init__(self, name):
+        self.values = {'text': name + ':'}
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+class LNP(object):
+    """Stands in for PyLNP; binding only uses its settings."""
+    def __init__(self, df_dir):
+        self.settings = DFConfiguration(df_dir)
+
+def make_df(root, raw_files, raw_size):
+    """Creates a DF folder with all options and <raw_files> raw files of
+    about <raw_size> bytes."""
+    for relative in (settings._init[0], settings._dinit[0]):
+        path = os.path.join(root, relative)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(''.join(
+                '[{0}:{1}]\n'.format(o.field_name, o.default)
+                for o in DFConfiguration.schema if o.files[0] == relative))
+    objects = os.path.join(root, 'raw', 'objects')
+    os.makedirs(objects)
+    block = '[INORGANIC:STONE_{0}]\n[USE_MATERIAL_TEMPLATE:STONE]\n'
+    for i in range(raw_files):
+        with open(os.path.join(
+                objects, 'inorganic_{0}.txt'.format(i)), 'w') as f:
+            f.write('[AQUIFER]\n' if i % 10 == 0 else '')
+            f.write(''.join(
+                block.format(j) for j in range(raw_size // len(block))))
+
+def startup(df_dir, defer):
+    """Shows all controls as the GUI does at startup. Returns the time taken,
+    whether the raw index was built, and the time taken by the deferred
+    update."""
+    file_cache.invalidate()
+    lnp = LNP(df_dir)
+    binding.init(lnp)
+    for option in DFConfiguration.schema + DFConfiguration.raw_schema:
+        binding.bind(Control(option.name), option.name)
+    start = time.time()
+    lnp.settings.read_settings(True)
+    binding.update(defer)
+    taken = time.time() - start
+    raws = lnp.settings.raw_index is not None
+    start = time.time()
+    binding.update_deferred()
+    return taken, raws, time.time() - start
+
+def main():
+    """Runs the benchmark and prints a table of results."""
+    work = tempfile.mkdtemp()
+    try:
+        print('{0:>10} {1:>10} {2:>6} {3:>10} {4:>6} {5:>10}'.format(
+            'raw files', 'full (ms)', 'raws', 'deferred', 'raws', 'later'))
+        for raw_files in (100, 400, 1000):
+            df_dir = os.path.join(work, str(raw_files))
+            make_df(df_dir, raw_files, 20000)
+            # The raw index is kept in memory only, so each startup builds it
+            full, full_raws, _ = startup(df_dir, False)
+            deferred, deferred_raws, later = startup(df_dir, True)
+            print('{0:>10} {1:>10.1f} {2:>6} {3:>10.1f} {4:>6} {5:>10.1f}'
+                  .format(raw_files, full * 1000, 'read' if full_raws else '-',
+                          deferred * 1000, 'read' if deferred_raws else '-',
+                          later * 1000))
+    finally:
+        shutil.rmtree(work)
+
+if __name__ == "__main__":
+    main()
+
+# vim:expandtab
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks: reading N fields from a DF init file with one regex
+search per field compared to a single TokenIndex pass, and registering and
+looking up the options of DFConfiguration (as settings.<name>) with parallel
+dictionaries compared to Option records."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+from settings import DFConfiguration, TokenIndex
+
+def make_text(count):
+    """Returns the text of an init file with <count> fields and comments."""
+    return ''.join(
+        'Description of field number {0}, as found in d_init.txt.\n'
+        '[FIELD_{0}:{0}]\n\n'.format(i) for i in range(count))
+
+def per_field(text, fields):
+    """Old approach: one full-text search per field."""
+    return [re.search(r'\[{0}:(.+?)\]'.format(f), text) for f in fields]
+
+def indexed(text, fields):
+    """New approach: one tokenizer pass, then dictionary lookups."""
+    index = TokenIndex(text)
+    return [index.get(f) for f in fields]
+
+class DictOptions(object):
+    """Old approach: options registered one by one into parallel
+    dictionaries, with field names mapped to names separately."""
+    def __init__(self, base_dir):
+        self.settings = dict()
+        self.options = dict()
+        self.field_names = dict()
+        self.inverse_field_names = dict()
+        self.files = dict()
+        self.in_files = dict()
+        for o in DFConfiguration.schema:
+            files = tuple(os.path.join(base_dir, f) for f in o.files)
+            self.settings[o.name] = o.default
+            self.options[o.name] = o.values
+            self.field_names[o.name] = o.field_name
+            self.inverse_field_names[o.field_name] = o.name
+            self.files[o.name] = files
+            self.in_files.setdefault(files, []).append(o.name)
+
+    def __getattr__(self, name):
+        """Returns the value of <name>, as __getattr__ did."""
+        if name in self.inverse_field_names:
+            return self.settings[self.inverse_field_names[name]]
+        return self.settings[name]
+
+def attribute_reader(keys):
+    """Returns a function reading the attributes <keys> of an object, as
+    code using settings.<name> does."""
+    return eval('lambda o: [{0}]'.format(  # pylint:disable=eval-used
+        ', '.join('o.' + k for k in keys)))
+
+def options_main():
+    """Times registering the options and looking them up by name and by
+    field name."""
+    base_dir = os.path.abspath('df')
+    names = [o.name for o in DFConfiguration.schema]
+    fields = [o.field_name for o in DFConfiguration.schema]
+    repeat = 2000
+    old = min(timeit.repeat(
+        lambda: DictOptions(base_dir), number=repeat, repeat=3)) / repeat
+    new = min(timeit.repeat(
+        lambda: DFConfiguration(base_dir), number=repeat,
+        repeat=3)) / repeat
+    print('\n{0:>16} {1:>14} {2:>14} {3:>8}'.format(
+        '', 'dicts (us)', 'records (us)', 'speedup'))
+    print('{0:>16} {1:>14.1f} {2:>14.1f} {3:>7.1f}x'.format(
+        'construct', old * 1e6, new * 1e6, old / new))
+    dicts = DictOptions(base_dir)
+    records = DFConfiguration(base_dir)
+    for label, keys in (('get by name', names), ('get by field', fields)):
+        get = attribute_reader(keys)
+        old = min(timeit.repeat(
+            lambda: get(dicts), number=repeat,
+            repeat=3)) / repeat / len(keys)
+        new = min(timeit.repeat(
+            lambda: get(records), number=repeat,
+            repeat=3)) / repeat / len(keys)
+        print('{0:>16} {1:>14.3f} {2:>14.3f} {3:>7.1f}x'.format(
+            label, old * 1e6, new * 1e6, old / new))
+
+def main():
+    """Runs the benchmarks and prints tables of results."""
+    print('{0:>8} {1:>14} {2:>14} {3:>8}'.format(
+        'fields', 'per-field (ms)', 'indexed (ms)', 'speedup'))
+    for count in (10, 50, 100, 200, 400, 800):
+        text = make_text(count)
+        fields = ['FIELD_{0}'.format(i) for i in range(count)]
+        repeat = max(1, 2000 // count)
+        old = min(timeit.repeat(
+            lambda: per_field(text, fields), number=repeat, repeat=3)) / repeat
+        new = min(timeit.repeat(
+            lambda: indexed(text, fields), number=repeat, repeat=3)) / repeat
+        print('{0:>8} {1:>14.3f} {2:>14.3f} {3:>7.1f}x'.format(
+            count, old * 1000, new * 1000, old / new))
+    options_main()
+
+if __name__ == "__main__":
+    main()
+
+# vim:expandtab
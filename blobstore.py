@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Content-addressed store of files, so identical raw files in savegames, the
+DF folder and graphics packs can share a single copy on disk."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import hashlib
+import os
+import tempfile
+
+import fileops
+from writebehind import replace_file
+
+class StoreReport(object):
+    """Disk usage of a BlobStore."""
+    def __init__(self, blobs=0, stored_bytes=0, linked_bytes=0):
+        """
+        Constructor for StoreReport.
+
+        Params:
+            blobs
+                The number of files in the store.
+            stored_bytes
+                The combined size of the files in the store.
+            linked_bytes
+                The combined size of all links to the stored files, i.e. the
+                disk space they would use without the store.
+        """
+        self.blobs = blobs
+        self.stored_bytes = stored_bytes
+        self.linked_bytes = linked_bytes
+
+    def saved_bytes(self):
+        """Returns the disk space saved by sharing files."""
+        return max(0, self.linked_bytes - self.stored_bytes)
+
+    def __str__(self):
+        return '{0} file(s), {1:.1f} MiB stored, {2:.1f} MiB saved'.format(
+            self.blobs, self.stored_bytes / 1048576.0,
+            self.saved_bytes() / 1048576.0)
+
+class BlobStore(object):
+    """Stores files under the SHA-1 hash of their contents. Directory trees are
+    materialized as hard links to the stored files; the link count of a stored
+    file tells how many places use it, so no other bookkeeping is needed.
+
+    Since the links share their data, a file changed in place changes every
+    copy, including the stored one. Only trees that are rewritten by replacing
+    files (see writebehind.atomic_write and fileops.unshare_file) should be
+    absorbed, and stored files are checked against their hash before they
+    are reused."""
+    def __init__(self, root):
+        """
+        Constructor for BlobStore. The store directory is created when the
+        first file is stored.
+
+        Params:
+            root
+                The directory holding the stored files.
+        """
+        self.root = root
+        # Stored file -> (size, mtime) when its contents last matched its hash
+        self.verified = {}
+
+    def blob_path(self, digest):
+        """Returns the path of the stored file with hash <digest>."""
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def add(self, path, digest):
+        """
+        Stores a copy of <path>, unless a file with the same contents is
+        already stored. Returns the path of the stored file.
+
+        Params:
+            path
+                The file to store.
+            digest
+                The SHA-1 hash of the file contents.
+        """
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            if self.verify(blob, digest):
+                return blob
+            # Changed through one of its links; those keep the changed
+            # contents, and the store gets a correct copy
+            os.remove(blob)
+        directory = os.path.dirname(blob)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, tmp = tempfile.mkstemp(dir=directory, prefix='.')
+        os.close(handle)
+        try:
+            fileops.copy_file(path, tmp)
+            replace_file(tmp, blob)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        st = os.stat(blob)
+        self.verified[blob] = (st.st_size, st.st_mtime)
+        return blob
+
+    def verify(self, blob, digest):
+        """
+        Returns True if the contents of a stored file still match its hash.
+        Files are only hashed again if their size or modification time
+        changed since they were last checked.
+
+        Params:
+            blob
+                The stored file.
+            digest
+                The SHA-1 hash the contents should have.
+        """
+        st = os.stat(blob)
+        stamp = (st.st_size, st.st_mtime)
+        if self.verified.get(blob) == stamp:
+            return True
+        sha = hashlib.sha1()
+        with open(blob, 'rb') as f:
+            for block in iter(lambda: f.read(1048576), b''):
+                sha.update(block)
+        if sha.hexdigest() != digest:
+            self.verified.pop(blob, None)
+            return False
+        self.verified[blob] = stamp
+        return True
+
+    def link_tree(self, source, target):
+        """
+        Materializes the files in <source> under <target> as links to stored
+        files, merging with any existing contents like fileops.copy_tree.
+        Files are copied instead where links are not supported.
+
+        Params:
+            source
+                A manifest.Manifest of the tree to materialize.
+            target
+                The directory to materialize the tree in.
+
+        Returns:
+            The number of files linked.
+        """
+        blobs = [
+            (relative, self.add(
+                os.path.join(source.root, relative), source.hash(relative)))
+            for relative in sorted(source.entries)]
+        for relative in [''] + sorted(source.directories):
+            path = os.path.join(target, relative)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        linked = 0
+        for relative, blob in blobs:
+            path = os.path.join(target, relative)
+            if fileops.link_file(blob, path):
+                linked += 1
+            else:
+                fileops.copy_file(blob, path)
+        return linked
+
+    def absorb(self, tree):
+        """
+        Replaces the files in a tree with links to stored files, so they share
+        disk space with identical files elsewhere.
+
+        Params:
+            tree
+                A manifest.Manifest of the tree.
+
+        Returns:
+            The number of files linked.
+        """
+        linked = 0
+        for relative in sorted(tree.entries):
+            path = os.path.join(tree.root, relative)
+            blob = self.add(path, tree.hash(relative))
+            if fileops.link_file(blob, path):
+                linked += 1
+                # The link has the times of the stored file
+                tree.restat(relative)
+        return linked
+
+    def blobs(self):
+        """Returns a list of (path, stat result) for all stored files."""
+        if not os.path.isdir(self.root):
+            return []
+        _, files = fileops.scan_tree(self.root, False)
+        # Stat again; scandir does not report link counts on Windows
+        paths = [
+            os.path.join(self.root, relative) for relative, _ in files
+            if not os.path.basename(relative).startswith('.')]
+        return [(p, os.stat(p)) for p in paths]
+
+    def collect_garbage(self):
+        """
+        Removes stored files that are no longer linked from anywhere.
+
+        Returns:
+            A tuple (files removed, bytes freed).
+        """
+        removed = 0
+        freed = 0
+        for path, st in self.blobs():
+            if st.st_nlink < 2:
+                os.remove(path)
+                removed += 1
+                freed += st.st_size
+        return removed, freed
+
+    def report(self):
+        """Returns a StoreReport of the current disk usage."""
+        result = StoreReport()
+        for _, st in self.blobs():
+            result.blobs += 1
+            result.stored_bytes += st.st_size
+            result.linked_bytes += st.st_size * (st.st_nlink - 1)
+        return result
+
+# vim:expandtab
@@ -2,12 +2,211 @@
 # -*- coding: utf-8 -*-
 """Framework for logging errors."""
 from __future__ import print_function, unicode_literals, absolute_import
+import atexit
+import os
 import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+class LogWriter(object):
+    """Writes text captured by CaptureStream objects to their files (and
+    original streams) on a dedicated thread, in batches."""
+    def __init__(self, max_pending=10000, block=True, flush_interval=1.0):
+        """
+        Constructor for LogWriter. Call start() to start the writer thread.
+
+        Params:
+            max_pending
+                The maximum number of writes waiting to be written.
+            block
+                What to do when max_pending is reached. If True, writing
+                waits for the writer thread to catch up. If False, new writes
+                are dropped from the files (but still kept in memory), and the
+                number of dropped writes is noted in the files.
+            flush_interval
+                The maximum number of seconds written text may stay in file
+                buffers.
+        """
+        self.max_pending = max_pending
+        self.block = block
+        self.flush_interval = flush_interval
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        # Number of writes queued and written so far
+        self.queued = 0
+        self.written = 0
+        self.flush_requested = False
+        self.thread = None
+
+    def start(self):
+        """Starts the writer thread, if not already running."""
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def stopped(self):
+        """Returns True if the writer thread was started and has ended."""
+        return self.thread is not None and not self.thread.is_alive()
+
+    def put(self, stream, string):
+        """
+        Queues a string to be written for a CaptureStream. If the writer
+        thread has ended, the string is written immediately instead. Writing
+        only waits for a running writer thread.
+
+        Params:
+            stream
+                The CaptureStream the string was written to.
+            string
+                The string to write.
+        """
+        with self.condition:
+            while (len(self.pending) >= self.max_pending and self.block and
+                   self.thread is not None and self.thread.is_alive() and
+                   threading.current_thread() is not self.thread):
+                self.condition.wait(0.1)
+            if self.stopped():
+                self.pending.append((stream, string))
+                self.queued += 1
+                self.write_pending()
+                return
+            if len(self.pending) >= self.max_pending and (
+                    not self.block or self.thread is None):
+                self.dropped += 1
+                return
+            self.pending.append((stream, string))
+            self.queued += 1
+            self.condition.notify_all()
+
+    def write_pending(self):
+        """Writes and flushes all queued strings on the calling thread.
+        Used once the writer thread has ended; the caller must hold
+        self.condition."""
+        batch = self.pending
+        self.pending = deque()
+        self.write_batch(batch, self.dropped, True)
+        self.dropped = 0
+        self.written += len(batch)
+
+    @staticmethod
+    def report():
+        """Writes the exception being handled to the original stderr,
+        bypassing the captured streams."""
+        if sys.__stderr__ is None:
+            return
+        try:
+            traceback.print_exc(file=sys.__stderr__)
+        except Exception:  # pylint:disable=broad-except
+            pass
+
+    def write_batch(self, batch, dropped, flush, dirty=None):
+        """
+        Writes a batch of queued strings. Errors are reported to the original
+        stderr; the rest of the batch is lost.
+
+        Params:
+            batch
+                A sequence of (stream, string) tuples to write.
+            dropped
+                The number of writes dropped since the last batch.
+            flush
+                If True, flush the streams written to.
+            dirty
+                A set collecting the streams written but not flushed, or None.
+        """
+        streams = set(s for s, _ in batch)
+        try:
+            for stream, string in batch:
+                stream.write_out(string)
+            if dropped:
+                for stream in streams:
+                    stream.write_out(
+                        '\n[{0} log messages dropped]\n'.format(dropped))
+            if flush:
+                for stream in streams.union(dirty or ()):
+                    stream.flush_out()
+                if dirty is not None:
+                    dirty.clear()
+            elif dirty is not None:
+                dirty.update(streams)
+        except Exception:  # pylint:disable=broad-except
+            self.report()
+
+    def run(self):
+        """Writes queued strings in batches. Runs in a thread; once it has
+        ended, strings are written by put."""
+        try:
+            self.write_loop()
+        except Exception:  # pylint:disable=broad-except
+            self.report()
+
+    def write_loop(self):
+        """Writes queued strings in batches until an unexpected error
+        occurs."""
+        last_flush = time.time()
+        dirty = set()
+        while True:
+            with self.condition:
+                while not self.pending and not self.flush_requested:
+                    if dirty:
+                        self.condition.wait(
+                            max(0, last_flush + self.flush_interval -
+                                time.time()))
+                        if time.time() >= last_flush + self.flush_interval:
+                            break
+                    else:
+                        self.condition.wait()
+                batch = self.pending
+                self.pending = deque()
+                dropped = self.dropped
+                self.dropped = 0
+                flush = self.flush_requested
+                self.flush_requested = False
+                self.condition.notify_all()
+            try:
+                flush = (
+                    flush or time.time() >= last_flush + self.flush_interval)
+                self.write_batch(batch, dropped, flush, dirty)
+                if flush:
+                    last_flush = time.time()
+            finally:
+                with self.condition:
+                    self.written += len(batch)
+                    self.condition.notify_all()
+
+    def flush(self):
+        """Waits until everything queued so far has been written and flushed
+        to disk."""
+        if self.stopped():
+            with self.condition:
+                self.write_pending()
+            return
+        if self.thread is None:
+            return
+        if threading.current_thread() is self.thread:
+            return
+        with self.condition:
+            target = self.queued
+            self.flush_requested = True
+            self.condition.notify_all()
+            while self.written < target or self.flush_requested:
+                self.condition.wait(0.1)
+                if not self.thread.is_alive():
+                    self.write_pending()
+                    return
 
 class CaptureStream(object):
-    """ Redirects output to a file-like object to an internal list as well as a
-    file."""
-    def __init__(self, name, tee=True):
+    """ Redirects output to a file-like object to an internal ring buffer as
+    well as a file. File writes are performed by a LogWriter."""
+    def __init__(
+            self, name, tee=True, capacity=5000, max_bytes=1048576,
+            backups=2, log_writer=None):
         """
         Constructor for CaptureStream. Call redirect() to start redirection.
 
@@ -18,30 +217,125 @@ class CaptureStream(object):
             tee
                 If True, forward writing to the original stream after
                 capturing. If False, the redirected stream is not used.
+            capacity
+                The number of most recent writes to keep in memory.
+            max_bytes
+                The size at which the output file is rotated.
+            backups
+                The number of rotated output files to keep (e.g. stdout.txt.1
+                and stdout.txt.2).
+            log_writer
+                The LogWriter performing file writes. Defaults to the shared
+                module-level writer.
         """
         self.softspace = 0
-        self.lines = []
+        self.lines = deque(maxlen=capacity)
+        # Number of strings written so far; the last one has this number
+        self.sequence = 0
+        self.lock = threading.Lock()
         self.name = name
         self.tee = tee
         self.stream = getattr(sys, name)
         self.outfile = None
+        self.filename = name + '.txt'
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file_size = 0
+        self.log_writer = log_writer or writer
 
     def write(self, string):
         """
-        Writes a string to the captured stream.
+        Writes a string to the captured stream. The string is kept in memory
+        immediately, and queued for writing to the file.
+
+        Params:
+            string
+                The string to write.
+        """
+        with self.lock:
+            self.sequence += 1
+            self.lines.append(string)
+            # Queue while holding the lock, so writes reach the file in the
+            # order they are numbered. put only waits for a running writer
+            # thread, which does not take this lock
+            self.log_writer.put(self, string)
+
+    def write_out(self, string):
+        """
+        Writes a string to the file and, if enabled, the original stream.
+        Called by the LogWriter.
 
         Params:
             string
                 The string to write.
         """
-        self.lines.append(string)
         self.outfile.write(string)
+        self.file_size += self.encoded_size(string)
+        if self.file_size > self.max_bytes:
+            self.rotate()
         if self.tee:
-            return self.stream.write(string)
+            self.stream.write(string)
+
+    def encoded_size(self, string):
+        """
+        Returns the number of bytes written to the output file for a string,
+        including line endings translated by the file.
+
+        Params:
+            string
+                The string written.
+        """
+        data = string
+        if not isinstance(string, bytes):
+            encoding = getattr(self.outfile, 'encoding', None) or 'utf-8'
+            data = string.encode(encoding, 'replace')
+        # Text files write each newline as os.linesep
+        return len(data) + data.count(b'\n') * (len(os.linesep) - 1)
+
+    def read_since(self, sequence):
+        """
+        Returns a tuple (text, sequence) containing the text written after
+        write number <sequence> that is still in memory, and the number of the
+        last write.
+
+        Params:
+            sequence
+                Number of the last write already read, or 0 to read all text
+                in memory.
+        """
+        with self.lock:
+            lines = list(self.lines)
+            last = self.sequence
+        count = min(last - sequence, len(lines))
+        return ''.join(lines[len(lines) - count:]), last
+
+    def rotate(self):
+        """Moves the output file to a numbered backup and starts a new one,
+        discarding the oldest backup."""
+        self.outfile.close()
+        for i in range(self.backups, 0, -1):
+            source = self.filename
+            if i > 1:
+                source = '{0}.{1}'.format(self.filename, i - 1)
+            target = '{0}.{1}'.format(self.filename, i)
+            if os.path.exists(source):
+                if os.path.exists(target):
+                    os.remove(target)
+                os.rename(source, target)
+        self.outfile = open(self.filename, 'w')
+        self.file_size = 0
 
     def flush(self):
-        """Flushes the output file."""
+        """Waits for everything written so far to be flushed to the output
+        file."""
+        self.log_writer.flush()
+
+    def flush_out(self):
+        """Flushes the output file and the original stream. Called by the
+        LogWriter."""
         self.outfile.flush()
+        if self.tee:
+            self.stream.flush()
 
     def hook(self):
         """Replaces the named stream with the redirected stream."""
@@ -53,7 +347,8 @@ class CaptureStream(object):
 
     def redirect(self):
         """Sets up the initial redirection."""
-        self.outfile = open(self.name+'.txt', 'w')
+        self.outfile = open(self.filename, 'w')
+        self.log_writer.start()
         self.hook()
 
 def start():
@@ -61,6 +356,7 @@ def start():
     out.redirect()
     err.redirect()
 
+writer = LogWriter()
 out = CaptureStream('stdout', not hasattr(sys, 'frozen'))
 err = CaptureStream('stderr', not hasattr(sys, 'frozen'))
 
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Copying and removal of files and directory trees. Files are copied using
+the fastest method supported by the file systems involved, and trees are
+processed by a pool of threads."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import errno
+import os
+import shutil
+import stat
+import sys
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import tracing
+from writebehind import replace_file
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    from os import scandir
+except ImportError:  # Python 2
+    try:
+        # pylint:disable=import-error
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Number of threads used to copy or remove files
+WORKERS = 8
+
+# ioctl request to share the data blocks of another file (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# Errors meaning a copy method is not supported for a pair of devices; it is
+# not tried again for them
+_UNSUPPORTED = set(
+    getattr(errno, n) for n in (
+        'EXDEV', 'EOPNOTSUPP', 'ENOTSUP', 'ENOSYS') if hasattr(errno, n))
+
+# Errors that may only concern the file at hand (e.g. its permissions or
+# link count); it is copied plainly, and the method is kept for other files
+_FAILED = set(
+    getattr(errno, n) for n in (
+        'EPERM', 'EINVAL', 'EBADF', 'ENOTTY', 'EMLINK') if hasattr(errno, n))
+
+# (source device, target device) -> set of methods found not to work
+_unsupported = {}
+
+# (source device, target device) pairs reflinks were found to work for
+_reflinked = set()
+
+def _methods():
+    """Returns the names of the data copying methods available on this
+    platform, fastest first."""
+    result = []
+    if fcntl is not None and sys.platform.startswith('linux'):
+        result.append('reflink')
+    if hasattr(os, 'copy_file_range'):
+        result.append('copy_file_range')
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        result.append('sendfile')
+    return result
+
+METHODS = _methods()
+
+def _reflink(src, dst, size):
+    """Makes <dst> share the data blocks of <src>."""
+    # pylint:disable=unused-argument
+    fcntl.ioctl(dst, FICLONE, src)
+
+def _copy_file_range(src, dst, size):
+    """Copies data inside the kernel with copy_file_range."""
+    # pylint:disable=no-member
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(src, dst, size - copied)
+        if count == 0:
+            if copied == 0:
+                # Some file systems silently copy nothing
+                raise OSError(errno.EINVAL, 'No data copied')
+            break
+        copied += count
+
+def _sendfile(src, dst, size):
+    """Copies data inside the kernel with sendfile."""
+    copied = 0
+    while copied < size:
+        count = os.sendfile(dst, src, copied, size - copied)
+        if count == 0:
+            if copied == 0:
+                # Some file systems silently copy nothing
+                raise OSError(errno.EINVAL, 'No data copied')
+            break
+        copied += count
+
+_COPIERS = {
+    'reflink': _reflink, 'copy_file_range': _copy_file_range,
+    'sendfile': _sendfile}
+
+def _devices(source, target):
+    """Returns the (source device, target device) key of <_unsupported> for
+    copying <source> to <target>."""
+    return (
+        os.stat(source).st_dev,
+        os.stat(os.path.dirname(os.path.abspath(target))).st_dev)
+
+def link_file(source, target):
+    """
+    Replaces <target> with a hard link to <source>. Returns False if this is
+    not supported for these files (e.g. they are on different devices).
+
+    Params:
+        source
+            The file to link to.
+        target
+            The link to create or replace.
+    """
+    key = _devices(source, target)
+    if 'link' in _unsupported.get(key, ()):
+        return False
+    if key[0] != key[1]:
+        _unsupported.setdefault(key, set()).add('link')
+        return False
+    if os.path.lexists(target):
+        if os.path.samefile(source, target):
+            return True
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except (OSError, AttributeError) as ex:
+        if isinstance(ex, AttributeError) or ex.errno in _UNSUPPORTED:
+            _unsupported.setdefault(key, set()).add('link')
+            return False
+        if ex.errno in _FAILED:
+            return False
+        raise
+    return True
+
+def copy_file(source, target, link=False):
+    """
+    Copies the file <source> to <target>, preserving permission bits and
+    times like shutil.copy2. The data is shared with a reflink if the file
+    system supports it; otherwise it is copied in the kernel with
+    copy_file_range or sendfile if possible, or by reading and writing.
+    Methods not supported for a pair of file systems are not tried again;
+    if a method fails for other reasons, the file is copied by reading and
+    writing.
+
+    Params:
+        source
+            The file to copy.
+        target
+            The file to create or replace.
+        link
+            If True, <target> is made a hard link to <source> where possible.
+            Only use this for files that are never modified in place, since
+            changes to one file will be visible in the other.
+
+    Returns:
+        The name of the method used.
+    """
+    if link and link_file(source, target):
+        tracing.add_io(0)
+        return 'link'
+    if os.path.lexists(target) and (
+            os.path.islink(target) or os.lstat(target).st_nlink > 1):
+        # Don't write through to the file <target> is linked to
+        os.remove(target)
+    with open(source, 'rb') as fsrc:
+        st = os.fstat(fsrc.fileno())
+        with open(target, 'wb') as fdst:
+            key = (st.st_dev, os.fstat(fdst.fileno()).st_dev)
+            unsupported = _unsupported.get(key, ())
+            method = None
+            for name in METHODS:
+                if name in unsupported:
+                    continue
+                try:
+                    _COPIERS[name](fsrc.fileno(), fdst.fileno(), st.st_size)
+                except (OSError, IOError) as ex:
+                    if not (ex.errno in _UNSUPPORTED or ex.errno in _FAILED):
+                        raise
+                    fdst.seek(0)
+                    fdst.truncate()
+                    if ex.errno in _FAILED:
+                        break
+                    _unsupported.setdefault(key, set()).add(name)
+                    # Start over with the next method
+                    continue
+                method = name
+                if name == 'reflink':
+                    _reflinked.add(key)
+                break
+            if method is None:
+                method = 'copy'
+                fsrc.seek(0)
+                shutil.copyfileobj(fsrc, fdst, 1048576)
+    shutil.copystat(source, target)
+    tracing.add_io(st.st_size)
+    return method
+
+def can_reflink(source, target):
+    """
+    Returns True if the files in the directory <source> can be copied into
+    the directory <target> with reflinks, so copying them writes no data.
+    The first time a pair of devices is checked, this is found out by
+    reflinking a file of <source> into a temporary file.
+
+    Params:
+        source
+            The directory to copy from.
+        target
+            An existing directory on the device to copy to.
+    """
+    if 'reflink' not in METHODS:
+        return False
+    key = (os.stat(source).st_dev, os.stat(target).st_dev)
+    if key in _reflinked:
+        return True
+    if 'reflink' in _unsupported.get(key, ()):
+        return False
+    sample = None
+    for directory, _, names in os.walk(source):
+        if names:
+            sample = os.path.join(directory, names[0])
+            break
+    if sample is None:
+        return False
+    handle, tmp = tempfile.mkstemp(dir=target)
+    try:
+        with open(sample, 'rb') as f:
+            _COPIERS['reflink'](f.fileno(), handle, 0)
+    except (OSError, IOError) as ex:
+        if ex.errno in _FAILED:
+            return False
+        if ex.errno not in _UNSUPPORTED:
+            raise
+        _unsupported.setdefault(key, set()).add('reflink')
+        return False
+    finally:
+        os.close(handle)
+        os.remove(tmp)
+    _reflinked.add(key)
+    return True
+
+def unshare_file(path):
+    """
+    If <path> is hard linked to other files, replaces it with a copy of its
+    own, so it can safely be modified in place.
+
+    Params:
+        path
+            The file to unshare.
+    """
+    if os.stat(path).st_nlink < 2:
+        return
+    directory, name = os.path.split(os.path.abspath(path))
+    handle, tmp = tempfile.mkstemp(dir=directory, prefix='.' + name + '.')
+    os.close(handle)
+    try:
+        copy_file(path, tmp)
+        replace_file(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _list_dir(path, follow_links):
+    """
+    Returns a list of (name, is directory, stat result) for the entries of
+    the directory <path>. The stat result is None for directories. Broken
+    symbolic links are skipped.
+    """
+    result = []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                is_dir = entry.is_dir(follow_symlinks=follow_links)
+                st = None if is_dir else entry.stat(
+                    follow_symlinks=follow_links)
+            except OSError:  # Broken link
+                continue
+            result.append((entry.name, is_dir, st))
+    else:
+        stat_func = os.stat if follow_links else os.lstat
+        for name in os.listdir(path):
+            try:
+                st = stat_func(os.path.join(path, name))
+            except OSError:
+                continue
+            is_dir = stat.S_ISDIR(st.st_mode)
+            result.append((name, is_dir, None if is_dir else st))
+    return result
+
+def scan_tree(root, follow_links=True):
+    """
+    Lists the contents of the directory <root> with a single pass of
+    os.scandir per directory.
+
+    Params:
+        root
+            The directory to scan.
+        follow_links
+            If True, symbolic links are treated as the files or directories
+            they point to. Otherwise, they are listed as files.
+
+    Returns:
+        A tuple (directories, files), where directories is a list of the
+        relative paths of all subdirectories (parents before children) and
+        files is a list of (relative path, stat result) for all files.
+    """
+    directories = []
+    files = []
+    pending = ['']
+    while pending:
+        relative = pending.pop()
+        for name, is_dir, st in _list_dir(
+                os.path.join(root, relative), follow_links):
+            path = os.path.join(relative, name)
+            if is_dir:
+                directories.append(path)
+                pending.append(path)
+            else:
+                files.append((path, st))
+    return directories, files
+
+def _run(func, items, progress):
+    """
+    Calls <func> for each of <items>, using a thread pool if there are
+    several, and reports progress after each call.
+
+    Params:
+        func
+            Function taking a single item.
+        items
+            The items to process.
+        progress
+            Function called with (items done, total items), or None.
+
+    Returns:
+        True if the calls were made by other threads.
+    """
+    total = len(items)
+    if total < 2 or WORKERS < 2:
+        results = (func(i) for i in items)
+        pool = None
+    else:
+        pool = ThreadPool(min(WORKERS, total))
+        results = pool.imap_unordered(func, items, 8)
+    try:
+        for done, _ in enumerate(results, 1):
+            if progress is not None:
+                progress(done, total)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return pool is not None
+
+def copy_files(jobs, link=False, progress=None):
+    """
+    Copies files with copy_file, in parallel. The target directories must
+    exist.
+
+    Params:
+        jobs
+            A list of (source, target, size) tuples.
+        link
+            See copy_file.
+        progress
+            Function called with (files copied, total files) after each file,
+            or None.
+    """
+    if _run(lambda job: copy_file(job[0], job[1], link), jobs, progress):
+        # Worker threads can't add to the operation being traced
+        tracing.add_io(sum(job[2] for job in jobs), len(jobs))
+
+def copy_tree(source, target, link=False, progress=None):
+    """
+    Copies the directory <source> and all its contents into <target>,
+    merging with any existing contents, as distutils.dir_util.copy_tree
+    does. Files are copied in parallel with copy_file.
+
+    Params:
+        source
+            The directory to copy.
+        target
+            The directory to copy into. Created if missing.
+        link
+            See copy_file.
+        progress
+            Function called with (files copied, total files) after each file,
+            or None.
+
+    Returns:
+        A list of the files copied to <target>.
+    """
+    if not os.path.isdir(source):
+        raise IOError('No such directory: ' + source)
+    directories, files = scan_tree(source)
+    for relative in [''] + directories:
+        path = os.path.join(target, relative)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    jobs = [
+        (os.path.join(source, relative), os.path.join(target, relative),
+         st.st_size) for relative, st in files]
+    copy_files(jobs, link, progress)
+    return [job[1] for job in jobs]
+
+def remove_tree(path, progress=None):
+    """
+    Removes the directory <path> and all its contents. Files are removed in
+    parallel.
+
+    Params:
+        path
+            The directory to remove.
+        progress
+            Function called with (files removed, total files) after each file,
+            or None.
+    """
+    # Remove links rather than what they point to
+    directories, files = scan_tree(path, False)
+    _run(
+        lambda f: os.remove(os.path.join(path, f[0])), files, progress)
+    tracing.add_io(0, len(files))
+    for relative in reversed(directories):
+        os.rmdir(os.path.join(path, relative))
+    os.rmdir(path)
+
+# vim:expandtab
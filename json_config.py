@@ -3,28 +3,90 @@
 """Proxy to abstract access to JSON configuration and gracefully handle missing
 keys."""
 from __future__ import print_function, unicode_literals, absolute_import
+import atexit
 import json
+import threading
+import weakref
+
+from writebehind import WriteBehind, atomic_write
+
+# Configurations with a writer, flushed once at exit
+_instances = weakref.WeakSet()
+
+@atexit.register
+def _flush_all():
+    """Writes unsaved changes of all configurations at exit."""
+    for config in list(_instances):
+        config.flush()
+
+def _write_later(ref):
+    """Returns a function for the writer thread of a configuration, which
+    writes it through the weak reference <ref>, so the thread does not keep
+    the configuration alive."""
+    def write():
+        """Writes the configuration."""
+        config = ref()
+        if config is not None:
+            config.write()
+    return write
 
 class JSONConfiguration(object):
     """Proxy for JSON-based configuration files."""
 
-    def __init__(self, filename):
+    def __init__(self, filename, delay=1.0, compact=False):
         """
         Constructor for JSONConfiguration.
 
         Params:
             filename
                 JSON filename to load data from.
+            delay
+                Seconds to wait for further changes before saving; all saves
+                requested within this window are written at once.
+            compact
+                If True, the file is written without indentation or spaces.
         """
         self.filename = filename
+        self.compact = compact
+        self.dirty = False
+        self.lock = threading.Lock()
         try:
-            self.data = json.load(open(filename), encoding='utf-8')
+            json_file = open(filename)
+            try:
+                self.data = json.load(json_file)
+            finally:
+                json_file.close()
         except IOError:
             self.data = {}
+        self.writer = WriteBehind(_write_later(weakref.ref(self)), delay)
+        _instances.add(self)
 
     def save_data(self):
-        """Saves the data to the JSON file."""
-        json.dump(self.data, open(self.filename, 'w'), indent=2)
+        """Saves the data to the JSON file if it has changed. The file is
+        written in the background once no changes have been made for a
+        while; call flush to write it immediately."""
+        if self.dirty:
+            self.writer.schedule()
+
+    def flush(self):
+        """Writes any unsaved changes immediately."""
+        self.writer.flush()
+
+    def write(self):
+        """Writes the data to the JSON file, if it has changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            if self.compact:
+                text = json.dumps(self.data, separators=(',', ':'))
+            else:
+                text = json.dumps(self.data, indent=2)
+            self.dirty = False
+        try:
+            atomic_write(self.filename, text)
+        except:
+            self.dirty = True
+            raise
 
     def get_value(self, path, default=None):
         """
@@ -114,10 +176,28 @@ class JSONConfiguration(object):
         """
         self.__setitem__(key, value)
 
+    def replace_value(self, key, value):
+        """
+        Writes a value to a key without comparing it to the current value,
+        e.g. for large values that are known to have changed.
+
+        Params:
+            key
+                The key to save the value under.
+            value
+                The value to save.
+        """
+        with self.lock:
+            self.data[key] = value
+            self.dirty = True
+
     def __getitem__(self, key):
         """Accessor for indexing directly into the configuration."""
         return self.get_value(key)
 
     def __setitem__(self, key, value):
         """Accessor for writing into the configuration with indexing."""
-        self.data[key] = value
+        with self.lock:
+            if key not in self.data or self.data[key] != value:
+                self.data[key] = value
+                self.dirty = True
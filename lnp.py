@@ -6,32 +6,56 @@ from __future__ import print_function, unicode_literals, absolute_import
 import sys
 from tkgui.tkgui import TkGui
 
-import distutils.dir_util as dir_util
 import fnmatch
 import glob
+import hashlib
+import json
 import os
 import re
 import shutil
+import struct
 import subprocess
-import tempfile
+import tarfile
 import time
+import zipfile
+from collections import OrderedDict
 from datetime import datetime
+from blobstore import BlobStore
 import errorlog
+import fileops
+import manifest
+import packarchive
+import packslots
+import tracing
+from multiprocessing.pool import ThreadPool
 from threading import Thread
 
-from settings import DFConfiguration
+from settings import (
+    DFConfiguration, TokenCache, TokenIndex, file_cache, patch_fields)
 from json_config import JSONConfiguration
+from writebehind import WriteBehind, atomic_write
 
 try:  # Python 2
     # pylint:disable=import-error
     from urllib2 import urlopen, URLError, Request
+    import Queue as queue
 except ImportError:  # Python 3
     # pylint:disable=import-error, no-name-in-module
     from urllib.request import urlopen, Request
     from urllib.error import URLError
+    import queue
 
 BASEDIR = '.'
 VERSION = '0.5.1'
+# Number of previously selected DF instances kept loaded for fast switching
+CACHED_INSTANCES = 4
+# Number of savegames updated at the same time
+SAVEGAME_WORKERS = 4
+# Number of graphics packs simplified at the same time
+SIMPLIFY_WORKERS = 4
+# Files of data/init taken from graphics packs
+PACK_INIT_FILES = (
+    'colors.txt', 'init.txt', 'd_init.txt', 'overrides.txt')
 
 
 class PyLNP(object):
@@ -66,6 +90,8 @@ class PyLNP(object):
         self.utils_dir = self.identify_folder_name(self.lnp_dir, 'Utilities')
         self.colors_dir = self.identify_folder_name(self.lnp_dir, 'Colors')
         self.embarks_dir = self.identify_folder_name(self.lnp_dir, 'Embarks')
+        # Shared copies of raw files, when deduplication is enabled
+        self.raw_store = BlobStore(os.path.join(self.lnp_dir, 'Store'))
 
         self.folders = []
         self.df_dir = ''
@@ -74,12 +100,37 @@ class PyLNP(object):
         self.save_dir = ''
         self.autorun = []
         self.running = {}
+        # Titles of the hacks enabled in the current DF instance
+        self.enabled_hacks = set()
+        # Name -> (stamps, result) of the assets of the current DF instance,
+        # see instance_asset
+        self.assets = {}
+        # df_dir -> (file stamps, DFConfiguration, enabled hacks, assets)
+        self.instances = OrderedDict()
+        # Option changes are written in the background once they settle down
+        self.params_writer = WriteBehind(self.write_params)
 
         config_file = 'PyLNP.json'
         if os.access(os.path.join(self.lnp_dir, 'PyLNP.json'), os.F_OK):
             config_file = os.path.join(self.lnp_dir, 'PyLNP.json')
         self.config = JSONConfiguration(config_file)
         self.userconfig = JSONConfiguration('PyLNP.user')
+        # Results of folder scans, validated by modification times
+        self.scan_cache = JSONConfiguration('PyLNP.cache', compact=True)
+        # Absolute path -> manifest entries of directory trees, kept apart
+        # from the scan results since they are large and change often
+        self.manifest_cache = JSONConfiguration(
+            'PyLNP.manifests', compact=True)
+        self.checked_scans = set()
+        self.unchecked_scans = {}
+        # (name, result, stamps, changed) of scans redone by the background
+        # check, to be stored by the UI thread; see apply_scan_results
+        self.scan_results = queue.Queue()
+        # (FONT, GRAPHICS_FONT) -> graphics pack, see read_graphics_index
+        self.pack_lookup = None
+        # (df_dir, changed paths) last written to the output log
+        self.reported_drift = None
+        self.ui = None
 
         self.load_autorun()
         self.find_df_folder()
@@ -87,8 +138,10 @@ class PyLNP(object):
         self.new_version = None
 
         self.ui = TkGui(self)
+        self.revalidate_scans()
         self.check_update()
         self.ui.start()
+        self.save_params()
 
     @staticmethod
     def identify_folder_name(base, name):
@@ -109,10 +162,20 @@ class PyLNP(object):
             return lower
         return normal
 
-    def load_params(self):
-        """Loads settings from the selected Dwarf Fortress instance."""
+    def load_params(self, lazy=False):
+        """
+        Loads settings from the selected Dwarf Fortress instance.
+
+        Params:
+            lazy
+                If True, each set of files is only read once one of its
+                settings is used.
+        """
+        self.save_params()
+        # Files may have been edited externally; re-read everything
+        file_cache.invalidate()
         try:
-            self.settings.read_settings()
+            self.settings.read_settings(lazy)
         except IOError:
             sys.excepthook(*sys.exc_info())
             msg = ("Failed to read settings, "
@@ -120,8 +183,14 @@ class PyLNP(object):
             raise IOError(msg)
 
     def save_params(self):
-        """Saves settings to the selected Dwarf Fortress instance."""
-        self.settings.write_settings()
+        """Saves settings to the selected Dwarf Fortress instance, including
+        any changes still waiting to be written in the background."""
+        self.params_writer.flush()
+
+    def write_params(self):
+        """Writes changed settings. Called by the background writer."""
+        if self.settings is not None:
+            self.settings.write_settings()
 
     def save_config(self):
         """Saves LNP configuration."""
@@ -129,6 +198,7 @@ class PyLNP(object):
 
     def restore_defaults(self):
         """Copy default settings into the selected Dwarf Fortress instance."""
+        self.save_params()
         shutil.copy(
             os.path.join(self.lnp_dir, 'Defaults', 'init.txt'),
             os.path.join(self.init_dir, 'init.txt')
@@ -139,8 +209,10 @@ class PyLNP(object):
         )
         self.load_params()
 
+    @tracing.traced()
     def run_df(self, force=False):
         """Launches Dwarf Fortress."""
+        self.save_params()
         result = None
         if sys.platform == 'win32':
             result = self.run_program(
@@ -294,14 +366,68 @@ class PyLNP(object):
 
         :param path: The path of the Dwarf Fortress instance to use.
         """
-        self.df_dir = os.path.abspath(path)
+        self.save_params()
+        df_dir = os.path.abspath(path)
+        # Taken out first, so caching the current instance cannot evict it
+        cached = self.instances.pop(df_dir, None)
+        self.cache_instance()
+        cached = self.instances.pop(df_dir, cached)
+        self.df_dir = df_dir
         self.init_dir = os.path.join(self.df_dir, 'data', 'init')
         self.save_dir = os.path.join(self.df_dir, 'data', 'save')
-        self.settings = DFConfiguration(self.df_dir)
+        if cached is not None and cached[0] == self.instance_stamps(cached[1]):
+            self.settings, self.enabled_hacks, self.assets = cached[1:]
+            return
+        self.assets = {}
+        self.settings = DFConfiguration(self.df_dir, self.raw_index_file())
         self.install_extras()
-        self.load_params()
+        self.load_params(True)
         self.read_hacks()
 
+    def raw_index_file(self):
+        """Returns the file the index of the raws of the current DF folder is
+        stored in. Each DF folder has its own file in PyLNP.rawindex, next to
+        the other caches of PyLNP, so nothing is added to the DF folder."""
+        key = hashlib.sha1(self.df_dir.encode('utf-8')).hexdigest()
+        return os.path.abspath(os.path.join('PyLNP.rawindex', key + '.json'))
+
+    def cache_instance(self):
+        """Keeps the loaded state of the current DF instance, so switching
+        back to it does not require reloading anything."""
+        if self.settings is None:
+            return
+        self.instances.pop(self.df_dir, None)
+        self.instances[self.df_dir] = (
+            self.instance_stamps(self.settings), self.settings,
+            self.enabled_hacks, self.assets)
+        while len(self.instances) > CACHED_INSTANCES:
+            self.instances.popitem(last=False)
+
+    @staticmethod
+    def instance_stamps(settings):
+        """
+        Returns stamps for all files the loaded state of a DF instance depends
+        on. If any of these change, the instance must be reloaded.
+
+        Params:
+            settings
+                The DFConfiguration of the instance.
+        """
+        files = set()
+        for fileset in settings.in_files:
+            files.update(settings.paths(fileset))
+        files.add(os.path.join(settings.base_dir, 'raw', 'objects'))
+        files.add(os.path.join(settings.base_dir, 'PyLNP_dfhack_onload.init'))
+        files.add(os.path.join(
+            settings.base_dir, 'PyLNP{0}.txt'.format(VERSION)))
+        result = []
+        for f in sorted(files):
+            try:
+                result.append((f, TokenCache.stamp(f)))
+            except OSError:
+                result.append((f, None))
+        return result
+
     @staticmethod
     def get_text_files(directory):
         """
@@ -319,40 +445,419 @@ class PyLNP(object):
                 result.append(f)
         return result
 
+    @staticmethod
+    def path_stamps(paths):
+        """
+        Returns a dictionary mapping each of <paths> to its modification time,
+        or None if it does not exist.
+
+        Params:
+            paths
+                The files and directories to stat.
+        """
+        result = {}
+        for p in paths:
+            try:
+                result[p] = os.stat(p).st_mtime
+            except OSError:
+                result[p] = None
+        return result
+
+    def instance_asset(self, name, scan):
+        """
+        Returns the result of a scan of the current DF instance. Results are
+        kept with the instance while the modification times of the scanned
+        paths are unchanged, so switching back to an instance does not
+        require scanning it again.
+
+        Params:
+            name
+                The name to keep the result under.
+            scan
+                Function performing the scan. Must return a tuple
+                (result, paths), where paths is a list of the files and
+                directories the result depends on.
+        """
+        entry = self.assets.get(name)
+        if entry is not None and entry[0] == self.path_stamps(entry[0]):
+            return entry[1]
+        result, paths = scan()
+        self.assets[name] = (self.path_stamps(paths), result)
+        return result
+
+    def cached_scan(self, name, scan):
+        """
+        Returns the result of a folder scan, cached in PyLNP.cache.
+
+        The first time a cached result is used in a session, it is returned
+        immediately and checked in the background; if it turns out to be
+        stale, the UI is notified to store the new result with
+        apply_scan_results. Afterwards, cached results are used as long as
+        the modification times of the scanned paths are unchanged.
+
+        Params:
+            name
+                The name to cache the result under.
+            scan
+                Function performing the scan. Must return a tuple
+                (result, paths), where paths is a list of the files and
+                directories the result depends on. The result must survive
+                a round trip through JSON.
+        """
+        entry = self.scan_cache.get_value(name)
+        if entry is not None:
+            if name not in self.checked_scans:
+                self.checked_scans.add(name)
+                self.unchecked_scans[name] = scan
+                if self.ui is not None:
+                    self.revalidate_scans()
+                return entry['result']
+            if entry['stamps'] == self.path_stamps(entry['stamps'].keys()):
+                return entry['result']
+        self.checked_scans.add(name)
+        return self.update_scan(name, scan)
+
+    def update_scan(self, name, scan):
+        """
+        Performs a scan and caches the result.
+
+        Params:
+            name
+                The name to cache the result under.
+            scan
+                Function performing the scan. See cached_scan.
+        """
+        result, stamps = self.run_scan(scan)
+        self.scan_cache[name] = {'result': result, 'stamps': stamps}
+        self.scan_cache.save_data()
+        return result
+
+    def run_scan(self, scan):
+        """
+        Performs a scan. Returns a tuple (result as stored in the cache,
+        modification times of the scanned paths).
+
+        Params:
+            scan
+                Function performing the scan. See cached_scan.
+        """
+        result, paths = scan()
+        return json.loads(json.dumps(result)), self.path_stamps(paths)
+
+    def revalidate_scans(self):
+        """Starts a background check of cached scan results used for the
+        first time in this session."""
+        if not self.unchecked_scans:
+            return
+        # The thread gets the cached entries, so it does not read the cache
+        scans = dict(
+            (name, (scan, self.scan_cache.get_value(name)))
+            for name, scan in self.unchecked_scans.items())
+        self.unchecked_scans = {}
+        t = Thread(target=self.perform_revalidation, args=(scans,))
+        t.daemon = True
+        t.start()
+
+    def perform_revalidation(self, scans):
+        """
+        Rescans stale cached results. Runs in a thread, so the new results
+        are only queued; the UI is notified to store them with
+        apply_scan_results.
+
+        Params:
+            scans
+                Dictionary mapping cache names to tuples (scan function,
+                cached entry).
+        """
+        try:
+            stale = False
+            for name, (scan, entry) in scans.items():
+                stamps = self.path_stamps(entry['stamps'].keys())
+                if entry['stamps'] != stamps:
+                    result, stamps = self.run_scan(scan)
+                    self.scan_results.put(
+                        (name, result, stamps, result != entry['result']))
+                    stale = True
+            if stale:
+                self.ui.on_scan_changed()
+        except Exception:
+            sys.excepthook(*sys.exc_info())
+
+    def apply_scan_results(self):
+        """
+        Stores the results queued by the background check of cached scans.
+        Call from the UI thread once notified through on_scan_changed.
+
+        Returns:
+            True if any of the results differ from those cached before, i.e.
+            lists shown need to be read again.
+        """
+        changed = False
+        stored = False
+        while True:
+            try:
+                name, result, stamps, differs = self.scan_results.get_nowait()
+            except queue.Empty:
+                break
+            self.scan_cache[name] = {'result': result, 'stamps': stamps}
+            changed |= differs
+            stored = True
+        if stored:
+            self.scan_cache.save_data()
+        return changed
+
     def read_keybinds(self):
         """Returns a list of keybinding files."""
-        return tuple([
+        return tuple(self.cached_scan('keybinds', lambda: ([
             os.path.basename(o) for o in self.get_text_files(self.keybinds_dir)
-            ])
+            ], [self.keybinds_dir])))
 
     def read_graphics(self):
-        """Returns a list of graphics directories."""
-        packs = [
-            os.path.basename(o) for o in
-            glob.glob(os.path.join(self.graphics_dir, '*')) if
-            os.path.isdir(o)]
-        result = []
+        """Returns a list of (name, font, graphics font) for the graphics
+        packs."""
+        packs = self.read_graphics_index()
+        return tuple((p['name'], p['font'], p['graphics_font']) for p in packs)
+
+    def read_graphics_index(self):
+        """
+        Returns a list of dictionaries describing the graphics packs, sorted
+        by name:
+
+            name
+                The name of the pack folder.
+            font, graphics_font
+                The FONT and GRAPHICS_FONT of the pack's init.txt.
+            tile_size, graphics_tile_size
+                The [width, height] of a tile in these fonts, or None if the
+                image can't be read.
+            stamp
+                The modification times of the pack folder and its init.txt
+                when the pack was read.
+
+        The number of files in a pack and their size are not kept here, since
+        the stamp does not notice changes deeper in the pack; see
+        get_pack_info.
+
+        Also updates the lookup used by current_pack.
+        """
+        packs = self.cached_scan('graphics_packs', self.scan_graphics)
+        lookup = {}
         for p in packs:
-            font = self.settings.read_value(os.path.join(
-                self.graphics_dir, p, 'data', 'init', 'init.txt'), 'FONT')
-            graphics = self.settings.read_value(
-                os.path.join(self.graphics_dir, p, 'data', 'init', 'init.txt'),
-                'GRAPHICS_FONT')
-            result.append((p, font, graphics))
-        return tuple(result)
+            lookup.setdefault((p['font'], p['graphics_font']), p['name'])
+        self.pack_lookup = lookup
+        return packs
+
+    def scan_graphics(self, reread=()):
+        """
+        Scans the graphics packs. See cached_scan. Packs whose folder and
+        init.txt are unchanged since the last scan are not read again.
+
+        Params:
+            reread
+                Names of packs to read again regardless.
+        """
+        previous = self.scan_cache.get_value('graphics_packs', {})
+        previous = dict((p['name'], p) for p in previous.get('result', []))
+        result = []
+        paths = [self.graphics_dir]
+        for p in sorted(
+                os.path.basename(o) for o in
+                glob.glob(os.path.join(self.graphics_dir, '*')) if
+                os.path.isdir(o) or packarchive.is_archive(o)):
+            path = os.path.join(self.graphics_dir, p)
+            init = os.path.join(path, 'data', 'init', 'init.txt')
+            stamps = self.path_stamps([path, init])
+            stamp = [stamps[path], stamps[init]]
+            info = previous.get(p)
+            if info is None or info['stamp'] != stamp or p in reread:
+                info = self.read_pack_info(path)
+                info['stamp'] = stamp
+            result.append(info)
+            paths.extend([path, init])
+        return result, paths
+
+    @staticmethod
+    def read_pack_info(path):
+        """
+        Reads the description of a graphics pack for read_graphics_index.
+
+        Params:
+            path
+                The folder or archive of the pack.
+        """
+        if packarchive.is_archive(path):
+            return PyLNP.read_archive_info(path)
+        init = os.path.join(path, 'data', 'init', 'init.txt')
+        font = DFConfiguration.read_value(init, 'FONT')
+        graphics = DFConfiguration.read_value(init, 'GRAPHICS_FONT')
+        art = os.path.join(path, 'data', 'art')
+        return {
+            'name': os.path.basename(path), 'font': font,
+            'graphics_font': graphics,
+            'tile_size': PyLNP.read_tile_size(art, font),
+            'graphics_tile_size': PyLNP.read_tile_size(art, graphics)}
+
+    def get_pack_info(self, pack):
+        """
+        Returns the description of a graphics pack from read_graphics_index,
+        with the number of files in the pack and their combined size added
+        as 'files' and 'bytes'. These are read from the pack each time, since
+        any file in it may have changed. Returns None if the pack is missing.
+
+        Params:
+            pack
+                The name of the pack folder or archive.
+        """
+        info = [p for p in self.read_graphics_index() if p['name'] == pack]
+        path = os.path.join(self.graphics_dir, pack)
+        if not info:
+            return None
+        info = dict(info[0])
+        if packarchive.is_archive(path):
+            with packarchive.PackArchive(path) as archive:
+                info['files'] = len(archive.members)
+                info['bytes'] = archive.total_bytes()
+        elif os.path.isdir(path):
+            files = fileops.scan_tree(path)[1]
+            info['files'] = len(files)
+            info['bytes'] = sum(st.st_size for _, st in files)
+        else:
+            return None
+        return info
+
+    @staticmethod
+    def read_archive_info(path):
+        """
+        Reads the description of a graphics pack archive for
+        read_graphics_index, from the list of files in the archive and the
+        few files needed. If the archive can't be read, the fonts and tile
+        sizes are None.
+
+        Params:
+            path
+                The archive of the pack.
+        """
+        info = {
+            'name': os.path.basename(path), 'font': None,
+            'graphics_font': None, 'tile_size': None,
+            'graphics_tile_size': None}
+        try:
+            with packarchive.PackArchive(path) as archive:
+                text = archive.read('data/init/init.txt')
+                if text is not None:
+                    index = TokenIndex(text.decode('utf-8', 'replace'))
+                    info['font'] = index.get('FONT')
+                    info['graphics_font'] = index.get('GRAPHICS_FONT')
+                for key, font in (('tile_size', info['font']), (
+                        'graphics_tile_size', info['graphics_font'])):
+                    if font:
+                        info[key] = PyLNP.tile_size(
+                            archive.read('data/art/' + font, 26))
+        except (IOError, OSError, zipfile.BadZipfile, tarfile.TarError):
+            sys.excepthook(*sys.exc_info())
+        return info
+
+    @staticmethod
+    def read_tile_size(art_dir, font):
+        """
+        Returns the [width, height] of a tile in a font image, reading only
+        the image header. See tile_size.
+
+        Params:
+            art_dir
+                The folder containing the image.
+            font
+                The file name of the image.
+        """
+        if not font:
+            return None
+        try:
+            with open(os.path.join(art_dir, font), 'rb') as f:
+                return PyLNP.tile_size(f.read(26))
+        except IOError:
+            return None
+
+    @staticmethod
+    def tile_size(header):
+        """
+        Returns the [width, height] of a tile in a font image (a grid of 16x16
+        tiles), given the first 26 bytes of the image file. Returns None if
+        the image is missing or not a PNG or BMP file.
+
+        Params:
+            header
+                The start of the image file, or None.
+        """
+        if header is None:
+            return None
+        if header[:8] == b'\x89PNG\r\n\x1a\n' and len(header) >= 24:
+            width, height = struct.unpack(str('>II'), header[16:24])
+        elif header[:2] == b'BM' and len(header) >= 26:
+            width, height = struct.unpack(str('<ii'), header[18:26])
+        else:
+            return None
+        return [width // 16, abs(height) // 16]
 
     def current_pack(self):
         """
         Returns the currently installed graphics pack.
-        If the pack cannot be identified, returns "FONT/GRAPHICS_FONT".
+
+        The pack recorded by the last install is returned if a quick check of
+        the live graphics and font settings shows they are unchanged since.
+        Otherwise, the pack is identified by its fonts, and any differences
+        from the recorded install are written to the output log. If the pack
+        cannot be identified, returns "FONT/GRAPHICS_FONT".
         """
-        packs = self.read_graphics()
-        for p in packs:
-            if (self.settings.FONT == p[1] and
-                    self.settings.GRAPHICS_FONT == p[2]):
-                return p[0]
+        record = self.installed_pack_record()
+        fonts = (self.settings.FONT, self.settings.GRAPHICS_FONT)
+        if record.get('pack') is not None and 'check' in record:
+            drift = self.pack_slots().verify(record)
+            if fonts != (record.get('font'), record.get('graphics_font')):
+                drift.append('FONT/GRAPHICS_FONT')
+            if not drift:
+                return record['pack']
+            if self.reported_drift != (self.df_dir, drift):
+                self.reported_drift = (self.df_dir, drift)
+                print('Graphics pack {0} was installed, but these have '
+                      'changed since: {1}'.format(
+                          record['pack'], ', '.join(drift)))
+        if self.pack_lookup is None:
+            self.read_graphics_index()
+        pack = self.pack_lookup.get(fonts)
+        if pack is not None:
+            return pack
         return str(self.settings.FONT)+'/'+str(self.settings.GRAPHICS_FONT)
 
+    def installed_pack_record(self):
+        """Returns the record of the graphics pack installed in the current
+        DF folder (the description of the live trees in its slots), or an
+        empty dictionary if there is none."""
+        slots = self.pack_slots()
+        return self.instance_asset('pack_record', lambda: (
+            slots.live_info(),
+            [os.path.join(slots.root, packslots.LIVE_FILE)]))
+
+    def record_installed_pack(self):
+        """Adds the install time, fonts and a fingerprint of the live
+        graphics (the trees, their files and the font images) to the record
+        of the installed graphics pack."""
+        slots = self.pack_slots()
+        info = slots.live_info()
+        info['installed'] = time.time()
+        info['font'] = self.settings.FONT
+        info['graphics_font'] = self.settings.GRAPHICS_FONT
+        # The trees, their files as of the swap, and the font images
+        paths = set(packslots.TREES)
+        for tree in packslots.TREES:
+            entries = self.cached_manifest(os.path.join(self.df_dir, tree))
+            paths.update(os.path.join(tree, r) for r in entries or ())
+        paths.update(
+            os.path.join('data', 'art', f)
+            for f in (info['font'], info['graphics_font']) if f)
+        info['check'] = slots.fingerprint(sorted(paths))
+        slots.write_live_info(info)
+        self.assets.pop('pack_record', None)
+
     @staticmethod
     def read_utility_lists(path):
         """
@@ -370,8 +875,13 @@ class PyLNP(object):
             pass
         return result
 
+    @tracing.traced()
     def read_utilities(self):
         """Returns a list of utility programs."""
+        return self.cached_scan('utilities', self.scan_utilities)
+
+    def scan_utilities(self):
+        """Scans the utilities folder. See cached_scan."""
         exclusions = self.read_utility_lists(os.path.join(
             self.utils_dir, 'exclude.txt'))
         # Allow for an include list of filenames that will be treated as valid
@@ -380,6 +890,9 @@ class PyLNP(object):
         inclusions = self.read_utility_lists(os.path.join(
             self.utils_dir, 'include.txt'))
         progs = []
+        paths = [
+            os.path.join(self.utils_dir, 'exclude.txt'),
+            os.path.join(self.utils_dir, 'include.txt')]
         patterns = ['*.jar']  # Java applications
         if sys.platform in ['windows', 'win32']:
             patterns.append('*.exe')  # Windows executables
@@ -387,6 +900,8 @@ class PyLNP(object):
         else:
             patterns.append('*.sh')  # Shell scripts for Linux and OS X
         for root, dirnames, filenames in os.walk(self.utils_dir):
+            paths.append(root)
+            tracing.add_io(0, len(filenames))
             if sys.platform == 'darwin':
                 for dirname in dirnames:
                     if fnmatch.fnmatch(dirname, '*.app'):
@@ -403,18 +918,34 @@ class PyLNP(object):
                         os.path.join(root, filename),
                         os.path.join(self.utils_dir)))
 
-        return progs
+        return progs, paths
 
     def read_embarks(self):
         """Returns a list of embark profiles."""
-        return tuple([
-            os.path.basename(o) for o in self.get_text_files(self.embarks_dir)])
+        return tuple(self.cached_scan('embarks', lambda: ([
+            os.path.basename(o) for o in self.get_text_files(self.embarks_dir)
+            ], [self.embarks_dir])))
 
     def toggle_autoclose(self):
         """Toggle automatic closing of the UI when launching DF."""
         self.userconfig['autoClose'] = not self.userconfig.get_bool('autoClose')
         self.userconfig.save_data()
 
+    def toggle_link_art(self):
+        """Toggle hard linking of graphics pack art instead of copying. While
+        enabled, the art of packs, the DF folder and pack slots may share
+        files, so none of them may be edited in place."""
+        self.userconfig['linkArt'] = not self.userconfig.get_bool('linkArt')
+        self.userconfig.save_data()
+
+    def toggle_dedup_raws(self):
+        """Toggle sharing of identical raw files of savegames and the DF
+        folder through the raw store. While enabled, these raws may be links
+        to the same file, so none of them may be edited in place."""
+        self.userconfig['dedupRaws'] = not self.userconfig.get_bool(
+            'dedupRaws')
+        self.userconfig.save_data()
+
     def toggle_autorun(self, item):
         """
         Toggles autorun for the specified item.
@@ -451,7 +982,7 @@ class PyLNP(object):
         :param field: The field to cycle.
         """
         self.settings.cycle_item(field)
-        self.save_params()
+        self.params_writer.schedule()
 
     def set_option(self, field, value):
         """
@@ -464,7 +995,7 @@ class PyLNP(object):
                 The new value for the field.
         """
         self.settings.set_value(field, value)
-        self.save_params()
+        self.params_writer.schedule()
 
     def load_keybinds(self, filename):
         """
@@ -517,9 +1048,11 @@ class PyLNP(object):
             filename = filename + '.txt'
         os.remove(os.path.join(self.keybinds_dir, filename))
 
+    @tracing.traced()
     def install_graphics(self, pack):
         """
-        Installs the graphics pack located in LNP/Graphics/<pack>.
+        Installs the graphics pack located in LNP/Graphics/<pack>, which may
+        be a folder or an archive (see packarchive).
 
         Params:
             pack
@@ -531,208 +1064,662 @@ class PyLNP(object):
             None if required files are missing (raw/graphics, data/init)
         """
         gfx_dir = os.path.join(self.graphics_dir, pack)
-        if (os.path.isdir(gfx_dir) and
-                os.path.isdir(os.path.join(gfx_dir, 'raw', 'graphics')) and
-                os.path.isdir(os.path.join(gfx_dir, 'data', 'init'))):
+        archive = None
+        try:
+            if packarchive.is_archive(gfx_dir):
+                archive = packarchive.PackArchive(gfx_dir)
+        except Exception:
+            sys.excepthook(*sys.exc_info())
+            return False
+        try:
+            if archive is not None:
+                complete = (
+                    archive.exists('raw/graphics') and
+                    archive.exists('data/init'))
+            else:
+                complete = (
+                    os.path.isdir(gfx_dir) and
+                    os.path.isdir(os.path.join(gfx_dir, 'raw', 'graphics')) and
+                    os.path.isdir(os.path.join(gfx_dir, 'data', 'init')))
+            if not complete:
+                return None
             try:
-                # Delete old graphics
-                if os.path.isdir(os.path.join(self.df_dir, 'raw', 'graphics')):
-                    dir_util.remove_tree(
-                        os.path.join(self.df_dir, 'raw', 'graphics'))
-                # Copy new raws
-                dir_util.copy_tree(
-                    os.path.join(gfx_dir, 'raw'),
-                    os.path.join(self.df_dir, 'raw'))
-                if os.path.isdir(os.path.join(self.df_dir, 'data', 'art')):
-                    dir_util.remove_tree(
-                        os.path.join(self.df_dir, 'data', 'art'))
-                dir_util.copy_tree(
-                    os.path.join(gfx_dir, 'data', 'art'),
-                    os.path.join(self.df_dir, 'data', 'art'))
-                self.patch_inits(gfx_dir)
-                shutil.copyfile(
-                    os.path.join(gfx_dir, 'data', 'init', 'colors.txt'),
-                    os.path.join(self.df_dir, 'data', 'init', 'colors.txt'))
-                try: # TwbT support
-                    os.remove(os.path.join(
-                        self.df_dir, 'data', 'init', 'overrides.txt'))
-                except:
-                    pass
-                try: # TwbT support
-                    shutil.copyfile(
-                        os.path.join(gfx_dir, 'data', 'init', 'overrides.txt'),
-                        os.path.join(
-                            self.df_dir, 'data', 'init', 'overrides.txt'))
-                except:
-                    pass
+                self.switch_graphics(pack, gfx_dir, archive)
             except Exception:
                 sys.excepthook(*sys.exc_info())
                 return False
-            else:
-                return True
+            if self.userconfig.get_bool('dedupRaws'):
+                # Only the DF folder; graphics packs are left alone, since
+                # they may be edited in place. The pack is installed either way
+                try:
+                    self.dedup_raws(os.path.join(self.df_dir, 'raw'))
+                except Exception:
+                    sys.excepthook(*sys.exc_info())
+            return True
+        finally:
+            if archive is not None:
+                archive.close()
+
+    def pack_slots(self):
+        """Returns the packslots.PackSlots of the current DF folder, with the
+        limits set in PyLNP.user."""
+        return packslots.PackSlots(
+            self.df_dir, self.userconfig.get_value('packSlots', 3),
+            self.userconfig.get_value('packSlotsBudget', 512) * 1048576)
+
+    def switch_graphics(self, pack, gfx_dir, archive=None):
+        """
+        Makes a graphics pack live. Its trees are prepared in a slot, unless
+        a slot already holds them, and swapped with the live trees. The live
+        trees and backups of the other files changed are kept in the
+        rollback slot. If installing the pack fails after the swap, it is
+        undone; failures cleaning up afterwards are only logged.
+
+        Params:
+            pack
+                The name of the pack.
+            gfx_dir
+                The folder of the pack.
+            archive
+                A packarchive.PackArchive if the pack is an archive.
+        """
+        slots = self.pack_slots()
+        if archive is not None:
+            stamp = archive.stamp()
+        else:
+            sources = [
+                self.load_manifest(os.path.join(gfx_dir, t))
+                for t in packslots.TREES]
+            stamp = '/'.join(m.digest() for m in sources)
+        incoming = slots.find(pack, stamp)
+        if incoming is None:
+            incoming = slots.new_slot()
+            try:
+                if archive is not None:
+                    report, manifests = self.stage_archive(incoming, archive)
+                else:
+                    report, manifests = self.stage_pack(incoming, sources)
+            except:
+                slots.remove(incoming)
+                raise
+            slots.write_info(incoming, {
+                'pack': pack, 'stamp': stamp, 'manifests': manifests,
+                'bytes': packslots.manifest_bytes(manifests)})
+            print('Installed graphics pack {0}: {1}'.format(pack, report))
         else:
+            print('Installed graphics pack {0} from a prepared slot'.format(
+                pack))
+        self.apply_pack(gfx_dir, incoming, archive)
+        # The pack is live now
+        try:
+            slots.evict()
+        except Exception:
+            sys.excepthook(*sys.exc_info())
+        try:
+            self.record_installed_pack()
+        except Exception:
+            sys.excepthook(*sys.exc_info())
+
+    def apply_pack(self, gfx_dir, incoming, archive=None):
+        """
+        Swaps in the prepared trees of a graphics pack and installs its other
+        raws and init files. See switch_graphics.
+
+        Params:
+            gfx_dir
+                The folder of the pack.
+            incoming
+                The slot holding the prepared trees.
+            archive
+                A packarchive.PackArchive if the pack is an archive. The other
+                raws and init files are then read straight from it.
+        """
+        # Option changes still waiting to be written belong in the backup
+        self.save_params()
+        slots = self.pack_slots()
+        outgoing = slots.new_slot()
+        init_dir = os.path.join('data', 'init')
+        added = []
+        swapped = False
+        try:
+            for name in PACK_INIT_FILES:
+                path = os.path.join(self.df_dir, init_dir, name)
+                if os.path.isfile(path):
+                    backup = os.path.join(
+                        outgoing, packslots.BACKUP_DIR, init_dir, name)
+                    if not os.path.isdir(os.path.dirname(backup)):
+                        os.makedirs(os.path.dirname(backup))
+                    fileops.copy_file(path, backup)
+                else:
+                    added.append(os.path.join(init_dir, name))
+            self.swap_slot(incoming, outgoing, False)
+            swapped = True
+        finally:
+            if not swapped:
+                slots.remove(outgoing)
+        try:
+            info = slots.read_info(outgoing)
+            info['added'] = added
+            slots.write_info(outgoing, info)
+            # Merge the other raws, keeping replaced files for rollback; files
+            # added are recorded even if this fails part way
+            report = manifest.SyncReport()
+            try:
+                if archive is not None:
+                    archive.sync(
+                        self.df_dir, lambda r: r.startswith('raw/') and
+                        not r.startswith('raw/graphics/'),
+                        os.path.join(outgoing, packslots.BACKUP_DIR), report)
+                    added.extend(report.added)
+                else:
+                    self.sync_tree(
+                        os.path.join(gfx_dir, 'raw'),
+                        os.path.join(self.df_dir, 'raw'), False,
+                        exclude=('graphics',), backup=os.path.join(
+                            outgoing, packslots.BACKUP_DIR, 'raw'),
+                        report=report)
+                    added.extend(os.path.join('raw', r) for r in report.added)
+            finally:
+                slots.write_info(outgoing, info)
+            # Apply the raw options to the new raws; written by patch_inits
+            self.settings.raws_replaced()
+            inits = None
+            if archive is not None:
+                # In one pass, since a compressed tar can't be read backwards
+                inits = archive.read_files(lambda r: r in [
+                    'data/init/' + n for n in PACK_INIT_FILES])
+            self.patch_inits(gfx_dir, inits)
+            colors = os.path.join(self.df_dir, 'data', 'init', 'colors.txt')
+            if archive is not None:
+                data = inits.get('data/init/colors.txt')
+                if data is None:
+                    raise IOError('No such file in the pack: colors.txt')
+                atomic_write(colors, data, 'wb')
+            else:
+                shutil.copyfile(os.path.join(
+                    gfx_dir, 'data', 'init', 'colors.txt'), colors)
+            overrides = os.path.join(
+                self.df_dir, 'data', 'init', 'overrides.txt')
+            try: # TwbT support
+                os.remove(overrides)
+            except:
+                pass
+            try: # TwbT support
+                if archive is not None:
+                    data = inits.get('data/init/overrides.txt')
+                    if data is not None:
+                        atomic_write(overrides, data, 'wb')
+                else:
+                    shutil.copyfile(os.path.join(
+                        gfx_dir, 'data', 'init', 'overrides.txt'), overrides)
+            except:
+                pass
+        except:
+            self.swap_slot(outgoing)
+            raise
+
+    def stage_archive(self, slot, archive):
+        """
+        Prepares the trees of a graphics pack archive in a slot, writing them
+        straight from the archive. Trees missing from the archive are copied
+        from the live trees, as for folders.
+
+        Params:
+            slot
+                The slot to prepare.
+            archive
+                The packarchive.PackArchive of the pack.
+
+        Returns:
+            A tuple (manifest.SyncReport, dictionary mapping trees to
+            manifest entries of the prepared trees).
+        """
+        prefixes = tuple(
+            t.replace(os.sep, '/') + '/' for t in packslots.TREES)
+        written = archive.extract(slot, lambda r: r.startswith(prefixes))
+        report = manifest.SyncReport()
+        report.copied = len(written)
+        report.copied_bytes = sum(archive.members[r][0] for r in written)
+        report.added = written
+        manifests = {}
+        for tree, prefix in zip(packslots.TREES, prefixes):
+            live = os.path.join(self.df_dir, tree)
+            target = os.path.join(slot, tree)
+            if not archive.exists(prefix) and os.path.isdir(live):
+                fileops.copy_tree(live, target, link=self.link_tree(tree))
+            manifests[tree] = manifest.Manifest.scan(target).entries
+        return report, manifests
+
+    def stage_pack(self, slot, sources):
+        """
+        Prepares the trees of a graphics pack in a slot. Where the file
+        system can copy the live trees with reflinks, which writes no data,
+        the slot starts out as such a copy and only files that differ are
+        copied from the pack; otherwise it is built from the files of the
+        pack alone. Trees missing from the pack are copied from the live
+        trees. Art is hard linked instead if enabled, see link_tree.
+
+        Params:
+            slot
+                The slot to prepare.
+            sources
+                A manifest.Manifest of the pack folder of each tree in
+                packslots.TREES.
+
+        Returns:
+            A tuple (manifest.SyncReport, dictionary mapping trees to
+            manifest entries of the prepared trees).
+        """
+        report = manifest.SyncReport()
+        manifests = {}
+        for tree, src in zip(packslots.TREES, sources):
+            live = os.path.join(self.df_dir, tree)
+            target = os.path.join(slot, tree)
+            if os.path.isdir(src.root):
+                previous = None
+                if os.path.isdir(live) and fileops.can_reflink(live, slot):
+                    fileops.copy_tree(live, target)
+                    # Same paths and times as the live tree, so its hashes
+                    # apply
+                    previous = self.cached_manifest(live)
+                r, _, dst = manifest.sync_tree(
+                    src.root, target, True, src.entries, previous,
+                    self.link_tree(tree))
+                report.add(r)
+            else:
+                if os.path.isdir(live):
+                    fileops.copy_tree(live, target, link=self.link_tree(tree))
+                dst = manifest.Manifest.scan(target)
+            manifests[tree] = dst.entries
+        self.save_manifests(*sources)
+        return report, manifests
+
+    def link_tree(self, tree):
+        """
+        Returns True if files of <tree> are hard linked when staging a pack,
+        rather than copied. This is only done for art, and only if enabled in
+        PyLNP.user (see toggle_link_art), since a file edited in place would
+        also change in the rollback slot and the other slots.
+
+        Params:
+            tree
+                One of packslots.TREES.
+        """
+        return (
+            tree == packslots.TREES[1] and self.userconfig.get_bool('linkArt'))
+
+    def swap_slot(self, incoming, outgoing=None, restore=True):
+        """
+        Swaps the trees of a slot with the live trees. The live trees are
+        moved to a slot, which becomes the rollback slot.
+
+        Params:
+            incoming
+                The slot to make live. It is removed afterwards.
+            outgoing
+                An empty slot to move the live trees to, or None to create
+                one.
+            restore
+                If True, files backed up in <incoming> are restored, i.e. it
+                is the rollback slot and the last install is undone.
+        """
+        slots = self.pack_slots()
+        created = outgoing is None
+        if created:
+            outgoing = slots.new_slot()
+        swapped = False
+        try:
+            live = slots.live_info()
+            live['manifests'] = dict(
+                (t, self.cached_manifest(os.path.join(self.df_dir, t)) or {})
+                for t in packslots.TREES)
+            live['bytes'] = packslots.manifest_bytes(live['manifests'])
+            live['used'] = time.time()
+            live['rollback'] = False
+            live['added'] = []
+            slots.write_info(outgoing, live)
+            info = slots.read_info(incoming)
+            slots.swap(incoming, outgoing)
+            swapped = True
+        finally:
+            if created and not swapped:
+                slots.remove(outgoing)
+        if restore:
+            live['added'] = slots.restore(incoming, outgoing)
+            slots.write_info(outgoing, live)
+        slots.remove(incoming)
+        slots.set_rollback(outgoing)
+        slots.write_live_info({
+            'pack': info.get('pack'), 'stamp': info.get('stamp')})
+        self.assets.pop('pack_record', None)
+        self.save_manifests(*[
+            manifest.Manifest(os.path.join(self.df_dir, t), m)
+            for t, m in info.get('manifests', {}).items()])
+
+    def undo_graphics_install(self):
+        """
+        Undoes the last graphics pack install (or undo) by swapping back the
+        rollback slot.
+
+        Returns:
+            True if successful,
+            False if an exception occured
+            None if there is nothing to undo
+        """
+        slot = self.pack_slots().rollback_slot()
+        if slot is None:
             return None
+        # Write pending changes now, so they don't end up in restored files
+        self.save_params()
+        try:
+            self.swap_slot(slot)
+        except Exception:
+            sys.excepthook(*sys.exc_info())
+            return False
         self.load_params()
+        self.record_installed_pack()
+        return True
+
+    def sync_tree(self, source, target, delete=True, link=False, **kwargs):
+        """
+        Updates <target> to match <source>, copying only changed files.
+        Manifests of both directories are kept in PyLNP.manifests, so file
+        hashes computed to compare them are reused next time.
+
+        Params:
+            source
+                The directory to copy from.
+            target
+                The directory to update.
+            delete
+                Which files to remove from <target> if they are not in
+                <source>. See manifest.sync_tree.
+            link
+                If True, hard link files instead of copying them where
+                possible. See fileops.copy_file.
+            kwargs
+                Other arguments for manifest.sync_tree.
+
+        Returns:
+            A manifest.SyncReport describing the work done.
+        """
+        report, src, dst = manifest.sync_tree(
+            source, target, delete, self.cached_manifest(source),
+            self.cached_manifest(target), link, **kwargs)
+        self.save_manifests(src, dst)
+        return report
+
+    def cached_manifest(self, path):
+        """
+        Returns the manifest entries of <path> cached in PyLNP.manifests, or
+        None if there are none.
+
+        Params:
+            path
+                The directory.
+        """
+        # Not get_value, which would split the path at each /
+        return self.manifest_cache.data.get(os.path.abspath(path))
+
+    def load_manifest(self, path):
+        """
+        Returns a manifest.Manifest of <path>, reusing file hashes cached in
+        PyLNP.manifests.
+
+        Params:
+            path
+                The directory to scan.
+        """
+        return manifest.Manifest.scan(path, self.cached_manifest(path))
+
+    def save_manifests(self, *manifests):
+        """
+        Caches manifests in PyLNP.manifests. Each manifest is stored as is,
+        without comparing it to the cached one.
+
+        Params:
+            manifests
+                The manifest.Manifest objects to cache.
+        """
+        for m in manifests:
+            self.manifest_cache.replace_value(
+                os.path.abspath(m.root), m.entries)
+        self.manifest_cache.save_data()
+
+    def dedup_raws(self, *paths):
+        """
+        Replaces the files in raw folders with links to the raw store, so
+        identical files share disk space, and removes stored files that are no
+        longer used. Only use this for folders whose files are changed by
+        replacing them (see BlobStore).
 
-    def patch_inits(self, gfx_dir):
-        """
-        Installs init files from a graphics pack by selectively changing
-        specific fields. All settings outside of the mentioned fields are
-        preserved.
-
-        TODO: Consider if there's a better option than listing all fields
-        explicitly...
-        """
-        d_init_fields = [
-            'WOUND_COLOR_NONE', 'WOUND_COLOR_MINOR',
-            'WOUND_COLOR_INHIBITED', 'WOUND_COLOR_FUNCTION_LOSS',
-            'WOUND_COLOR_BROKEN', 'WOUND_COLOR_MISSING', 'SKY', 'CHASM',
-            'PILLAR_TILE',
-            # Tracks
-            'TRACK_N', 'TRACK_S', 'TRACK_E', 'TRACK_W', 'TRACK_NS',
-            'TRACK_NE', 'TRACK_NW', 'TRACK_SE', 'TRACK_SW', 'TRACK_EW',
-            'TRACK_NSE', 'TRACK_NSW', 'TRACK_NEW', 'TRACK_SEW',
-            'TRACK_NSEW', 'TRACK_RAMP_N', 'TRACK_RAMP_S', 'TRACK_RAMP_E',
-            'TRACK_RAMP_W', 'TRACK_RAMP_NS', 'TRACK_RAMP_NE',
-            'TRACK_RAMP_NW', 'TRACK_RAMP_SE', 'TRACK_RAMP_SW',
-            'TRACK_RAMP_EW', 'TRACK_RAMP_NSE', 'TRACK_RAMP_NSW',
-            'TRACK_RAMP_NEW', 'TRACK_RAMP_SEW', 'TRACK_RAMP_NSEW',
-            # Trees
-            'TREE_ROOT_SLOPING', 'TREE_TRUNK_SLOPING',
-            'TREE_ROOT_SLOPING_DEAD', 'TREE_TRUNK_SLOPING_DEAD',
-            'TREE_ROOTS', 'TREE_ROOTS_DEAD', 'TREE_BRANCHES',
-            'TREE_BRANCHES_DEAD', 'TREE_SMOOTH_BRANCHES',
-            'TREE_SMOOTH_BRANCHES_DEAD', 'TREE_TRUNK_PILLAR',
-            'TREE_TRUNK_PILLAR_DEAD', 'TREE_CAP_PILLAR',
-            'TREE_CAP_PILLAR_DEAD', 'TREE_TRUNK_N', 'TREE_TRUNK_S',
-            'TREE_TRUNK_N_DEAD', 'TREE_TRUNK_S_DEAD', 'TREE_TRUNK_EW',
-            'TREE_TRUNK_EW_DEAD', 'TREE_CAP_WALL_N', 'TREE_CAP_WALL_S',
-            'TREE_CAP_WALL_N_DEAD', 'TREE_CAP_WALL_S_DEAD', 'TREE_TRUNK_E',
-            'TREE_TRUNK_W', 'TREE_TRUNK_E_DEAD', 'TREE_TRUNK_W_DEAD',
-            'TREE_TRUNK_NS', 'TREE_TRUNK_NS_DEAD', 'TREE_CAP_WALL_E',
-            'TREE_CAP_WALL_W', 'TREE_CAP_WALL_E_DEAD',
-            'TREE_CAP_WALL_W_DEAD', 'TREE_TRUNK_NW', 'TREE_CAP_WALL_NW',
-            'TREE_TRUNK_NW_DEAD', 'TREE_CAP_WALL_NW_DEAD', 'TREE_TRUNK_NE',
-            'TREE_CAP_WALL_NE', 'TREE_TRUNK_NE_DEAD',
-            'TREE_CAP_WALL_NE_DEAD', 'TREE_TRUNK_SW', 'TREE_CAP_WALL_SW',
-            'TREE_TRUNK_SW_DEAD', 'TREE_CAP_WALL_SW_DEAD', 'TREE_TRUNK_SE',
-            'TREE_CAP_WALL_SE', 'TREE_TRUNK_SE_DEAD',
-            'TREE_CAP_WALL_SE_DEAD', 'TREE_TRUNK_NSE',
-            'TREE_TRUNK_NSE_DEAD', 'TREE_TRUNK_NSW', 'TREE_TRUNK_NSW_DEAD',
-            'TREE_TRUNK_NEW', 'TREE_TRUNK_NEW_DEAD', 'TREE_TRUNK_SEW',
-            'TREE_TRUNK_SEW_DEAD', 'TREE_TRUNK_NSEW',
-            'TREE_TRUNK_NSEW_DEAD', 'TREE_TRUNK_BRANCH_N',
-            'TREE_TRUNK_BRANCH_N_DEAD', 'TREE_TRUNK_BRANCH_S',
-            'TREE_TRUNK_BRANCH_S_DEAD', 'TREE_TRUNK_BRANCH_E',
-            'TREE_TRUNK_BRANCH_E_DEAD', 'TREE_TRUNK_BRANCH_W',
-            'TREE_TRUNK_BRANCH_W_DEAD', 'TREE_BRANCH_NS',
-            'TREE_BRANCH_NS_DEAD', 'TREE_BRANCH_EW', 'TREE_BRANCH_EW_DEAD',
-            'TREE_BRANCH_NW', 'TREE_BRANCH_NW_DEAD', 'TREE_BRANCH_NE',
-            'TREE_BRANCH_NE_DEAD', 'TREE_BRANCH_SW', 'TREE_BRANCH_SW_DEAD',
-            'TREE_BRANCH_SE', 'TREE_BRANCH_SE_DEAD', 'TREE_BRANCH_NSE',
-            'TREE_BRANCH_NSE_DEAD', 'TREE_BRANCH_NSW',
-            'TREE_BRANCH_NSW_DEAD', 'TREE_BRANCH_NEW',
-            'TREE_BRANCH_NEW_DEAD', 'TREE_BRANCH_SEW',
-            'TREE_BRANCH_SEW_DEAD', 'TREE_BRANCH_NSEW',
-            'TREE_BRANCH_NSEW_DEAD', 'TREE_TWIGS', 'TREE_TWIGS_DEAD',
-            'TREE_CAP_RAMP', 'TREE_CAP_RAMP_DEAD', 'TREE_CAP_FLOOR1',
-            'TREE_CAP_FLOOR2', 'TREE_CAP_FLOOR1_DEAD',
-            'TREE_CAP_FLOOR2_DEAD', 'TREE_CAP_FLOOR3', 'TREE_CAP_FLOOR4',
-            'TREE_CAP_FLOOR3_DEAD', 'TREE_CAP_FLOOR4_DEAD',
-            'TREE_TRUNK_INTERIOR', 'TREE_TRUNK_INTERIOR_DEAD']
-        init_fields = [
-            'FONT', 'FULLFONT', 'GRAPHICS', 'GRAPHICS_FONT',
-            'GRAPHICS_FULLFONT', 'TRUETYPE']
-        self.settings.read_file(
-            os.path.join(gfx_dir, 'data', 'init', 'init.txt'), init_fields,
-            False)
-        self.settings.read_file(
-            os.path.join(gfx_dir, 'data', 'init', 'd_init.txt'), d_init_fields,
-            False)
+        Params:
+            paths
+                The raw folders to deduplicate.
+        """
+        trees = [self.load_manifest(p) for p in paths]
+        for tree in trees:
+            self.raw_store.absorb(tree)
+        self.save_manifests(*trees)
+        self.collect_raw_garbage()
+
+    def collect_raw_garbage(self):
+        """Removes files from the raw store that are no longer used, and
+        writes a report of the space saved to the output log."""
+        removed, freed = self.raw_store.collect_garbage()
+        print('Raw store: {0}; {1} unused file(s) ({2} bytes) removed'.format(
+            self.raw_store.report(), removed, freed))
+
+    def patch_inits(self, gfx_dir, files=None):
+        """
+        Installs init files from a graphics pack by selectively changing the
+        fields listed in settings.GRAPHICS_FIELDS. All settings outside of
+        these fields are preserved.
+
+        Params:
+            gfx_dir
+                The folder of the graphics pack.
+            files
+                Dictionary mapping paths in the pack (with / as separator) to
+                the contents of its init files, to read them from instead if
+                the pack is an archive (see packarchive.PackArchive.read_files).
+        """
+        # Pending changes must not overwrite the patched files later
         self.save_params()
+        def read(relative):
+            """Returns the text of an init file of the archive."""
+            data = files.get(relative.replace(os.sep, '/'))
+            if data is not None:
+                return data.decode('utf-8', 'replace')
+        changes = patch_fields(
+            gfx_dir, self.df_dir, read=read if files is not None else None)
+        for relative, fields in changes.items():
+            self.settings.update_fields(
+                os.path.join(self.df_dir, relative),
+                [(f, new) for f, _, new in fields])
+        print('Patched init files: ' + ', '.join(
+            '{0} field(s) in {1}'.format(len(f), os.path.basename(r))
+            for r, f in changes.items()))
+
+    def get_savegames(self):
+        """Returns a sorted list of the names of the save games in the
+        current DF instance."""
+        def scan():
+            """Lists the save folders. See instance_asset."""
+            return sorted(
+                os.path.basename(o) for o in
+                glob.glob(os.path.join(self.save_dir, '*'))
+                if os.path.isdir(o) and not o.endswith('current')), [
+                    self.save_dir]
+        return self.instance_asset('savegames', scan)
+
+    @tracing.traced()
+    def update_savegames(self, progress=None, cancel=None):
+        """
+        Update save games with current raws. Several saves are updated at the
+        same time.
 
-    def update_savegames(self):
-        """Update save games with current raws."""
-        saves = [
-            o for o in glob.glob(os.path.join(self.save_dir, '*'))
-            if os.path.isdir(o) and not o.endswith('current')]
-        count = 0
-        if saves:
-            for save in saves:
-                count = count + 1
+        Params:
+            progress
+                Function called with (saves finished, total saves, save name,
+                result) each time a save is finished, or None. Called from
+                the calling thread.
+            cancel
+                A threading.Event; once it is set, saves that have not been
+                started are skipped. Saves being updated are finished.
+
+        Returns:
+            A list of (save name, result) tuples, where result is True if the
+            save was updated, False if an error occurred (written to the
+            output log), or None if it was skipped due to cancellation.
+        """
+        saves = [os.path.join(self.save_dir, s) for s in self.get_savegames()]
+        if not saves:
+            return []
+        raw = None
+        if self.userconfig.get_bool('dedupRaws'):
+            # Share the files in the store; saves become trees of links.
+            # This hashes every file, so the workers only read the manifest
+            raw = self.load_manifest(os.path.join(self.df_dir, 'raw'))
+            self.raw_store.absorb(raw)
+            self.save_manifests(raw)
+
+        def update(index):
+            """Updates a single save. Runs in a thread, and only changes the
+            save folder; the result is handled by the calling thread."""
+            save = saves[index]
+            if cancel is not None and cancel.is_set():
+                return index, None, None
+            try:
                 # Delete old graphics
                 if os.path.isdir(os.path.join(save, 'raw', 'graphics')):
-                    dir_util.remove_tree(os.path.join(save, 'raw', 'graphics'))
+                    fileops.remove_tree(os.path.join(save, 'raw', 'graphics'))
                 # Copy new raws
-                dir_util.copy_tree(
-                    os.path.join(self.df_dir, 'raw'),
-                    os.path.join(save, 'raw'))
-        return count
+                if raw is not None:
+                    self.raw_store.link_tree(raw, os.path.join(save, 'raw'))
+                else:
+                    fileops.copy_tree(
+                        os.path.join(self.df_dir, 'raw'),
+                        os.path.join(save, 'raw'))
+                return index, True, None
+            except Exception:
+                return index, False, sys.exc_info()
+
+        results = [None] * len(saves)
+        finished = 0
+        pool = ThreadPool(min(SAVEGAME_WORKERS, len(saves)))
+        try:
+            for index, result, error in pool.imap_unordered(
+                    update, range(len(saves))):
+                if error is not None:
+                    sys.excepthook(*error)
+                name = os.path.basename(saves[index])
+                results[index] = (name, result)
+                finished += 1
+                if progress is not None:
+                    progress(finished, len(saves), name, result)
+        finally:
+            # Saves still being updated if this failed are finished first
+            pool.close()
+            pool.join()
+        if raw is not None:
+            self.collect_raw_garbage()
+        return results
+
+    def simplify_graphics(self, dry_run=False):
+        """
+        Removes unnecessary files from all graphics packs. Several packs are
+        processed at the same time.
+
+        Params:
+            dry_run
+                If True, nothing is removed; the results tell what would be.
+
+        Returns:
+            A list of (pack name, result) tuples, where result is as
+            returned by simplify_pack.
+        """
+        packs = [p[0] for p in self.read_graphics()]
+        if not packs:
+            return []
+        pool = ThreadPool(min(SIMPLIFY_WORKERS, len(packs)))
+        try:
+            results = pool.map(
+                lambda p: (p, self.simplify_pack(p, dry_run)), packs)
+        finally:
+            pool.close()
+        if not dry_run:
+            # Removing files deep in a pack doesn't change its folder's
+            # modification time, so read the packs again
+            self.update_scan('graphics_packs', lambda: self.scan_graphics(
+                [p for p, r in results if r is not None]))
+        return results
 
-    def simplify_graphics(self):
-        """Removes unnecessary files from all graphics packs."""
-        for pack in self.read_graphics():
-            self.simplify_pack(pack)
+    @staticmethod
+    def simplify_keep(relative):
+        """
+        Returns True if a file is needed in a simplified graphics pack.
 
-    def simplify_pack(self, pack):
+        Params:
+            relative
+                The path of the file, relative to the pack folder.
         """
-        Removes unnecessary files from LNP/Graphics/<pack>.
+        parts = relative.replace(os.sep, '/').split('/')
+        if parts[:2] in (['data', 'art'], ['raw', 'graphics'],
+                         ['raw', 'objects']):
+            return len(parts) > 2
+        return parts[:2] == ['data', 'init'] and len(parts) == 3 and (
+            parts[2] in PACK_INIT_FILES)
+
+    @tracing.traced()
+    def simplify_pack(self, pack, dry_run=False):
+        """
+        Removes unnecessary files from LNP/Graphics/<pack>, in place. Folders
+        left empty are removed too.
 
         Params:
             pack
                 The pack to simplify.
+            dry_run
+                If True, nothing is removed; the result tells what would be.
 
         Returns:
-          The number of files removed if successful
+          A tuple (files, bytes) removed if successful
           False if an exception occurred
           None if folder is empty
         """
         pack = os.path.join(self.graphics_dir, pack)
-        files_before = sum(len(f) for (_, _, f) in os.walk(pack))
-        if files_before == 0:
+        if not os.path.isdir(pack):
+            return None
+        directories, files = fileops.scan_tree(pack, False)
+        if not files:
             return None
-        tmp = tempfile.mkdtemp()
+        remove = [(r, st) for r, st in files if not self.simplify_keep(r)]
+        result = (len(remove), sum(st.st_size for _, st in remove))
+        if dry_run:
+            return result
+        kept = set([
+            '', 'data', 'raw', os.path.join('data', 'art'),
+            os.path.join('data', 'init'), os.path.join('raw', 'graphics'),
+            os.path.join('raw', 'objects')])
+        for relative, _ in files:
+            if self.simplify_keep(relative):
+                while relative:
+                    relative = os.path.dirname(relative)
+                    kept.add(relative)
         try:
-            dir_util.copy_tree(pack, tmp)
-            if os.path.isdir(pack):
-                dir_util.remove_tree(pack)
-
-            os.makedirs(pack)
-            os.makedirs(os.path.join(pack, 'data', 'art'))
-            os.makedirs(os.path.join(pack, 'raw', 'graphics'))
-            os.makedirs(os.path.join(pack, 'raw', 'objects'))
-            os.makedirs(os.path.join(pack, 'data', 'init'))
-
-            dir_util.copy_tree(
-                os.path.join(tmp, 'data', 'art'),
-                os.path.join(pack, 'data', 'art'))
-            dir_util.copy_tree(
-                os.path.join(tmp, 'raw', 'graphics'),
-                os.path.join(pack, 'raw', 'graphics'))
-            dir_util.copy_tree(
-                os.path.join(tmp, 'raw', 'objects'),
-                os.path.join(pack, 'raw', 'objects'))
-            shutil.copyfile(
-                os.path.join(tmp, 'data', 'init', 'colors.txt'),
-                os.path.join(pack, 'data', 'init', 'colors.txt'))
-            shutil.copyfile(
-                os.path.join(tmp, 'data', 'init', 'init.txt'),
-                os.path.join(pack, 'data', 'init', 'init.txt'))
-            shutil.copyfile(
-                os.path.join(tmp, 'data', 'init', 'd_init.txt'),
-                os.path.join(pack, 'data', 'init', 'd_init.txt'))
-            shutil.copyfile(
-                os.path.join(tmp, 'data', 'init', 'overrides.txt'),
-                os.path.join(pack, 'data', 'init', 'overrides.txt'))
-        except IOError:
+            for relative, _ in remove:
+                os.remove(os.path.join(pack, relative))
+            tracing.add_io(0, len(remove))
+            # Deepest first, so parents are empty once their children are gone
+            for relative in sorted(directories, reverse=True):
+                path = os.path.join(pack, relative)
+                if relative not in kept and not os.listdir(path):
+                    os.rmdir(path)
+        except (IOError, OSError):
             sys.excepthook(*sys.exc_info())
-            retval = False
-        else:
-            files_after = sum(len(f) for (_, _, f) in os.walk(pack))
-            retval = files_after - files_before
-        if os.path.isdir(tmp):
-            dir_util.remove_tree(tmp)
-        return retval
+            return False
+        return result
 
     def install_extras(self):
         """
@@ -744,7 +1731,7 @@ class PyLNP(object):
             return
         install_file = os.path.join(self.df_dir, 'PyLNP{0}.txt'.format(VERSION))
         if not os.access(install_file, os.F_OK):
-            dir_util.copy_tree(extras_dir, self.df_dir)
+            fileops.copy_tree(extras_dir, self.df_dir)
             textfile = open(install_file, 'w')
             textfile.write(
                 'PyLNP V{0} extras installed!\nTime: {1}'.format(
@@ -799,9 +1786,9 @@ class PyLNP(object):
 
     def read_colors(self):
         """Returns a list of color schemes."""
-        return tuple([
+        return tuple(self.cached_scan('colors', lambda: ([
             os.path.splitext(os.path.basename(p))[0] for p in
-            self.get_text_files(self.colors_dir)])
+            self.get_text_files(self.colors_dir)], [self.colors_dir])))
 
     def get_colors(self, colorscheme=None):
         """
@@ -875,20 +1862,24 @@ class PyLNP(object):
         os.remove(os.path.join(self.colors_dir, filename))
 
     def read_hacks(self):
-        """Reads which hacks are enabled."""
+        """Reads which hacks are enabled in the current DF instance."""
         try:
             f = open(os.path.join(self.df_dir, 'PyLNP_dfhack_onload.init'))
             hacklines = f.readlines()
-            for h in self.get_hacks().values():
-                h['enabled'] = h['command']+'\n' in hacklines
+            self.enabled_hacks = set(
+                t for t, h in self.config.get_dict('dfhack').items()
+                if h['command']+'\n' in hacklines)
             f.close()
         except IOError:
-            for h in self.get_hacks().values():
-                h['enabled'] = False
+            self.enabled_hacks = set()
 
     def get_hacks(self):
-        """Returns dict of available hacks."""
-        return self.config.get_dict('dfhack')
+        """Returns dict of available hacks. Each hack is a copy of its
+        configuration, with 'enabled' set for the current DF instance."""
+        hacks = self.config.get_dict('dfhack')
+        return type(hacks)(
+            (t, dict(h, enabled=t in self.enabled_hacks))
+            for t, h in hacks.items())
 
     def get_hack(self, title):
         """
@@ -911,7 +1902,7 @@ class PyLNP(object):
             name
                 The name of the hack to toggle.
         """
-        self.get_hack(name)['enabled'] = not self.get_hack(name)['enabled']
+        self.enabled_hacks ^= set([name])
         self.rebuild_hacks()
 
     def rebuild_hacks(self):
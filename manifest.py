@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""File manifests of directory trees, used to copy only what has changed."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import hashlib
+import os
+import shutil
+
+import fileops
+import tracing
+from writebehind import replace_file
+
+class Manifest(object):
+    """Lists the files in a directory tree with their size, modification time
+    and, once it has been needed, a hash of their contents. The inode change
+    time is kept too, so a hash is not reused for a file rewritten with the
+    same size and modification time."""
+    def __init__(self, root, entries=None):
+        """
+        Constructor for Manifest.
+
+        Params:
+            root
+                The directory the manifest describes.
+            entries
+                Dictionary mapping relative paths to
+                [size, mtime, hash, ctime], where hash may be None.
+        """
+        self.root = root
+        self.entries = entries if entries is not None else {}
+        # Relative paths of all subdirectories, as of the last scan
+        self.directories = set()
+
+    @staticmethod
+    def entry(st, digest=None):
+        """
+        Returns a manifest entry for a file.
+
+        Params:
+            st
+                The stat result of the file.
+            digest
+                The hash of the file, or None if it is not known.
+        """
+        return [st.st_size, st.st_mtime, digest, st.st_ctime]
+
+    @staticmethod
+    def scan(root, previous=None):
+        """
+        Returns a Manifest of the files currently in <root>. Hashes are kept
+        from <previous> for files whose size, modification time and change
+        time are unchanged.
+
+        Params:
+            root
+                The directory to scan.
+            previous
+                An earlier Manifest (or its entries) for the same directory.
+        """
+        if isinstance(previous, Manifest):
+            previous = previous.entries
+        previous = previous or {}
+        result = Manifest(root)
+        if not os.path.isdir(root):
+            return result
+        directories, files = fileops.scan_tree(root)
+        result.directories.update(directories)
+        for relative, st in files:
+            entry = Manifest.entry(st)
+            old = previous.get(relative)
+            if (old is not None and old[:2] == entry[:2] and
+                    old[3:] == entry[3:]):
+                entry[2] = old[2]
+            result.entries[relative] = entry
+        return result
+
+    def hash(self, relative):
+        """
+        Returns the SHA-1 hash of the contents of a file in the manifest,
+        computing it if necessary.
+
+        Params:
+            relative
+                The path of the file, relative to the root.
+        """
+        entry = self.entries[relative]
+        if entry[2] is None:
+            digest = hashlib.sha1()
+            with open(os.path.join(self.root, relative), 'rb') as f:
+                for block in iter(lambda: f.read(1048576), b''):
+                    digest.update(block)
+            entry[2] = digest.hexdigest()
+            tracing.add_io(entry[0])
+        return entry[2]
+
+    def restat(self, relative):
+        """
+        Updates the entry of a file after its times or links changed, keeping
+        its hash.
+
+        Params:
+            relative
+                The path of the file, relative to the root.
+        """
+        self.entries[relative] = Manifest.entry(
+            os.stat(os.path.join(self.root, relative)),
+            self.entries[relative][2])
+
+    def total_bytes(self):
+        """Returns the combined size of all files in the manifest."""
+        return sum(e[0] for e in self.entries.values())
+
+    def digest(self):
+        """Returns a hash of the paths, sizes and modification times of the
+        files in the manifest, which changes whenever the tree changes."""
+        digest = hashlib.sha1()
+        for relative in sorted(self.entries):
+            entry = self.entries[relative]
+            digest.update('{0}\0{1}\0{2!r}\n'.format(
+                relative.replace(os.sep, '/'), entry[0],
+                entry[1]).encode('utf-8'))
+        return digest.hexdigest()
+
+class SyncReport(object):
+    """Counts the work done by sync_tree."""
+    def __init__(self):
+        self.copied = 0
+        self.copied_bytes = 0
+        self.removed = 0
+        self.removed_bytes = 0
+        self.unchanged = 0
+        # Relative paths of the files that did not exist in the target
+        self.added = []
+
+    def add(self, other):
+        """Adds the counts of another SyncReport to this one."""
+        self.copied += other.copied
+        self.copied_bytes += other.copied_bytes
+        self.removed += other.removed
+        self.removed_bytes += other.removed_bytes
+        self.unchanged += other.unchanged
+        self.added.extend(other.added)
+
+    def __str__(self):
+        return (
+            '{0} file(s) copied ({1} bytes), {2} removed ({3} bytes), '
+            '{4} unchanged'.format(
+                self.copied, self.copied_bytes, self.removed,
+                self.removed_bytes, self.unchanged))
+
+def sync_tree(source, target, delete=True, source_entries=None,
+              target_entries=None, link=False, progress=None, exclude=(),
+              backup=None, report=None):
+    """
+    Updates <target> to contain the files in <source>, copying only files
+    that are new or have changed. Files of the same size but with different
+    modification times are compared by hash, so identical files are left in
+    place. Returns a tuple (report, source manifest, target manifest),
+    where report is <report> if one was given.
+
+    Params:
+        source
+            The directory to copy from. Must exist.
+        target
+            The directory to copy to. Created if missing.
+        delete
+            If True, files (and directories left empty) in <target> that do
+            not exist in <source> are removed. May also be a tuple of
+            subdirectories of <target>, to only remove files within those.
+        source_entries
+            Entries of a previous manifest of <source>, to reuse hashes.
+        target_entries
+            Entries of a previous manifest of <target>, to reuse hashes.
+        link
+            If True, copied files are hard links to the source files where
+            possible. See fileops.copy_file.
+        progress
+            Function called with (files copied, files to copy) after each
+            file, or None.
+        exclude
+            Names of top-level subdirectories of <source> and <target> to
+            leave alone.
+        backup
+            If given, files in <target> that are replaced or removed are
+            moved into this directory (at the same relative path) instead of
+            being overwritten, so the sync can be undone.
+        report
+            A SyncReport to add the work done to, or None to start a new one.
+            Files are added to report.added before they are copied, so if the
+            sync fails part way, the report lists every file it may have
+            created.
+    """
+    if not os.path.isdir(source):
+        raise IOError('No such directory: ' + source)
+    if report is None:
+        report = SyncReport()
+    if not os.path.isdir(target):
+        os.makedirs(target)
+    src = Manifest.scan(source, source_entries)
+    dst = Manifest.scan(target, target_entries)
+    for relative in sorted(src.directories - dst.directories):
+        path = os.path.join(target, relative)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    def excluded(relative):
+        """Returns True if <relative> is in an excluded subdirectory."""
+        return relative.replace(os.sep, '/').split('/')[0] in exclude
+
+    def move_out(relative):
+        """Moves a file of <target> into <backup>."""
+        path = os.path.join(backup, relative)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        replace_file(os.path.join(target, relative), path)
+
+    copies = []
+    for relative in sorted(src.entries):
+        if excluded(relative):
+            continue
+        entry = src.entries[relative]
+        old = dst.entries.get(relative)
+        if old is not None and old[0] == entry[0]:
+            if old[1] == entry[1] or src.hash(relative) == dst.hash(relative):
+                path = os.path.join(target, relative)
+                # Same contents; make the times match to skip the hash next
+                # time, unless the file shares its times with other links
+                if old[1] != entry[1] and os.stat(path).st_nlink < 2:
+                    shutil.copystat(os.path.join(source, relative), path)
+                    dst.restat(relative)
+                report.unchanged += 1
+                continue
+        copies.append(relative)
+        if old is None:
+            report.added.append(relative)
+        elif backup is not None:
+            move_out(relative)
+    fileops.copy_files([
+        (os.path.join(source, r), os.path.join(target, r),
+         src.entries[r][0]) for r in copies], link, progress)
+    for relative in copies:
+        st = os.stat(os.path.join(target, relative))
+        dst.entries[relative] = Manifest.entry(st, src.entries[relative][2])
+        if link:
+            # A new link changes the change time of the source file too
+            src.restat(relative)
+        report.copied += 1
+        report.copied_bytes += st.st_size
+    if delete:
+        def removable(relative):
+            """Returns True if <relative> may be removed from <target>."""
+            if excluded(relative):
+                return False
+            if delete is True:
+                return True
+            return any(
+                relative.startswith(os.path.join(d, '')) for d in delete)
+        for relative in sorted(set(dst.entries) - set(src.entries)):
+            if removable(relative):
+                if backup is not None:
+                    move_out(relative)
+                else:
+                    os.remove(os.path.join(target, relative))
+                report.removed += 1
+                report.removed_bytes += dst.entries.pop(relative)[0]
+        # Deepest first, so parents are empty once their children are gone
+        for relative in sorted(dst.directories - src.directories,
+                               reverse=True):
+            path = os.path.join(target, relative)
+            if removable(relative) and not os.listdir(path):
+                os.rmdir(path)
+                dst.directories.discard(relative)
+    dst.directories |= src.directories
+    tracing.add_io(0, report.removed)
+    return report, src, dst
+
+# vim:expandtab
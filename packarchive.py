@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Graphics packs stored as zip or tar archives, read without extracting
+them. Packs may be at the top level of the archive or in a folder."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import shutil
+import tarfile
+import time
+import zipfile
+from collections import OrderedDict
+
+import tracing
+from manifest import SyncReport
+from writebehind import replace_file
+
+# File name endings of supported archives
+ARCHIVE_SUFFIXES = (
+    '.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz',
+    '.txz')
+
+# The file identifying the top folder of a pack
+MARKER = 'data/init/init.txt'
+
+def is_archive(path):
+    """Returns True if <path> is a file with the name of a supported
+    archive."""
+    return path.lower().endswith(ARCHIVE_SUFFIXES) and os.path.isfile(path)
+
+def member_path(name):
+    """
+    Returns the name of an archive member with / as separator, or None if
+    it could point outside the folder it is extracted to: absolute paths,
+    Windows drive letters and UNC paths, and paths containing "..".
+
+    Params:
+        name
+            The name of the member as stored in the archive.
+    """
+    name = name.replace('\\', '/')
+    parts = name.split('/')
+    if name.startswith('/') or '..' in parts or any(':' in p for p in parts):
+        return None
+    return name
+
+class PackArchive(object):
+    """A graphics pack in an archive. Paths inside the pack are relative to
+    its top folder and use / as separator."""
+    def __init__(self, path):
+        """
+        Constructor for PackArchive. Reads the list of files in the archive:
+        for zip files, this is the central directory at the end of the file;
+        tar files have to be read through to find all their headers, which
+        compressed tar files stream through the decompressor without writing
+        anything. Reading a file of a compressed tar stored before the last
+        one read decompresses the archive again from the start, so files are
+        best read in archive order (see extract and read_files).
+
+        Params:
+            path
+                The archive file.
+        """
+        self.path = path
+        self.zip = None
+        self.tar = None
+        if path.lower().endswith('.zip'):
+            self.zip = zipfile.ZipFile(path)
+            listing = [
+                (member_path(i.filename), i.file_size,
+                 time.mktime(i.date_time + (0, 0, -1)), i)
+                for i in self.zip.infolist() if not i.filename.endswith('/')]
+        else:
+            self.tar = tarfile.open(path)
+            listing = [
+                (member_path(m.name), m.size, m.mtime, m)
+                for m in self.tar.getmembers() if m.isfile()]
+        # Unsafe names are left out
+        listing = [m for m in listing if m[0] is not None]
+        prefixes = [
+            name[:-len(MARKER)] for name, _, _, _ in listing
+            if name == MARKER or name.endswith('/' + MARKER)]
+        self.prefix = min(prefixes, key=len) if prefixes else ''
+        # Relative path -> (size, mtime, archive member), in archive order
+        self.members = OrderedDict()
+        for name, size, mtime, member in listing:
+            if not name.startswith(self.prefix):
+                continue
+            relative = name[len(self.prefix):]
+            if relative:
+                self.members[relative] = (size, mtime, member)
+
+    def close(self):
+        """Closes the archive."""
+        (self.zip or self.tar).close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def stamp(self):
+        """Returns a string identifying the current version of the archive
+        file."""
+        st = os.stat(self.path)
+        return 'archive:{0}:{1!r}'.format(st.st_size, st.st_mtime)
+
+    def exists(self, relative):
+        """Returns True if the file or folder <relative> is in the pack."""
+        if relative in self.members:
+            return True
+        folder = relative.rstrip('/') + '/'
+        return any(r.startswith(folder) for r in self.members)
+
+    def _open(self, member):
+        """Returns a file object reading an archive member."""
+        if self.zip is not None:
+            return self.zip.open(member)
+        return self.tar.extractfile(member)
+
+    def read(self, relative, size=-1):
+        """
+        Returns the contents of a file in the pack, or None if it does not
+        exist.
+
+        Params:
+            relative
+                The path of the file.
+            size
+                The maximum number of bytes to read, or -1 to read it all.
+        """
+        entry = self.members.get(relative)
+        if entry is None:
+            return None
+        f = self._open(entry[2])
+        try:
+            # Python 2's tar members take no negative sizes
+            data = f.read() if size < 0 else f.read(size)
+        finally:
+            f.close()
+        tracing.add_io(len(data))
+        return data
+
+    def read_files(self, select):
+        """
+        Returns the contents of several files of the pack, reading them in
+        archive order so a compressed tar is decompressed at most once.
+
+        Params:
+            select
+                Function returning True for the relative paths of the files
+                to read.
+
+        Returns:
+            A dictionary mapping the relative paths to the file contents.
+        """
+        result = {}
+        for relative, (_, _, member) in self.members.items():
+            if not select(relative):
+                continue
+            f = self._open(member)
+            try:
+                result[relative] = f.read()
+            finally:
+                f.close()
+            tracing.add_io(len(result[relative]))
+        return result
+
+    def total_bytes(self):
+        """Returns the combined size of the files in the pack."""
+        return sum(e[0] for e in self.members.values())
+
+    def extract(self, target, select):
+        """
+        Writes files of the pack to <target>, reading the archive front to
+        back. Files keep their modification times.
+
+        Params:
+            target
+                The folder to write to.
+            select
+                Function returning True for the relative paths of the files
+                to write.
+
+        Returns:
+            A list of the relative paths written.
+        """
+        written = []
+        root = os.path.join(os.path.abspath(target), '')
+        for relative, (size, mtime, member) in self.members.items():
+            if not select(relative):
+                continue
+            path = os.path.join(root, *relative.split('/'))
+            if not os.path.normpath(path).startswith(root):
+                raise IOError('Unsafe path in archive: ' + relative)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if os.path.lexists(path) and (
+                    os.path.islink(path) or os.lstat(path).st_nlink > 1):
+                # Don't write through to the file <path> is linked to
+                os.remove(path)
+            source = self._open(member)
+            try:
+                with open(path, 'wb') as out:
+                    shutil.copyfileobj(source, out, 1048576)
+            finally:
+                source.close()
+            os.utime(path, (mtime, mtime))
+            tracing.add_io(size)
+            written.append(relative)
+        return written
+
+    def sync(self, target, select, backup=None, report=None):
+        """
+        Updates <target> with files of the pack, writing them straight from
+        the archive. Files of the same size and modification time as in the
+        archive are left in place; files not in the pack are kept.
+
+        Params:
+            target
+                The folder to update.
+            select
+                Function returning True for the relative paths of the files
+                to write.
+            backup
+                If given, files in <target> that are replaced are moved into
+                this folder (at the same relative path) first, so the update
+                can be undone.
+            report
+                A manifest.SyncReport to add the work done to, or None to
+                start a new one. Files are added to report.added before they
+                are written, so if the update fails part way, the report
+                lists every file it may have created.
+
+        Returns:
+            The manifest.SyncReport, with added paths using os.sep.
+        """
+        if report is None:
+            report = SyncReport()
+        changed = set()
+        for relative, (size, mtime, _) in self.members.items():
+            if not select(relative):
+                continue
+            local = os.path.join(*relative.split('/'))
+            path = os.path.join(target, local)
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is not None and st.st_size == size and (
+                    int(st.st_mtime) == int(mtime)):
+                report.unchanged += 1
+                continue
+            if st is None:
+                report.added.append(local)
+            elif backup is not None:
+                moved = os.path.join(backup, local)
+                if not os.path.isdir(os.path.dirname(moved)):
+                    os.makedirs(os.path.dirname(moved))
+                replace_file(path, moved)
+            changed.add(relative)
+        written = self.extract(target, changed.__contains__)
+        report.copied += len(written)
+        report.copied_bytes += sum(self.members[r][0] for r in written)
+        return report
+
+# vim:expandtab
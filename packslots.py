@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Slots holding prepared graphics trees for a DF folder.
+
+A graphics pack is installed by preparing the trees it replaces (raw/graphics
+and data/art) in a slot next to the DF folder, then swapping the slot with
+the live trees by renaming directories. The trees taken out by the swap are
+kept in a slot of their own, along with backups of other files the install
+changed, so the install can be undone by swapping back. Slots of recently
+used packs are kept until a limit on their number or size is reached, so
+switching back to one of these packs needs no copying."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import json
+import os
+import tempfile
+
+import fileops
+from writebehind import atomic_write, replace_file
+
+# Trees of a DF folder replaced as a whole by a graphics pack
+TREES = (os.path.join('raw', 'graphics'), os.path.join('data', 'art'))
+
+# Files describing a slot and the live trees
+INFO_FILE = 'slot.json'
+LIVE_FILE = 'live.json'
+
+# Directory of a slot holding files to restore when undoing an install
+BACKUP_DIR = 'backup'
+
+def _read_json(path):
+    """Returns the object stored in the JSON file <path>, or an empty
+    dictionary if it is missing or unreadable."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def _move(source, target):
+    """Moves the file or directory <source> to <target>, creating parent
+    directories as needed."""
+    parent = os.path.dirname(target)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    replace_file(source, target)
+
+def manifest_bytes(manifests):
+    """
+    Returns the combined size of the files in manifest entries.
+
+    Params:
+        manifests
+            Dictionary mapping trees to manifest entries.
+    """
+    return sum(e[0] for m in manifests.values() for e in m.values())
+
+class PackSlots(object):
+    """The slots of a DF folder. Each slot is a directory containing the trees
+    in TREES and a file describing them:
+
+        pack
+            The name of the graphics pack the trees were made from, or None
+            if unknown.
+        stamp
+            The manifest digest of the pack when the trees were made.
+        manifests
+            Dictionary mapping each tree to its manifest entries.
+        bytes
+            The combined size of the trees.
+        used
+            The time the trees were last live.
+        installed
+            For the live trees, the time they were installed.
+        font, graphics_font
+            For the live trees, the FONT and GRAPHICS_FONT they were
+            installed with.
+        check
+            For the live trees, a fingerprint of them. See fingerprint().
+        rollback
+            True for the slot of the trees replaced by the last install, which
+            also holds backups of the other files changed by it.
+        added
+            For the rollback slot, files (relative to the DF folder) created
+            by the install, to remove when undoing it.
+    """
+    def __init__(self, df_dir, max_slots=3, budget=512 * 1048576):
+        """
+        Constructor for PackSlots.
+
+        Params:
+            df_dir
+                The DF folder.
+            max_slots
+                The maximum number of slots to keep, including the rollback
+                slot.
+            budget
+                The maximum combined size in bytes of the slots to keep. The
+                rollback slot is always kept.
+        """
+        self.df_dir = df_dir
+        self.root = os.path.join(df_dir, 'PyLNP_slots')
+        self.max_slots = max_slots
+        self.budget = budget
+
+    @staticmethod
+    def read_info(slot):
+        """Returns the description of <slot>."""
+        return _read_json(os.path.join(slot, INFO_FILE))
+
+    @staticmethod
+    def write_info(slot, info):
+        """Stores the description of <slot>."""
+        atomic_write(os.path.join(slot, INFO_FILE), json.dumps(
+            info, separators=(',', ':')))
+
+    def live_info(self):
+        """Returns the description of the live trees, in the same format as
+        slots, or an empty dictionary if they were not installed through
+        slots."""
+        return _read_json(os.path.join(self.root, LIVE_FILE))
+
+    def write_live_info(self, info):
+        """Stores the description of the live trees."""
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        atomic_write(os.path.join(self.root, LIVE_FILE), json.dumps(
+            info, separators=(',', ':')))
+
+    def fingerprint(self, paths):
+        """
+        Returns the sizes and modification times of files and directories in
+        the DF folder, as a dictionary mapping their paths to [size, mtime],
+        or None for missing paths. Checking these for the live trees and font
+        images is a cheap way to notice that the live graphics changed.
+
+        Params:
+            paths
+                The paths to check, relative to the DF folder.
+        """
+        result = {}
+        for relative in paths:
+            try:
+                st = os.stat(os.path.join(self.df_dir, relative))
+                result[relative] = [st.st_size, st.st_mtime]
+            except OSError:
+                result[relative] = None
+        return result
+
+    def verify(self, info):
+        """
+        Checks the live trees against the fingerprint in <info>, the
+        description of the live trees. Returns a sorted list of the paths
+        that changed since the fingerprint was taken.
+        """
+        check = info.get('check', {})
+        current = self.fingerprint(check)
+        return sorted(r for r in check if check[r] != current[r])
+
+    def slots(self):
+        """Returns a list of (path, description) for all slots, most recently
+        used first."""
+        if not os.path.isdir(self.root):
+            return []
+        result = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path):
+                result.append((path, self.read_info(path)))
+        result.sort(key=lambda s: -s[1].get('used', 0))
+        return result
+
+    def find(self, pack, stamp):
+        """
+        Returns the path of the slot holding trees made from the current
+        contents of a pack, or None.
+
+        Params:
+            pack
+                The name of the pack.
+            stamp
+                The current manifest digest of the pack.
+        """
+        for path, info in self.slots():
+            if info.get('pack') == pack and info.get('stamp') == stamp:
+                return path
+        return None
+
+    def rollback_slot(self):
+        """Returns the path of the slot holding the trees replaced by the
+        last install, or None."""
+        for path, info in self.slots():
+            if info.get('rollback'):
+                return path
+        return None
+
+    def new_slot(self):
+        """Creates an empty slot and returns its path."""
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        return tempfile.mkdtemp(prefix='slot-', dir=self.root)
+
+    def swap(self, incoming, outgoing):
+        """
+        Makes the trees in the slot <incoming> live, moving the live trees
+        into the slot <outgoing>. If a rename fails, the renames done so far
+        are reverted.
+
+        Params:
+            incoming
+                The slot to take the trees from.
+            outgoing
+                The slot to move the live trees to.
+        """
+        done = []
+        try:
+            for tree in TREES:
+                live = os.path.join(self.df_dir, tree)
+                if os.path.isdir(live):
+                    _move(live, os.path.join(outgoing, tree))
+                    done.append((os.path.join(outgoing, tree), live))
+                if os.path.isdir(os.path.join(incoming, tree)):
+                    _move(os.path.join(incoming, tree), live)
+                    done.append((live, os.path.join(incoming, tree)))
+        except:
+            for source, target in reversed(done):
+                _move(source, target)
+            raise
+
+    def backup(self, relative, slot):
+        """
+        Moves a file of the DF folder into the backups of <slot>. Returns
+        False if the file does not exist.
+
+        Params:
+            relative
+                The path of the file, relative to the DF folder.
+            slot
+                The slot to move the file to.
+        """
+        path = os.path.join(self.df_dir, relative)
+        if not os.path.isfile(path):
+            return False
+        _move(path, os.path.join(slot, BACKUP_DIR, relative))
+        return True
+
+    def restore(self, slot, outgoing):
+        """
+        Undoes the changes recorded in the rollback slot <slot> to files
+        outside the trees. The files it replaces are backed up in
+        <outgoing>, so restoring can be undone in turn.
+
+        Params:
+            slot
+                The rollback slot.
+            outgoing
+                The slot to back up replaced files in.
+
+        Returns:
+            A list of the files created by restoring.
+        """
+        added = []
+        for relative in self.read_info(slot).get('added', []):
+            self.backup(relative, outgoing)
+        backup = os.path.join(slot, BACKUP_DIR)
+        if os.path.isdir(backup):
+            for relative, _ in fileops.scan_tree(backup, False)[1]:
+                if not self.backup(relative, outgoing):
+                    added.append(relative)
+                _move(os.path.join(backup, relative),
+                      os.path.join(self.df_dir, relative))
+        return added
+
+    @staticmethod
+    def remove(slot):
+        """Removes <slot> and its contents."""
+        if os.path.isdir(slot):
+            fileops.remove_tree(slot)
+
+    def set_rollback(self, slot):
+        """
+        Makes <slot> the rollback slot. Backups held by the previous rollback
+        slot are discarded, and the slot itself too if its trees are not
+        those of a known pack.
+
+        Params:
+            slot
+                The new rollback slot.
+        """
+        for path, info in self.slots():
+            if path == slot or not info.get('rollback'):
+                continue
+            if info.get('pack') is None:
+                self.remove(path)
+                continue
+            if os.path.isdir(os.path.join(path, BACKUP_DIR)):
+                fileops.remove_tree(os.path.join(path, BACKUP_DIR))
+            info.pop('added', None)
+            info['rollback'] = False
+            self.write_info(path, info)
+        info = self.read_info(slot)
+        info['rollback'] = True
+        self.write_info(slot, info)
+
+    def evict(self):
+        """
+        Removes the least recently used slots until the number and combined
+        size of the slots are within limits. Slots not made from a known pack
+        are removed, unless they are the rollback slot.
+
+        Returns:
+            The number of slots removed.
+        """
+        kept = 0
+        total = 0
+        removed = 0
+        for path, info in self.slots():
+            size = info.get('bytes', 0)
+            if not info.get('rollback') and (
+                    info.get('pack') is None or kept >= self.max_slots or
+                    total + size > self.budget):
+                self.remove(path)
+                removed += 1
+                continue
+            kept += 1
+            total += size
+        return removed
+
+# vim:expandtab
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Persistent index of the tokens used in the raw files of a DF instance."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import json
+import mmap
+import os
+import re
+import sys
+
+from writebehind import atomic_write
+
+# Token names in [TOKEN], [TOKEN:...] and the disabled form !TOKEN!. The
+# closing ! is not consumed, since the next token may start right after it
+# (e.g. !A!!B!)
+_RAW_TOKEN_RE = re.compile(
+    br'\[([^\[\]:\r\n]+)[:\]]|!([A-Z0-9_]+)(?=!)')
+
+INDEX_VERSION = 4
+
+class RawIndex(object):
+    """Maps token names to the raw files they occur in, and keeps where the
+    flag tokens being tracked (e.g. AQUIFER) occur in each file, so these
+    can be read and toggled without scanning the files. Offsets are only
+    kept for the tracked tokens, since keeping them for every token of the
+    raws would make the index many times larger. The index is stored on disk
+    and only files modified since the last refresh are scanned again."""
+    def __init__(self, raw_dir, index_file=None, flags=()):
+        """
+        Constructor for RawIndex. Loads the stored index and refreshes it.
+
+        Params:
+            raw_dir
+                The directory containing the raw files (e.g. raw/objects).
+            index_file
+                The file the index is stored in, or None to keep it in
+                memory only.
+            flags
+                Names of the flag tokens to keep the offsets of.
+        """
+        self.raw_dir = raw_dir
+        self.index_file = index_file
+        self.flags = sorted(set(flags))
+        # filename -> {'mtime': ..., 'size': ..., 'tokens': [token, ...],
+        #              'flags': {flag: [offset, ...]}}
+        self.files = dict()
+        # token -> tuple of paths
+        self.token_files = dict()
+        # Whether files changed in place have not been stored yet
+        self.unsaved = False
+        self.load()
+        self.refresh()
+
+    def load(self):
+        """Loads the stored index, if it exists, is of a known version and
+        tracks the same flags."""
+        if self.index_file is None:
+            return
+        try:
+            f = open(self.index_file)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return
+        if (data.get('version') == INDEX_VERSION and
+                data.get('flags') == self.flags):
+            self.files = data.get('files', {})
+
+    def save(self):
+        """Stores the index on disk."""
+        if self.index_file is None:
+            return
+        try:
+            folder = os.path.dirname(self.index_file)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            atomic_write(self.index_file, json.dumps({
+                'version': INDEX_VERSION, 'flags': self.flags,
+                'files': self.files}, separators=(',', ':')))
+        except (IOError, OSError):
+            sys.excepthook(*sys.exc_info())
+
+    def refresh(self):
+        """Rescans raw files added or modified since the last refresh, and
+        drops files that no longer exist. Returns True if anything changed."""
+        try:
+            names = [
+                n for n in os.listdir(self.raw_dir) if n.endswith('.txt')]
+        except OSError:
+            names = []
+        changed = False
+        for name in list(self.files.keys()):
+            if name not in names:
+                del self.files[name]
+                changed = True
+        for name in names:
+            path = os.path.join(self.raw_dir, name)
+            try:
+                st = os.stat(path)
+                entry = self.files.get(name)
+                if (entry is None or entry['mtime'] != st.st_mtime or
+                        entry['size'] != st.st_size):
+                    tokens, flags = self.scan(path, self.flags)
+                    self.files[name] = {
+                        'mtime': st.st_mtime, 'size': st.st_size,
+                        'tokens': tokens, 'flags': flags}
+                    changed = True
+            except (IOError, OSError):
+                # Removed since the folder was listed
+                if self.files.pop(name, None) is not None:
+                    changed = True
+        if changed or not self.token_files:
+            self.build()
+        if changed or self.unsaved:
+            self.save()
+            self.unsaved = False
+        return changed
+
+    @staticmethod
+    def scan(path, flags=()):
+        """
+        Returns a tuple (sorted list of the token names used in <path>,
+        dictionary mapping each of <flags> used as a flag token, i.e. as
+        [FLAG] or !FLAG!, to the offsets of these occurrences).
+
+        Params:
+            path
+                The raw file to scan.
+            flags
+                Names of the flag tokens to find the offsets of.
+        """
+        tokens = set()
+        offsets = dict()
+        flags = set(f.encode('ascii') for f in flags)
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return [], {}
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for match in _RAW_TOKEN_RE.finditer(data):
+                    token = match.group(1) or match.group(2)
+                    tokens.add(token)
+                    if token in flags and (
+                            match.group(2) or match.group(0).endswith(b']')):
+                        offsets.setdefault(token.decode('latin-1'), []).append(
+                            match.start())
+            finally:
+                data.close()
+        return sorted(t.decode('latin-1') for t in tokens), offsets
+
+    def build(self):
+        """Builds the in-memory lookup tables from the per-file data."""
+        tokens = dict()
+        for name in sorted(self.files.keys()):
+            path = os.path.join(self.raw_dir, name)
+            for token in self.files[name]['tokens']:
+                tokens.setdefault(token, []).append(path)
+        self.token_files = dict((k, tuple(v)) for k, v in tokens.items())
+
+    def files_with(self, token):
+        """
+        Returns a tuple of the paths of all raw files using <token>.
+
+        Params:
+            token
+                The token name to look up.
+        """
+        return self.token_files.get(token, ())
+
+    def flag_offsets(self, path, flag):
+        """
+        Returns a list of the offsets of the flag token <flag> in the raw
+        file <path>, or None if they are not known: the flag is not tracked,
+        or the file is not in the index or has changed since it was scanned.
+
+        Params:
+            path
+                The raw file.
+            flag
+                The name of the flag token.
+        """
+        entry = self.files.get(os.path.basename(path))
+        if entry is None or flag not in self.flags:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if entry['mtime'] != st.st_mtime or entry['size'] != st.st_size:
+            return None
+        return entry['flags'].get(flag, [])
+
+    def touched(self, path):
+        """
+        Records that the raw file <path> was changed in place without moving
+        any tokens (e.g. by toggling a flag), so its offsets still apply. The
+        index is stored on disk again with the next refresh.
+
+        Params:
+            path
+                The raw file.
+        """
+        entry = self.files.get(os.path.basename(path))
+        if entry is not None:
+            st = os.stat(path)
+            entry['mtime'] = st.st_mtime
+            entry['size'] = st.st_size
+            self.unsaved = True
+
+# vim:expandtab
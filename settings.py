@@ -3,7 +3,14 @@
 """Configuration and raw manipulation for Dwarf Fortress."""
 from __future__ import print_function, unicode_literals, absolute_import
 
-import sys, os, re
+import sys, os, re, threading, mmap, fnmatch
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import fileops
+import tracing
+from writebehind import atomic_write
+from rawindex import RawIndex
 
 # Markers to read certain settings correctly
 
@@ -21,80 +28,571 @@ class _ForceBool(object):
 
 _force_bool = _ForceBool()
 
+# Matches [FIELD] and [FIELD:VALUE]
+_TOKEN_RE = re.compile(r'\[([^\[\]:\r\n]+)(?::([^\]\r\n]+))?\]')
+
+class TokenIndex(object):
+    """Index of the tokens in the text of a DF file, built in a single pass
+    over the text."""
+    def __init__(self, text):
+        """
+        Constructor for TokenIndex.
+
+        Params:
+            text
+                The text to index.
+        """
+        self.text = text
+        # field name -> list of (value, start, end); span covers the value
+        self.values = dict()
+        for match in _TOKEN_RE.finditer(text):
+            if match.group(2) is not None:
+                self.values.setdefault(match.group(1), []).append(
+                    (match.group(2), match.start(2), match.end(2)))
+
+    def get(self, field):
+        """
+        Returns the value of the first occurrence of <field>, or None if the
+        field does not occur with a value.
+
+        Params:
+            field
+                The field name to look up.
+        """
+        try:
+            return self.values[field][0][0]
+        except KeyError:
+            return None
+
+    def fields(self):
+        """Returns a list of (field name, first value) for all fields with a
+        value."""
+        return [(k, v[0][0]) for k, v in self.values.items()]
+
+    @staticmethod
+    def from_file(filename):
+        """
+        Reads and indexes the file <filename>.
+
+        Params:
+            filename
+                The file to read.
+        """
+        settings_file = open(filename)
+        try:
+            text = settings_file.read()
+        finally:
+            settings_file.close()
+        tracing.add_io(len(text))
+        return TokenIndex(text)
+
+class TokenCache(object):
+    """Bounded LRU cache of TokenIndex objects for files. Entries are
+    validated against the size and modification time of the file, so a cache
+    hit costs a single stat."""
+    def __init__(self, max_size=32):
+        """
+        Constructor for TokenCache.
+
+        Params:
+            max_size
+                The maximum number of files to keep indexes for.
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def stamp(filename):
+        """
+        Returns a (mtime_ns, size) tuple identifying the current version of
+        <filename>.
+
+        Params:
+            filename
+                The file to stat.
+        """
+        st = os.stat(filename)
+        mtime = getattr(st, 'st_mtime_ns', None)
+        if mtime is None:  # Python 2
+            mtime = int(st.st_mtime * 1000000000)
+        return (mtime, st.st_size)
+
+    def get(self, filename):
+        """
+        Returns a TokenIndex for <filename>, reading the file only if it has
+        changed since it was last indexed.
+
+        Params:
+            filename
+                The file to read.
+        """
+        key = os.path.abspath(filename)
+        try:
+            stamp = self.stamp(key)
+        except OSError:
+            # Let the read raise the same IOError as an uncached read would
+            return TokenIndex.from_file(filename)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] == stamp:
+                self.hits += 1
+                self.entries[key] = entry
+                return entry[1]
+            self.misses += 1
+        index = TokenIndex.from_file(filename)
+        self.add(key, stamp, index)
+        return index
+
+    def store(self, filename, index):
+        """
+        Records <index> as the current contents of <filename>. Used after
+        writing a file, to avoid reading it back.
+
+        Params:
+            filename
+                The file that was written.
+            index
+                A TokenIndex of the text that was written.
+        """
+        key = os.path.abspath(filename)
+        self.add(key, self.stamp(key), index)
+
+    def add(self, key, stamp, index):
+        """Adds an entry, evicting the least recently used entries if the
+        cache is full."""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (stamp, index)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, filename=None):
+        """
+        Drops the cached index for <filename>, or all indexes if no filename
+        is given.
+
+        Params:
+            filename
+                The file to drop.
+        """
+        with self.lock:
+            if filename is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(os.path.abspath(filename), None)
+
+# Shared by all readers of DF text files
+file_cache = TokenCache()
+
+def _flag_re(field_name):
+    """Returns a bytes regex matching both [<field_name>] and
+    !<field_name>!."""
+    name = re.escape(field_name.encode('ascii'))
+    return re.compile(b'\\[' + name + b'\\]|!' + name + b'!')
+
+def _flags_at(f, field_name, offsets):
+    """
+    Returns a list of (offset, enabled) for the flag token <field_name> at
+    each of <offsets> in the open file <f>, or None if any of them does not
+    hold [<field_name>] or !<field_name>!.
+    """
+    enabled = b'[' + field_name.encode('ascii') + b']'
+    disabled = b'!' + field_name.encode('ascii') + b'!'
+    result = []
+    for offset in offsets:
+        f.seek(offset)
+        data = f.read(len(enabled))
+        if data not in (enabled, disabled):
+            return None
+        result.append((offset, data == enabled))
+    tracing.add_io(len(offsets) * len(enabled))
+    return result
+
+def raw_flag_enabled(filename, field_name, offsets=None):
+    """
+    Returns True if the token [<field_name>] occurs in <filename>. If the
+    offsets of the token are known, only these are read; otherwise, the file
+    is memory-mapped and scanned as bytes, so large raw files are neither
+    decoded nor copied.
+
+    Params:
+        filename
+            The file to scan.
+        field_name
+            The name of the flag token.
+        offsets
+            The offsets of [<field_name>] and !<field_name>! in the file
+            (see rawindex.RawIndex.flag_offsets), or None to scan it.
+    """
+    with open(filename, 'rb') as f:
+        if offsets is not None:
+            flags = _flags_at(f, field_name, offsets)
+            if flags is not None:
+                return any(e for _, e in flags)
+        size = os.fstat(f.fileno()).st_size
+        tracing.add_io(size)
+        if size == 0:
+            return False
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            token = b'[' + field_name.encode('ascii') + b']'
+            return data.find(token) != -1
+        finally:
+            data.close()
+
+def set_raw_flag(filename, field_name, enabled, offsets=None):
+    """
+    Enables or disables all occurrences of the token [<field_name>] in
+    <filename> by replacing the surrounding [] with !! (or the other way
+    around). Since the replacement has the same length, the file is changed
+    in place: at the known offsets of the token, or otherwise through a
+    memory map.
+
+    Params:
+        filename
+            The file to modify.
+        field_name
+            The name of the flag token.
+        enabled
+            True to enable the flag, False to disable it.
+        offsets
+            The offsets of [<field_name>] and !<field_name>! in the file
+            (see rawindex.RawIndex.flag_offsets), or None to scan it.
+    """
+    if enabled:
+        start, end = b'[', b']'
+    else:
+        start, end = b'!', b'!'
+    if offsets is not None:
+        with open(filename, 'rb') as f:
+            flags = _flags_at(f, field_name, offsets)
+        if flags is not None:
+            positions = [o for o, e in flags if e != enabled]
+            if not positions:
+                return
+            if os.stat(filename).st_nlink > 1:
+                fileops.unshare_file(filename)
+            with open(filename, 'r+b') as f:
+                for offset in positions:
+                    f.seek(offset)
+                    f.write(start)
+                    f.seek(offset + len(field_name) + 1)
+                    f.write(end)
+            tracing.add_io(2 * len(positions))
+            return
+    if os.stat(filename).st_nlink > 1:
+        # The file is shared with other files (e.g. through the raw store);
+        # give it its own copy first, if it needs changing
+        with open(filename, 'rb') as f:
+            text = f.read()
+        if all(text[m.start():m.start() + 1] == start
+               for m in _flag_re(field_name).finditer(text)):
+            return
+        fileops.unshare_file(filename)
+    with open(filename, 'r+b') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE)
+        try:
+            positions = [
+                (m.start(), m.end() - 1) for m in
+                _flag_re(field_name).finditer(data)
+                if data[m.start():m.start() + 1] != start]
+            for first, last in positions:
+                data[first:first + 1] = start
+                data[last:last + 1] = end
+            if positions:
+                data.flush()
+                tracing.add_io(2 * len(positions))
+        finally:
+            data.close()
+
+def _splice(text, edits):
+    """
+    Returns <text> with a list of non-overlapping edits applied in one pass.
+
+    Params:
+        text
+            The original text.
+        edits
+            Iterable of (start, end, replacement) tuples.
+    """
+    pieces = []
+    pos = 0
+    for start, end, replacement in sorted(edits):
+        pieces.append(text[pos:start])
+        pieces.append(replacement)
+        pos = end
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+class Option(object):
+    """An option stored in DF files. The files are given relative to the
+    Dwarf Fortress folder, so options can be shared by all instances of
+    DFConfiguration. For options stored in raw files, files is None until
+    the files are looked up."""
+    __slots__ = ('name', 'field_name', 'default', 'values', 'files')
+
+    def __init__(self, name, field_name, default, values, files):
+        """
+        Constructor for Option. See DFConfiguration.create_option for a
+        description of the parameters; files must be relative paths.
+        """
+        self.name = name
+        self.field_name = field_name
+        self.default = default
+        self.values = values
+        self.files = files
+
+    def __repr__(self):
+        return 'Option({0!r}, {1!r}, {2!r}, {3!r}, {4!r})'.format(
+            self.name, self.field_name, self.default, self.values, self.files)
+
+_boolvals = ("YES", "NO")
+_init = (os.path.join('data', 'init', 'init.txt'),)
+_dinit = (os.path.join('data', 'init', 'd_init.txt'),)
+
+# Init file fields belonging to a graphics pack, by category: (file relative
+# to the DF folder, fnmatch-style patterns of field names). Patterns pick up
+# fields added by new DF versions.
+GRAPHICS_FIELDS = OrderedDict((
+    ('font', (_init[0], ('FONT', 'FULLFONT', 'TRUETYPE'))),
+    ('tileset', (
+        _init[0], ('GRAPHICS', 'GRAPHICS_FONT', 'GRAPHICS_FULLFONT'))),
+    ('tiles', (_dinit[0], ('SKY', 'CHASM', 'PILLAR_TILE'))),
+    ('track', (_dinit[0], ('TRACK_*',))),
+    ('tree', (_dinit[0], ('TREE_*',))),
+    ('wound colors', (_dinit[0], ('WOUND_COLOR_*',))),
+))
+
+# Tuple of fnmatch-style patterns -> compiled regular expression
+_field_matchers = {}
+
+def _field_matcher(patterns):
+    """Returns a compiled regular expression matching field names that match
+    any of <patterns>."""
+    patterns = tuple(patterns)
+    matcher = _field_matchers.get(patterns)
+    if matcher is None:
+        matcher = re.compile('|'.join(fnmatch.translate(p) for p in patterns))
+        _field_matchers[patterns] = matcher
+    return matcher
+
+def patch_fields(source_dir, target_dir, categories=None, read=None):
+    """
+    Copies the values of fields in init files from one DF folder (or
+    graphics pack) to another. Each file is read once from each folder (or
+    the file cache) and, if any values differ, written once with all changes
+    spliced in. Fields are only changed, not added. As when options are read,
+    values of yes/no options such as TRUETYPE other than NO are taken as YES.
+
+    Params:
+        source_dir
+            The folder to take values from.
+        target_dir
+            The folder to change.
+        categories
+            Dictionary mapping category names to (file, patterns) as in
+            GRAPHICS_FIELDS, which is the default.
+        read
+            Function returning the text of a file of the source given its
+            path relative to the folders, or None if it does not exist. Used
+            for sources other than folders, e.g. archives; if None, files are
+            read from <source_dir>.
+
+    Returns:
+        A dictionary mapping each file (relative to the folders) to a sorted
+        list of (field, old value, new value) for the fields changed.
+    """
+    if categories is None:
+        categories = GRAPHICS_FIELDS
+    patterns = OrderedDict()
+    for relative, names in categories.values():
+        patterns.setdefault(relative, []).extend(names)
+    forced = set(
+        o.field_name for o in DFConfiguration.schema
+        if o.values is _force_bool)
+    result = OrderedDict()
+    for relative, names in patterns.items():
+        matcher = _field_matcher(names)
+        if read is None:
+            source = file_cache.get(os.path.join(source_dir, relative))
+        else:
+            text = read(relative)
+            if text is None:
+                raise IOError('No such file in the pack: ' + relative)
+            source = TokenIndex(text)
+        filename = os.path.join(target_dir, relative)
+        target = file_cache.get(filename)
+        changes = []
+        edits = []
+        for field, occurrences in target.values.items():
+            if not matcher.match(field):
+                continue
+            value = source.get(field)
+            if value is not None and field in forced and value != "NO":
+                #Interpret everything other than "NO" as "YES"
+                value = "YES"
+            if value is None or all(v == value for v, _, _ in occurrences):
+                continue
+            changes.append((field, occurrences[0][0], value))
+            edits.extend((start, end, value) for _, start, end in occurrences)
+        if edits:
+            text = _splice(target.text, edits)
+            atomic_write(filename, text)
+            tracing.add_io(len(text))
+            file_cache.store(filename, TokenIndex(text))
+        result[relative] = sorted(changes)
+    return result
+
 class DFConfiguration(object):
     """Reads and modifies Dwarf Fortress configuration textfiles."""
-    def __init__(self, base_dir):
+    # Options registered for every instance
+    schema = (
+        # init.txt
+        Option("truetype", "TRUETYPE", "YES", _force_bool, _init),
+        Option("sound", "SOUND", "YES", _boolvals, _init),
+        Option("volume", "VOLUME", "255", None, _init),
+        Option("introMovie", "INTRO", "YES", _boolvals, _init),
+        Option("startWindowed", "WINDOWED", "YES", _boolvals, _init),
+        Option("fpsCounter", "FPS", "NO", _boolvals, _init),
+        Option("fpsCap", "FPS_CAP", "100", None, _init),
+        Option("gpsCap", "G_FPS_CAP", "50", None, _init),
+        Option("procPriority", "PRIORITY", "NORMAL", (
+            "REALTIME", "HIGH", "ABOVE_NORMAL", "NORMAL", "BELOW_NORMAL",
+            "IDLE"), _init),
+        Option("compressSaves", "COMPRESSED_SAVES", "YES", _boolvals, _init),
+        Option("printmode", "PRINT_MODE", "2D", ("2D", "STANDARD"), _init),
+        # d_init.txt
+        Option("popcap", "POPULATION_CAP", "200", None, _dinit),
+        Option("childcap", "BABY_CHILD_CAP", "100:1000", None, _dinit),
+        Option("invaders", "INVADERS", "YES", _boolvals, _dinit),
+        Option("temperature", "TEMPERATURE", "YES", _boolvals, _dinit),
+        Option("weather", "WEATHER", "YES", _boolvals, _dinit),
+        Option("caveins", "CAVEINS", "YES", _boolvals, _dinit),
+        Option("liquidDepth", "SHOW_FLOW_AMOUNTS", "YES", _boolvals, _dinit),
+        Option("variedGround", "VARIED_GROUND_TILES", "YES", _boolvals, _dinit),
+        Option("laborLists", "SET_LABOR_LISTS", "SKILLS", (
+            "NO", "SKILLS", "BY_UNIT_TYPE"), _dinit),
+        Option("autoSave", "AUTOSAVE", "SEASONAL", (
+            "NONE", "SEASONAL", "YEARLY"), _dinit),
+        Option("autoBackup", "AUTOBACKUP", "YES", _boolvals, _dinit),
+        Option("autoSavePause", "AUTOSAVE_PAUSE", "YES", _boolvals, _dinit),
+        Option("initialSave", "INITIAL_SAVE", "YES", _boolvals, _dinit),
+        Option("pauseOnLoad", "PAUSE_ON_LOAD", "YES", _boolvals, _dinit),
+        Option("entombPets", "COFFIN_NO_PETS_DEFAULT", "NO", _boolvals, _dinit),
+        Option("artifacts", "ARTIFACTS", "YES", _boolvals, _dinit),
+    )
+    # Options stored in the raw files using their field name; the files are
+    # looked up per instance
+    raw_schema = (
+        Option("aquifers", "AQUIFER", "NO", _disabled, None),
+    )
+    # (options, settings, values, in_files) built from schema on first use,
+    # and copied by each new instance
+    schema_tables = None
+    # Names of attributes and methods, which option values may not shadow
+    reserved = None
+
+    def __init__(self, base_dir, raw_index_file=None):
         """
         Constructor for DFConfiguration.
 
         Params:
             base_dir
                 Path containing the Dwarf Fortress instance to operate on.
+            raw_index_file
+                The file to store the index of raw/objects in (see
+                rawindex.RawIndex), or None to keep it in memory only.
         """
         self.base_dir = base_dir
-        self.settings = dict()
-        self.options = dict()
-        self.field_names = dict()
-        self.inverse_field_names = dict()
-        self.files = dict()
-        self.in_files = dict()
-        # init.txt
-        boolvals = ("YES", "NO")
-        init = (os.path.join(base_dir, 'data', 'init', 'init.txt'),)
-        self.create_option("truetype", "TRUETYPE", "YES", _force_bool, init)
-        self.create_option("sound", "SOUND", "YES", boolvals, init)
-        self.create_option("volume", "VOLUME", "255", None, init)
-        self.create_option("introMovie", "INTRO", "YES", boolvals, init)
-        self.create_option("startWindowed", "WINDOWED", "YES", boolvals, init)
-        self.create_option("fpsCounter", "FPS", "NO", boolvals, init)
-        self.create_option("fpsCap", "FPS_CAP", "100", None, init)
-        self.create_option("gpsCap", "G_FPS_CAP", "50", None, init)
-        self.create_option(
-            "procPriority", "PRIORITY", "NORMAL", (
-                "REALTIME", "HIGH", "ABOVE_NORMAL", "NORMAL", "BELOW_NORMAL",
-                "IDLE"), init)
-        self.create_option(
-            "compressSaves", "COMPRESSED_SAVES", "YES", boolvals, init)
-        self.create_option(
-            "printmode", "PRINT_MODE", "2D", ("2D", "STANDARD"), init)
-        # d_init.txt
-        dinit = (os.path.join(base_dir, 'data', 'init', 'd_init.txt'),)
-        self.create_option("popcap", "POPULATION_CAP", "200", None, dinit)
-        self.create_option(
-            "childcap", "BABY_CHILD_CAP", "100:1000", None, dinit)
-        self.create_option("invaders", "INVADERS", "YES", boolvals, dinit)
-        self.create_option(
-            "temperature", "TEMPERATURE", "YES", boolvals, dinit)
-        self.create_option("weather", "WEATHER", "YES", boolvals, dinit)
-        self.create_option("caveins", "CAVEINS", "YES", boolvals, dinit)
-        self.create_option(
-            "liquidDepth", "SHOW_FLOW_AMOUNTS", "YES", boolvals, dinit)
-        self.create_option(
-            "variedGround", "VARIED_GROUND_TILES", "YES", boolvals, dinit)
-        self.create_option("laborLists", "SET_LABOR_LISTS", "SKILLS", (
-            "NO", "SKILLS", "BY_UNIT_TYPE"), dinit)
-        self.create_option("autoSave", "AUTOSAVE", "SEASONAL", (
-            "NONE", "SEASONAL", "YEARLY"), dinit)
-        self.create_option("autoBackup", "AUTOBACKUP", "YES", boolvals, dinit)
-        self.create_option(
-            "autoSavePause", "AUTOSAVE_PAUSE", "YES", boolvals, dinit)
-        self.create_option(
-            "initialSave", "INITIAL_SAVE", "YES", boolvals, dinit)
-        self.create_option(
-            "pauseOnLoad", "PAUSE_ON_LOAD", "YES", boolvals, dinit)
-        self.create_option(
-            "entombPets", "COFFIN_NO_PETS_DEFAULT", "NO", boolvals, dinit)
-        self.create_option("artifacts", "ARTIFACTS", "YES", boolvals, dinit)
-        # special
-        self.create_option("aquifers", "AQUIFER", "NO", _disabled, tuple(
-            os.path.join(base_dir, 'raw', 'objects', a) for a in [
-                'inorganic_stone_layer.txt', 'inorganic_stone_mineral.txt',
-                'inorganic_stone_soil.txt']))
+        self.raw_index_file = raw_index_file
+        if DFConfiguration.schema_tables is None:
+            DFConfiguration.schema_tables = self.build_tables(self.schema)
+        options, settings, values, in_files = DFConfiguration.schema_tables
+        # Name or field name -> Option
+        self.options = dict(options)
+        # Name -> current value
+        self.settings = dict(settings)
+        # Fileset (relative paths) -> list of names
+        self.in_files = dict((k, list(v)) for k, v in in_files.items())
+        # Filesets resolved from raw tokens; never used to auto-add options
+        self.raw_files = set()
+        # Names of raw options whose files have not been looked up yet
+        self.raw_pending = set()
+        # Index of raw/objects, built when first needed
+        self.raw_index = None
+        # Whether the raw index has been refreshed since the raws were last
+        # read or replaced
+        self.raw_index_fresh = False
+        # Options changed since they were last read or written
+        self.dirty = set()
+        # Filesets registered but not read yet by read_settings
+        self.unloaded = set()
+        # Filesets read so far
+        self.loaded = set()
+        # Guards registration and assignment while filesets are read
+        # concurrently
+        self.lock = threading.RLock()
+        # Option names and field names whose values are published as instance
+        # attributes, so that reading them never calls __getattr__
+        self.published = set()
+        if DFConfiguration.reserved is None:
+            DFConfiguration.reserved = frozenset(dir(self))
+            for key in DFConfiguration.reserved.intersection(values):
+                del values[key]
+        self.__dict__.update(values)
+        self.published.update(values)
+        for option in self.raw_schema:
+            self.create_raw_option(
+                option.name, option.field_name, option.default, option.values)
+
+    @staticmethod
+    def build_tables(schema):
+        """
+        Returns the (options, settings, values, in_files) lookup tables for a
+        list of options.
+
+        Params:
+            schema
+                The Option objects to build tables for.
+        """
+        options = dict()
+        settings = dict()
+        values = dict()
+        in_files = dict()
+        for option in schema:
+            options[option.name] = option
+            options[option.field_name] = option
+            settings[option.name] = option.default
+            values[option.name] = option.default
+            values[option.field_name] = option.default
+            in_files.setdefault(option.files, []).append(option.name)
+        return options, settings, values, in_files
+
+    def path(self, filename):
+        """Returns the full path of a file relative to the DF folder."""
+        return os.path.join(self.base_dir, filename)
+
+    def relative(self, filename):
+        """Returns the path of a file relative to the DF folder. Files on
+        another drive than the DF folder keep their absolute path."""
+        try:
+            return os.path.relpath(filename, self.base_dir)
+        except ValueError:
+            return os.path.abspath(filename)
+
+    def paths(self, files):
+        """Returns the full paths of a fileset."""
+        return tuple(self.path(f) for f in files)
 
     def create_option(self, name, field_name, default, values, files):
         """
-        Register an option to write back for changes. If the field_name has
-        been registered before, no changes are made.
+        Register an option to write back for changes. If the name or
+        field_name has been registered before, no changes are made.
 
         Params:
           name
@@ -118,24 +616,191 @@ class DFConfiguration(object):
           files
             A tuple of files this value is read from. Used for e.g. aquifer
             toggling, which requires editing multiple files.
+
+        Returns:
+            The files relative to the DF folder if the option was registered,
+            otherwise None.
         """
+        files = tuple(self.relative(f) for f in files)
+        with self.lock:
+            # Don't allow re-registration of a known field
+            if name in self.options or field_name in self.options:
+                return
+            option = Option(name, field_name, default, values, files)
+            self.options[name] = option
+            self.options[field_name] = option
+            self.store(option, default)
+            self.in_files.setdefault(files, []).append(name)
+            return files
 
-        # Don't allow re-registration of a known field
-        if name in self.settings or name in self.inverse_field_names:
-            return
-        self.settings[name] = default
-        self.options[name] = values
-        self.field_names[name] = field_name
-        if field_name != name:
-            self.inverse_field_names[field_name] = name
-        self.files[name] = files
-        self.in_files.setdefault(files, [])
-        self.in_files[files].append(name)
+    def create_raw_option(self, name, field_name, default, values):
+        """
+        Register an option stored in every raw file in raw/objects containing
+        the token <field_name>. The files are found through the raw index
+        when the option is first used. See create_option for a description
+        of the parameters.
+        """
+        with self.lock:
+            if name in self.options or field_name in self.options:
+                return
+            option = Option(name, field_name, default, values, None)
+            self.options[name] = option
+            self.options[field_name] = option
+            self.store(option, default)
+            self.raw_pending.add(name)
+
+    def resolve_raw_options(self):
+        """
+        Looks up the files of raw options through the raw index, which is
+        built on first use and refreshed once each time the raws are read or
+        replaced. Options marked as changed keep their values, to be written
+        to the files found; the others are read from the files when next
+        used.
+        """
+        with self.lock:
+            if not self.raw_pending:
+                return
+            if self.raw_index is None:
+                self.raw_index = RawIndex(
+                    os.path.join(self.base_dir, 'raw', 'objects'),
+                    self.raw_index_file, [
+                        self.options[n].field_name for n in self.raw_pending])
+            elif not self.raw_index_fresh:
+                self.raw_index.refresh()
+            self.raw_index_fresh = True
+            for name in self.raw_pending:
+                option = self.options[name]
+                option.files = tuple(
+                    self.relative(f) for f in
+                    self.raw_index.files_with(option.field_name))
+                self.in_files.setdefault(option.files, []).append(name)
+                self.raw_files.add(option.files)
+                if name not in self.dirty:
+                    self.unloaded.add(option.files)
+            # Changed values are kept, unless another option of their files
+            # has to be read
+            self.publish([
+                n for n in self.raw_pending
+                if self.options[n].files not in self.unloaded])
+            self.raw_pending.clear()
+
+    def forget_raw_files(self, keep_values):
+        """
+        Drops the files found for raw options, so they are looked up again
+        when next used.
+
+        Params:
+            keep_values
+                If True, options whose values have been read keep them and
+                are marked as changed, so write_settings applies them to the
+                files found. Otherwise, they are read again from those files.
+        """
+        with self.lock:
+            # The raws may have changed
+            self.raw_index_fresh = False
+            for files in list(self.raw_files):
+                keep = (
+                    keep_values and files in self.loaded and
+                    files not in self.unloaded)
+                self.raw_files.discard(files)
+                self.unloaded.discard(files)
+                self.loaded.discard(files)
+                names = self.in_files.pop(files)
+                self.unpublish(names)
+                for name in names:
+                    self.options[name].files = None
+                    self.raw_pending.add(name)
+                    if keep:
+                        self.dirty.add(name)
+                    else:
+                        self.dirty.discard(name)
 
     def __iter__(self):
-        for key, value in list(self.settings.items()):
+        self.ensure_loaded()
+        with self.lock:
+            items = list(self.settings.items())
+        for key, value in items:
             yield key, value
 
+    def get_value(self, name, default=None):
+        """
+        Returns the value of the setting <name>, or <default> if there is no
+        such setting.
+
+        Params:
+            name
+                Name or field name of the setting.
+            default
+                Value to return for unknown settings.
+        """
+        if self.unloaded or self.raw_pending:
+            self.ensure_loaded(name)
+        option = self.options.get(name)
+        if option is None:
+            return default
+        return self.settings[option.name]
+
+    def is_loaded(self, name):
+        """
+        Returns True if the value of the setting <name> can be used without
+        reading any files. Unknown settings count as loaded once all filesets
+        have been read, since these may register them.
+
+        Params:
+            name
+                Name or field name of the setting.
+        """
+        option = self.options.get(name)
+        if option is None:
+            return not self.unloaded and not self.raw_pending
+        return option.files is not None and option.files not in self.unloaded
+
+    def store(self, option, value):
+        """
+        Stores the value of an option, and updates its attributes if they are
+        published. Call with the lock held.
+
+        Params:
+            option
+                The Option.
+            value
+                The new value.
+        """
+        self.settings[option.name] = value
+        for key in (option.name, option.field_name):
+            if key in self.published:
+                self.__dict__[key] = value
+
+    def publish(self, names):
+        """
+        Publishes the values of options as attributes under their names and
+        field names, once their files have been read. Call with the lock held.
+
+        Params:
+            names
+                The names of the options.
+        """
+        for name in names:
+            for key in (name, self.options[name].field_name):
+                if key not in self.reserved:
+                    self.__dict__[key] = self.settings[name]
+                    self.published.add(key)
+
+    def unpublish(self, names):
+        """
+        Removes the attributes of options, so that reading them goes through
+        __getattr__ until their files have been read. Call with the lock held.
+
+        Params:
+            names
+                The names of the options.
+        """
+        for name in names:
+            for key in (name, self.options[name].field_name):
+                if key in self.published:
+                    self.published.discard(key)
+                    del self.__dict__[key]
+
     def set_value(self, name, value):
         """
         Sets the setting <name> to <value>.
@@ -146,7 +811,12 @@ class DFConfiguration(object):
             value
                 New value for the setting.
         """
-        self.settings[name] = value
+        self.ensure_loaded(name)
+        with self.lock:
+            option = self.options[name]
+            if self.settings[option.name] != value:
+                self.store(option, value)
+                self.dirty.add(option.name)
 
     def cycle_item(self, name):
         """
@@ -156,9 +826,11 @@ class DFConfiguration(object):
             name
                 Name of the setting to cycle.
         """
-
-        self.settings[name] = self.cycle_list(
-            self.settings[name], self.options[name])
+        self.ensure_loaded(name)
+        with self.lock:
+            option = self.options[name]
+            self.set_value(option.name, self.cycle_list(
+                self.settings[option.name], option.values))
 
     @staticmethod
     def cycle_list(current, items):
@@ -183,16 +855,119 @@ class DFConfiguration(object):
             items = ("YES", "NO")
         return items[(items.index(current) + 1) % len(items)]
 
-    def read_settings(self):
-        """Read settings from known filesets. If fileset only contains one
-        file, all options will be registered automatically."""
-        for files in self.in_files.keys():
-            for filename in files:
-                self.read_file(filename, self.in_files[files], len(files) == 1)
+    @tracing.traced()
+    def read_settings(self, lazy=False):
+        """
+        Read settings from known filesets. If fileset only contains one
+        file, all options will be registered automatically, unless the fileset
+        belongs to a raw option.
+
+        Params:
+            lazy
+                If True, only check that the files exist; each fileset is read
+                when one of its options is first accessed, and the raw index
+                is not used until then. Otherwise, all filesets are read
+                concurrently.
+        """
+        # Raw files may have been added or removed
+        self.forget_raw_files(False)
+        if not lazy:
+            self.resolve_raw_options()
+        with self.lock:
+            self.unloaded = set(self.in_files.keys())
+            for key in self.published:
+                del self.__dict__[key]
+            self.published.clear()
+        if lazy:
+            for files in self.unloaded:
+                for filename in self.paths(files):
+                    if not os.path.isfile(filename):
+                        raise IOError('No such file: ' + filename)
+        else:
+            self.load_filesets(self.unloaded)
+
+    def ensure_loaded(self, name=None):
+        """
+        Reads the fileset containing the option <name>, if this has not yet
+        happened. If <name> is None or unknown, reads all remaining filesets,
+        since these may register the option. Files that cannot be read are
+        reported, and their options keep their current values.
+
+        Params:
+            name
+                The option that is about to be used.
+        """
+        if self.raw_pending:
+            option = self.options.get(name)
+            if name is None or (option is not None and option.files is None):
+                self.resolve_raw_options()
+        if not self.unloaded:
+            return
+        if name in self.options:
+            filesets = [self.options[name].files]
+        else:
+            filesets = list(self.unloaded)
+        try:
+            self.load_filesets(filesets)
+        except IOError:
+            # Called when a setting is used, where nothing handles the error;
+            # report it once and keep the default values
+            sys.excepthook(*sys.exc_info())
+            with self.lock:
+                self.unloaded.difference_update(filesets)
+                for files in filesets:
+                    self.publish(self.in_files.get(files, ()))
+
+    def load_filesets(self, filesets):
+        """
+        Reads those of <filesets> which have not yet been read, using a small
+        thread pool if there are several.
+
+        Params:
+            filesets
+                The filesets to read.
+        """
+        with self.lock:
+            filesets = [f for f in filesets if f in self.unloaded]
+            self.unloaded.difference_update(filesets)
+        try:
+            if len(filesets) > 1:
+                pool = ThreadPool(min(len(filesets), 4))
+                try:
+                    pool.map(self.read_fileset, filesets)
+                finally:
+                    pool.close()
+            else:
+                for files in filesets:
+                    self.read_fileset(files)
+        except:
+            with self.lock:
+                self.unloaded.update(filesets)
+                for files in filesets:
+                    self.unpublish(self.in_files.get(files, ()))
+            raise
+
+    @tracing.traced(log=False)
+    def read_fileset(self, files):
+        """
+        Reads the options of a single fileset.
+
+        Params:
+            files
+                The fileset to read.
+        """
+        auto_add = len(files) == 1 and files not in self.raw_files
+        for filename in self.paths(files):
+            self.read_file(filename, self.in_files[files], auto_add)
+        with self.lock:
+            self.loaded.add(files)
+            self.publish(self.in_files[files])
 
     def read_file(self, filename, fields, auto_add):
         """
-        Reads DF settings from the file <filename>.
+        Reads DF settings from the file <filename>. Fields read from one of
+        their own files are no longer considered changed; fields read from
+        any other file (e.g. a graphics pack) are marked as changed.
 
         Params:
           filename
@@ -204,35 +979,102 @@ class DFConfiguration(object):
             calling create_option(field_name, field_name, value, None,
             (filename,)).
         """
-        settings_file = open(filename)
-        text = settings_file.read()
-        if auto_add:
-            for match in re.findall(r'\[(.+?):(.+?)\]', text):
-                self.create_option(
-                    match[0], match[0], match[1], None, (filename,))
-        for field in fields:
-            if field in self.inverse_field_names:
-                field = self.inverse_field_names[field]
-            if self.options[field] is _disabled:
-                # If there is a single match, flag the option as enabled
-                if "[{0}]".format(self.field_names[field]) in text:
-                    self.settings[field] = "YES"
-            else:
-                match = re.search(r'\[{0}:(.+?)\]'.format(
-                    self.field_names[field]), text)
-                if match:
-                    if (self.options[field] is _force_bool and
-                            match.group(1) != "NO"):
+        relative = self.relative(filename)
+        if self.unloaded and any(
+                f not in self.options or
+                relative not in (self.options[f].files or ()) for f in fields):
+            # Read the current values first, so they can't later overwrite
+            # the values read from this file
+            self.ensure_loaded()
+        options = [self.options[f] for f in fields]
+        index = None
+        if auto_add or any(o.values is not _disabled for o in options):
+            index = file_cache.get(filename)
+        flags = dict(
+            (o.name, raw_flag_enabled(
+                filename, o.field_name,
+                self.raw_offsets(filename, o.field_name)))
+            for o in options if o.values is _disabled)
+        with self.lock:
+            if auto_add:
+                for field_name, value in index.fields():
+                    self.create_option(
+                        field_name, field_name, value, None, (filename,))
+            for option in options:
+                field = option.name
+                if relative in (option.files or ()):
+                    self.dirty.discard(field)
+                else:
+                    self.dirty.add(field)
+                if field in flags:
+                    # If there is a single match, flag the option as enabled
+                    if flags[field]:
+                        self.store(option, "YES")
+                    continue
+                value = index.get(option.field_name)
+                if value is not None:
+                    if option.values is _force_bool and value != "NO":
                         #Interpret everything other than "NO" as "YES"
-                        self.settings[field] = "YES"
+                        self.store(option, "YES")
                     else:
-                        self.settings[field] = match.group(1)
+                        self.store(option, value)
                 else:
                     print(
                         'WARNING: Expected match for field ' + str(field) +
                         ' in file ' + str(filename) +
                         '. Possible DF version mismatch?', file=sys.stderr)
 
+    def update_fields(self, filename, values):
+        """
+        Records values written straight to <filename> (e.g. by patch_fields)
+        without reading the file again. Unregistered fields are ignored;
+        fields of other files are marked as changed, as in read_file.
+
+        Params:
+          filename
+            The file that was written.
+          values
+            An iterable of (field name, value) tuples.
+        """
+        relative = self.relative(filename)
+        with self.lock:
+            for field, value in values:
+                option = self.options.get(field)
+                if option is None or option.values is _disabled:
+                    continue
+                if relative in (option.files or ()):
+                    self.dirty.discard(option.name)
+                else:
+                    self.dirty.add(option.name)
+                if option.values is _force_bool and value != "NO":
+                    value = "YES"
+                self.store(option, value)
+
+    def raws_replaced(self):
+        """
+        Records that files in raw/objects were replaced or added, e.g. by a
+        graphics pack install. The files of raw options are looked up again,
+        and options whose values have been read are marked as changed, so
+        write_settings applies them to the new files; otherwise, the values
+        shown would no longer match the files.
+        """
+        self.forget_raw_files(True)
+
+    def raw_offsets(self, filename, field_name):
+        """
+        Returns the offsets of the flag token <field_name> in the raw file
+        <filename> known to the raw index, or None if they are not known.
+
+        Params:
+            filename
+                The raw file.
+            field_name
+                The name of the flag token.
+        """
+        if self.raw_index is None:
+            return None
+        return self.raw_index.flag_offsets(filename, field_name)
+
     @staticmethod
     def read_value(filename, field):
         """
@@ -247,22 +1089,36 @@ class DFConfiguration(object):
             The field to read.
         """
         try:
-            settings_file = open(filename)
-            match = re.search(
-                r'\['+str(field)+r':(.+?)\]', settings_file.read())
-            if match is None:
-                return None
-            return match.group(1)
+            return file_cache.get(filename).get(str(field))
         except IOError:
             return None
 
+    @tracing.traced()
     def write_settings(self):
-        """Write all settings to their respective files."""
-        for files in self.in_files:
-            for filename in files:
-                self.write_file(filename, self.in_files[files])
+        """Write changed settings to their respective files. Files without
+        changed settings are not touched. The changes are taken under the
+        lock, so settings may be changed by other threads while writing;
+        such changes are left for the next write."""
+        with self.lock:
+            if self.raw_pending & self.dirty:
+                self.resolve_raw_options()
+            dirty = self.dirty
+            self.dirty = set()
+            values = dict((n, self.settings[n]) for n in dirty)
+            filesets = [
+                (files, [f for f in fields if f in dirty])
+                for files, fields in self.in_files.items()]
+        try:
+            for files, changed in filesets:
+                if changed:
+                    for filename in self.paths(files):
+                        self.write_file(filename, changed, values)
+        except:
+            with self.lock:
+                self.dirty.update(dirty)
+            raise
 
-    def write_file(self, filename, fields):
+    def write_file(self, filename, fields, values=None):
         """
         Write settings to a specific file.
 
@@ -270,46 +1126,55 @@ class DFConfiguration(object):
             filename
                 Name of the file to write.
             fields
-                List of all field names to change.
-        """
-        oldfile = open(filename, 'r')
-        text = oldfile.read()
-        for field in fields:
-            if self.options[field] is _disabled:
-                replace_from = None
-                replace_to = None
-                if self.settings[field] == "NO":
-                    replace_from = "[{0}]"
-                    replace_to = "!{0}!"
-                else:
-                    replace_from = "!{0}!"
-                    replace_to = "[{0}]"
-                text = text.replace(
-                    replace_from.format(self.field_names[field]),
-                    replace_to.format(self.field_names[field]))
-            else:
-                text = re.sub(
-                    r'\[{0}:(.+?)\]'.format(self.field_names[field]),
-                    '[{0}:{1}]'.format(
-                        self.field_names[field], self.settings[field]), text)
-        oldfile.close()
-        newfile = open(filename, 'w')
-        newfile.write(text)
-        newfile.close()
+                List of all field names to change. The file is only rewritten
+                if this changes its contents.
+            values
+                Dictionary mapping the names of the fields to the values to
+                write. Defaults to the current settings.
+        """
+        if values is None:
+            values = self.settings
+        options = [self.options[f] for f in fields]
+        for option in options:
+            if option.values is _disabled:
+                offsets = self.raw_offsets(filename, option.field_name)
+                set_raw_flag(
+                    filename, option.field_name,
+                    values[option.name] != "NO", offsets)
+                if offsets is not None:
+                    # The tokens kept their places
+                    self.raw_index.touched(filename)
+        options = [o for o in options if o.values is not _disabled]
+        if not options:
+            return
+        index = file_cache.get(filename)
+        edits = []
+        for option in options:
+            value = "{0}".format(values[option.name])
+            edits.extend(
+                (start, end, value) for (_, start, end) in
+                index.values.get(option.field_name, ()))
+        text = _splice(index.text, edits)
+        if text == index.text:
+            return
+        atomic_write(filename, text)
+        tracing.add_io(len(text))
+        file_cache.store(filename, TokenIndex(text))
 
     def __str__(self):
-        return (
-            "base_dir = {0}\nsettings = {1}\noptions = {2}\n"
-            "field_names ={3}\ninverse_field_names = {4}\nfiles = {5}\n"
-            "in_files = {6}").format(
-                self.base_dir, self.settings, self.options, self.field_names,
-                self.inverse_field_names, self.files, self.in_files)
+        return "base_dir = {0}\nsettings = {1}\noptions = {2}".format(
+            self.base_dir, self.settings,
+            sorted(set(self.options.values()), key=lambda o: o.name))
 
     def __getattr__(self, name):
         """Exposes all registered options through both their internal and
-        registered names."""
-        if name in self.inverse_field_names:
-            return self.settings[self.inverse_field_names[name]]
-        return self.settings[name]
+        registered names. Options whose files have been read are published as
+        instance attributes (see publish), so this is only called for the
+        others; the fileset containing the option is read first."""
+        self.ensure_loaded(name)
+        option = self.options.get(name)
+        if option is None:
+            raise AttributeError(name)
+        return self.settings[option.name]
 
 # vim:expandtab
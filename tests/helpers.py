@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Helpers shared by the tests: writing and reading files and creating a
+minimal DF folder."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+import settings
+from settings import DFConfiguration
+
+# The raw file holding the AQUIFER raw option in make_df
+STONE = os.path.join('raw', 'objects', 'inorganic_stone_layer.txt')
+
+def write(path, data, mtime=None):
+    """
+    Writes <data> to <path>, creating parent directories, and optionally
+    sets its modification time.
+
+    Params:
+        path
+            The file to write.
+        data
+            The contents; bytes are written as is, text in text mode.
+        mtime
+            The modification time to set, or None to leave it.
+    """
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+def read(path):
+    """Returns the contents of <path> as bytes."""
+    with open(path, 'rb') as f:
+        return f.read()
+
+def read_text(path):
+    """Returns the contents of <path> as text."""
+    with open(path) as f:
+        return f.read()
+
+def make_df(root):
+    """Creates a minimal DF folder with all options of DFConfiguration."""
+    for relative in (settings._init[0], settings._dinit[0]):
+        write(os.path.join(root, relative), ''.join(
+            '[{0}:{1}]\n'.format(o.field_name, o.default)
+            for o in DFConfiguration.schema if o.files[0] == relative))
+    write(os.path.join(root, STONE), '[INORGANIC:SAND]\n!AQUIFER!\n')
+
+# vim:expandtab
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for blobstore."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+import fileops
+from blobstore import BlobStore
+from helpers import read, write
+from manifest import Manifest
+from settings import set_raw_flag
+from writebehind import atomic_write
+
+SAME = b'[FLAG]\nsame\n'
+
+class BlobStoreTest(unittest.TestCase):
+    """Tests for BlobStore."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = BlobStore(os.path.join(self.root, 'store'))
+        self.a = os.path.join(self.root, 'a')
+        self.b = os.path.join(self.root, 'b')
+        write(os.path.join(self.a, 'x.txt'), SAME)
+        write(os.path.join(self.b, 'x.txt'), SAME)
+        write(os.path.join(self.b, 'y.txt'), b'other\n')
+        if not fileops.link_file(
+                os.path.join(self.a, 'x.txt'),
+                os.path.join(self.root, 'probe')):
+            self.skipTest('hard links not supported')
+        os.remove(os.path.join(self.root, 'probe'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def absorb(self):
+        """Absorbs both trees into the store."""
+        return sum(
+            self.store.absorb(Manifest.scan(t)) for t in (self.a, self.b))
+
+    def test_absorb_shares_identical_files(self):
+        self.assertEqual(self.absorb(), 3)
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.a, 'x.txt'), os.path.join(self.b, 'x.txt')))
+        report = self.store.report()
+        self.assertEqual(report.blobs, 2)
+        self.assertEqual(report.saved_bytes(), len(SAME))
+
+    def test_atomic_write_unshares(self):
+        self.absorb()
+        atomic_write(os.path.join(self.a, 'x.txt'), 'changed\n')
+        self.assertEqual(read(os.path.join(self.b, 'x.txt')), SAME)
+        self.assertEqual(self.store.report().blobs, 2)
+        for path, _ in self.store.blobs():
+            self.assertIn(read(path), (SAME, b'other\n'))
+
+    def test_raw_flag_unshares(self):
+        self.absorb()
+        set_raw_flag(os.path.join(self.a, 'x.txt'), 'FLAG', False)
+        self.assertEqual(
+            read(os.path.join(self.a, 'x.txt')), b'!FLAG!\nsame\n')
+        self.assertEqual(read(os.path.join(self.b, 'x.txt')), SAME)
+
+    def test_changed_blob_replaced(self):
+        self.absorb()
+        digest = hashlib.sha1(SAME).hexdigest()
+        # Changed in place through a link, behind the store's back
+        with open(os.path.join(self.a, 'x.txt'), 'r+b') as f:
+            f.write(b'[XXXX]')
+        os.utime(os.path.join(self.a, 'x.txt'), (1000000000, 1000000000))
+        write(os.path.join(self.root, 'c', 'x.txt'), SAME)
+        blob = self.store.add(os.path.join(self.root, 'c', 'x.txt'), digest)
+        self.assertEqual(read(blob), SAME)
+        self.assertFalse(
+            os.path.samefile(blob, os.path.join(self.a, 'x.txt')))
+
+    def test_collect_garbage(self):
+        self.absorb()
+        os.remove(os.path.join(self.b, 'y.txt'))
+        self.assertEqual(self.store.collect_garbage(), (1, len(b'other\n')))
+        self.assertEqual(self.store.report().blobs, 1)
+
+    def test_link_tree(self):
+        tree = Manifest.scan(self.b)
+        target = os.path.join(self.root, 'save')
+        self.assertEqual(self.store.link_tree(tree, target), 2)
+        self.assertEqual(read(os.path.join(target, 'y.txt')), b'other\n')
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab
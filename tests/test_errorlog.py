@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for errorlog."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+from errorlog import CaptureStream, LogWriter
+
+class FakeStream(object):
+    """Collects what a LogWriter writes, failing on request."""
+    def __init__(self, fail=0):
+        self.text = []
+        self.flushes = 0
+        self.fail = fail
+
+    def write_out(self, string):
+        """Keeps a string, or raises IOError for the first <fail> writes."""
+        if self.fail:
+            self.fail -= 1
+            raise IOError('disk full')
+        self.text.append(string)
+
+    def flush_out(self):
+        """Counts flushes."""
+        self.flushes += 1
+
+class LogWriterTest(unittest.TestCase):
+    """Tests for LogWriter."""
+    def setUp(self):
+        self.stderr = sys.__stderr__
+        sys.__stderr__ = io.StringIO() if sys.version_info[0] > 2 else \
+            io.BytesIO()
+
+    def tearDown(self):
+        sys.__stderr__ = self.stderr
+
+    def test_survives_write_error(self):
+        log_writer = LogWriter()
+        log_writer.start()
+        stream = FakeStream(fail=1)
+        log_writer.put(stream, 'lost')
+        log_writer.flush()
+        log_writer.put(stream, 'kept')
+        log_writer.flush()
+        self.assertTrue(log_writer.thread.is_alive())
+        self.assertEqual(stream.text, ['kept'])
+        self.assertIn('disk full', sys.__stderr__.getvalue())
+
+    def test_stopped_thread_writes_directly(self):
+        log_writer = LogWriter(max_pending=1)
+        log_writer.thread = threading.Thread(target=lambda: None)
+        log_writer.thread.start()
+        log_writer.thread.join()
+        stream = FakeStream()
+        log_writer.pending.append((stream, 'a'))
+        # Would wait for the writer thread if it were running
+        log_writer.put(stream, 'b')
+        self.assertEqual(stream.text, ['a', 'b'])
+        self.assertEqual(stream.flushes, 1)
+        log_writer.flush()
+
+    def test_not_started_does_not_block(self):
+        log_writer = LogWriter(max_pending=1)
+        stream = FakeStream()
+        log_writer.put(stream, 'a')
+        log_writer.put(stream, 'b')
+        self.assertEqual(log_writer.dropped, 1)
+        log_writer.start()
+        log_writer.flush()
+        self.assertEqual(stream.text, ['a', '\n[1 log messages dropped]\n'])
+
+class CaptureStreamTest(unittest.TestCase):
+    """Tests for CaptureStream."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.log_writer = LogWriter()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def stream(self, **kwargs):
+        """Returns a CaptureStream writing to a file in the temporary
+        folder."""
+        stream = CaptureStream(
+            'stdout', tee=False, log_writer=self.log_writer, **kwargs)
+        stream.filename = os.path.join(self.root, 'stdout.txt')
+        stream.outfile = io.open(stream.filename, 'w', encoding='utf-8')
+        return stream
+
+    def test_size_in_bytes(self):
+        stream = self.stream()
+        stream.write_out('æøå')
+        stream.write_out('a\n')
+        stream.outfile.close()
+        self.assertEqual(stream.file_size, 8 + len(os.linesep) - 1)
+        self.assertEqual(stream.file_size, os.path.getsize(stream.filename))
+
+    def test_rotate_on_encoded_size(self):
+        stream = self.stream(max_bytes=10)
+        stream.write_out('æ' * 6)
+        stream.outfile.close()
+        self.assertTrue(os.path.exists(stream.filename + '.1'))
+        self.assertEqual(stream.file_size, 0)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab
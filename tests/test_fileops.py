@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for fileops."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+import fileops
+from helpers import read, write
+
+class CopyFallbackTest(unittest.TestCase):
+    """Tests for the fallbacks of copy_file and link_file."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, 'source.txt')
+        self.target = os.path.join(self.root, 'target.txt')
+        write(self.source, b'abc' * 1000)
+        os.utime(self.source, (1000000000, 1000000000))
+        self.methods = fileops.METHODS
+        self.copiers = fileops._COPIERS
+        self.calls = []
+        fileops._unsupported.clear()
+        fileops._reflinked.clear()
+
+    def tearDown(self):
+        fileops.METHODS = self.methods
+        fileops._COPIERS = self.copiers
+        fileops._unsupported.clear()
+        fileops._reflinked.clear()
+        shutil.rmtree(self.root)
+
+    def fail_with(self, code):
+        """Returns a copier raising OSError(<code>) after writing some
+        data."""
+        def copier(src, dst, size):
+            """Fails part way."""
+            # pylint:disable=unused-argument
+            self.calls.append(code)
+            os.write(dst, b'partial')
+            raise OSError(code, os.strerror(code))
+        return copier
+
+    def test_unsupported_method_falls_back(self):
+        fileops.METHODS = ['broken']
+        fileops._COPIERS = {'broken': self.fail_with(errno.EXDEV)}
+        self.assertEqual(fileops.copy_file(self.source, self.target), 'copy')
+        self.assertEqual(read(self.target), read(self.source))
+        self.assertEqual(os.stat(self.target).st_mtime, 1000000000)
+        # Not tried again for the same pair of devices
+        fileops.copy_file(self.source, self.target)
+        self.assertEqual(self.calls, [errno.EXDEV])
+
+    def test_next_method_tried(self):
+        fileops.METHODS = ['broken', 'working']
+        fileops._COPIERS = {
+            'broken': self.fail_with(errno.EOPNOTSUPP),
+            'working': lambda src, dst, size: os.write(
+                dst, os.read(src, size))}
+        self.assertEqual(
+            fileops.copy_file(self.source, self.target), 'working')
+        self.assertEqual(read(self.target), read(self.source))
+
+    def test_failed_method_not_cached(self):
+        fileops.METHODS = ['broken', 'working']
+        fileops._COPIERS = {
+            'broken': self.fail_with(errno.EPERM),
+            'working': self.fail_with(errno.EIO)}
+        self.assertEqual(fileops.copy_file(self.source, self.target), 'copy')
+        self.assertEqual(read(self.target), read(self.source))
+        # Tried again for the next file
+        fileops.copy_file(self.source, self.target)
+        self.assertEqual(self.calls, [errno.EPERM, errno.EPERM])
+        self.assertEqual(fileops._unsupported, {})
+
+    def test_other_errors_raised(self):
+        fileops.METHODS = ['broken']
+        fileops._COPIERS = {'broken': self.fail_with(errno.EIO)}
+        self.assertRaises(
+            OSError, fileops.copy_file, self.source, self.target)
+
+    def test_can_reflink(self):
+        fileops.METHODS = ['reflink']
+        fileops._COPIERS = {'reflink': self.fail_with(errno.EOPNOTSUPP)}
+        self.assertFalse(fileops.can_reflink(self.root, self.root))
+        # Found out once per pair of devices, leaving no files behind
+        self.assertFalse(fileops.can_reflink(self.root, self.root))
+        self.assertEqual(self.calls, [errno.EOPNOTSUPP])
+        self.assertEqual(os.listdir(self.root), ['source.txt'])
+        fileops._unsupported.clear()
+        fileops._COPIERS = {'reflink': lambda src, dst, size: None}
+        self.assertTrue(fileops.can_reflink(self.root, self.root))
+        fileops.METHODS = []
+        self.assertFalse(fileops.can_reflink(self.root, self.root))
+
+    def test_link_unsupported(self):
+        link = getattr(os, 'link', None)
+
+        def fail(source, target):
+            """Fails like a file system without hard links."""
+            raise OSError(errno.EOPNOTSUPP, 'Operation not supported')
+
+        os.link = fail
+        try:
+            self.assertNotEqual(
+                fileops.copy_file(self.source, self.target, True), 'link')
+        finally:
+            if link is None:
+                del os.link
+            else:
+                os.link = link
+        self.assertEqual(read(self.target), read(self.source))
+        self.assertFalse(fileops.link_file(self.source, self.target))
+
+    def test_link_failed(self):
+        link = getattr(os, 'link', None)
+
+        def fail(source, target):
+            """Fails like a file that may not be linked."""
+            raise OSError(errno.EPERM, 'Operation not permitted')
+
+        os.link = fail
+        try:
+            self.assertFalse(fileops.link_file(self.source, self.target))
+        finally:
+            if link is None:
+                del os.link
+            else:
+                os.link = link
+        # Not cached, so other files are still linked
+        self.assertTrue(fileops.link_file(self.source, self.target))
+
+    def test_copy_over_link_does_not_write_through(self):
+        if not fileops.link_file(self.source, self.target):
+            self.skipTest('hard links not supported')
+        other = os.path.join(self.root, 'other.txt')
+        write(other, b'xyz')
+        fileops.copy_file(other, self.target)
+        self.assertEqual(read(self.target), b'xyz')
+        self.assertEqual(read(self.source), b'abc' * 1000)
+
+    def test_unshare(self):
+        if not fileops.link_file(self.source, self.target):
+            self.skipTest('hard links not supported')
+        fileops.unshare_file(self.target)
+        self.assertEqual(os.stat(self.source).st_nlink, 1)
+        self.assertEqual(read(self.target), read(self.source))
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for json_config."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+import json_config
+from json_config import JSONConfiguration
+
+class FlushAtExitTest(unittest.TestCase):
+    """Tests for writing configurations at exit."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_unsaved_changes_written(self):
+        path = os.path.join(self.root, 'a.json')
+        config = JSONConfiguration(path, delay=60)
+        config.set_value('a', 1)
+        config.save_data()
+        json_config._flush_all()
+        with open(path) as f:
+            self.assertEqual(json.load(f), {'a': 1})
+
+    def test_instances_not_kept_alive(self):
+        before = len(json_config._instances)
+        config = JSONConfiguration(os.path.join(self.root, 'b.json'))
+        self.assertEqual(len(json_config._instances), before + 1)
+        del config
+        gc.collect()
+        self.assertEqual(len(json_config._instances), before)
+
+    def test_scheduled_instances_not_kept_alive(self):
+        before = len(json_config._instances)
+        config = JSONConfiguration(os.path.join(self.root, 'c.json'))
+        config.set_value('c', 1)
+        config.save_data()
+        self.assertTrue(config.writer.pending())
+        writer = config.writer
+        del config
+        gc.collect()
+        self.assertEqual(len(json_config._instances), before)
+        # Nothing is left to write once the configuration is gone
+        writer.stop()
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'c.json')))
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab
@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for lnp."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import io
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+import fileops
+import lnp
+import packslots
+import settings
+import tracing
+from blobstore import BlobStore
+from helpers import make_df, read_text, write
+from json_config import JSONConfiguration
+from settings import file_cache
+from writebehind import WriteBehind
+
+class UI(object):
+    """Stands in for the user interface."""
+    def __init__(self):
+        self.scan_changed = threading.Event()
+
+    def on_scan_changed(self):
+        """Records the notification."""
+        self.scan_changed.set()
+
+def make_lnp(df_dir):
+    """Returns a PyLNP for the LNP folder in the current directory and
+    <df_dir>, without starting the user interface."""
+    # pylint:disable=attribute-defined-outside-init
+    p = lnp.PyLNP.__new__(lnp.PyLNP)
+    p.bundle = ''
+    p.lnp_dir = 'LNP'
+    p.keybinds_dir = os.path.join('LNP', 'Keybinds')
+    p.graphics_dir = os.path.join('LNP', 'Graphics')
+    p.utils_dir = os.path.join('LNP', 'Utilities')
+    p.colors_dir = os.path.join('LNP', 'Colors')
+    p.embarks_dir = os.path.join('LNP', 'Embarks')
+    p.raw_store = BlobStore(os.path.join('LNP', 'Store'))
+    p.folders = []
+    p.df_dir = ''
+    p.settings = None
+    p.init_dir = ''
+    p.save_dir = ''
+    p.autorun = []
+    p.running = {}
+    p.enabled_hacks = set()
+    p.assets = {}
+    p.instances = OrderedDict()
+    p.params_writer = WriteBehind(p.write_params)
+    # Absolute paths, since configurations may be written in the background
+    p.config = JSONConfiguration(os.path.abspath(
+        os.path.join('LNP', 'PyLNP.json')))
+    p.userconfig = JSONConfiguration(os.path.abspath('PyLNP.user'))
+    p.scan_cache = JSONConfiguration(
+        os.path.abspath('PyLNP.cache'), compact=True)
+    p.manifest_cache = JSONConfiguration(
+        os.path.abspath('PyLNP.manifests'), compact=True)
+    p.checked_scans = set()
+    p.unchecked_scans = {}
+    p.scan_results = lnp.queue.Queue()
+    p.pack_lookup = None
+    p.reported_drift = None
+    p.ui = None
+    p.new_version = None
+    p.set_df_folder(df_dir)
+    return p
+
+class LNPTestCase(unittest.TestCase):
+    """Base class for tests running PyLNP in a temporary folder."""
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp()
+        os.chdir(self.root)
+        file_cache.invalidate()
+        make_df('df')
+        self.instances = []
+
+    def tearDown(self):
+        # Write everything pending before the folder is removed
+        for p in self.instances:
+            p.params_writer.flush()
+            for config in (p.userconfig, p.scan_cache, p.manifest_cache):
+                config.flush()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def make_lnp(self, df_dir='df'):
+        """Returns a PyLNP for <df_dir>, see make_lnp."""
+        p = make_lnp(df_dir)
+        self.instances.append(p)
+        return p
+
+class ScanCacheTest(LNPTestCase):
+    """Tests for the cached folder scans."""
+    def setUp(self):
+        super(ScanCacheTest, self).setUp()
+        write(os.path.join('LNP', 'Keybinds', 'a.txt'), '')
+        self.lnp = self.make_lnp()
+        self.assertEqual(self.lnp.read_keybinds(), ('a.txt',))
+        self.lnp.scan_cache.flush()
+
+    def test_revalidation(self):
+        write(os.path.join('LNP', 'Keybinds', 'b.txt'), '')
+        os.utime(os.path.join('LNP', 'Keybinds'), (1000000000,) * 2)
+        # A new session uses the cached result and checks it in the background
+        later = self.make_lnp()
+        later.ui = UI()
+        self.assertEqual(later.read_keybinds(), ('a.txt',))
+        self.assertTrue(later.ui.scan_changed.wait(10))
+        # The new result is only stored by the UI thread
+        self.assertEqual(
+            later.scan_cache.get_value('keybinds')['result'], ['a.txt'])
+        self.assertTrue(later.apply_scan_results())
+        self.assertFalse(later.apply_scan_results())
+        self.assertEqual(sorted(later.read_keybinds()), ['a.txt', 'b.txt'])
+
+    def test_cached_manifest(self):
+        tree = os.path.join('LNP', 'Keybinds')
+        self.assertIsNone(self.lnp.cached_manifest(tree))
+        scanned = self.lnp.load_manifest(tree)
+        self.lnp.save_manifests(scanned)
+        self.assertEqual(self.lnp.cached_manifest(tree), scanned.entries)
+        self.lnp.manifest_cache.flush()
+        self.assertEqual(
+            self.make_lnp().cached_manifest(os.path.abspath(tree)),
+            scanned.entries)
+
+class InstanceCacheTest(LNPTestCase):
+    """Tests for keeping the loaded state of DF folders when switching."""
+    def setUp(self):
+        super(InstanceCacheTest, self).setUp()
+        for df_dir in ('df1', 'df2', 'df3'):
+            make_df(df_dir)
+        self.lnp = self.make_lnp()
+
+    def tearDown(self):
+        lnp.CACHED_INSTANCES = 4
+        super(InstanceCacheTest, self).tearDown()
+
+    def visit(self, *folders):
+        """Switches to each of <folders> in turn, and returns their
+        configurations."""
+        result = []
+        for df_dir in folders:
+            self.lnp.set_df_folder(df_dir)
+            result.append(self.lnp.settings)
+        return result
+
+    def test_switch(self):
+        first = self.lnp.settings
+        self.assertEqual(first.sound, 'YES')
+        assets = self.lnp.assets
+        second, = self.visit('df1')
+        self.assertIsNot(second, first)
+        self.assertEqual(self.visit('df', 'df1', 'df'), [first, second, first])
+        # Selecting the current folder again keeps it
+        self.assertEqual(self.visit('df'), [first])
+        self.assertIs(self.lnp.assets, assets)
+        self.assertEqual(list(self.lnp.instances), [os.path.abspath('df1')])
+
+    def test_eviction(self):
+        lnp.CACHED_INSTANCES = 2
+        first = self.lnp.settings
+        df1, _, _, _ = self.visit('df1', 'df', 'df2', 'df3')
+        # df1 was used least recently
+        self.assertEqual(
+            list(self.lnp.instances), [os.path.abspath(d) for d in (
+                'df', 'df2')])
+        self.assertEqual(self.visit('df'), [first])
+        self.assertIsNot(self.visit('df1')[0], df1)
+
+    def test_external_edit(self):
+        first = self.lnp.settings
+        self.assertEqual(first.sound, 'YES')
+        stamps = self.lnp.instance_stamps(first)
+        self.visit('df1')
+        init = os.path.join('df', settings._init[0])
+        write(init, read_text(init).replace('[SOUND:YES]', '[SOUND:NO]'))
+        self.assertNotEqual(self.lnp.instance_stamps(first), stamps)
+        reloaded, = self.visit('df')
+        self.assertIsNot(reloaded, first)
+        self.assertEqual(reloaded.sound, 'NO')
+
+class GraphicsTest(LNPTestCase):
+    """Tests for installing, undoing and simplifying graphics packs."""
+    def setUp(self):
+        super(GraphicsTest, self).setUp()
+        init = os.path.join('df', settings._init[0])
+        write(init, read_text(init) +
+              '[FONT:curses.png]\n[GRAPHICS_FONT:curses.png]\n')
+        write(os.path.join('df', 'data', 'init', 'colors.txt'), '[BLACK_R:0]')
+        write(os.path.join('df', 'raw', 'graphics', 'live.txt'), 'live')
+        write(os.path.join('df', 'data', 'art', 'curses.png'), 'curses')
+        self.make_pack('PackA', 'a.png')
+        self.make_pack('PackB', 'b.png')
+        self.lnp = self.make_lnp()
+        self.errors = []
+        self.excepthook = sys.excepthook
+        sys.excepthook = lambda *info: self.errors.append(info[1])
+
+    def tearDown(self):
+        sys.excepthook = self.excepthook
+        super(GraphicsTest, self).tearDown()
+
+    @staticmethod
+    def make_pack(name, font):
+        """Creates a graphics pack in LNP/Graphics using <font>."""
+        pack = os.path.join('LNP', 'Graphics', name)
+        init = read_text(os.path.join('df', settings._init[0]))
+        write(os.path.join(pack, settings._init[0]),
+              init.replace('curses.png', font))
+        write(os.path.join(pack, settings._dinit[0]),
+              read_text(os.path.join('df', settings._dinit[0])))
+        write(os.path.join(pack, 'data', 'init', 'colors.txt'), name)
+        write(os.path.join(pack, 'data', 'init', 'overrides.txt'), name)
+        write(os.path.join(pack, 'raw', 'graphics', name + '.txt'), name)
+        write(os.path.join(pack, 'raw', 'objects', name + '.txt'), name)
+        write(os.path.join(pack, 'data', 'art', font), name)
+        write(os.path.join(pack, 'readme.txt'), 'readme')
+        write(os.path.join(pack, 'extra', 'notes.txt'), 'notes')
+
+    def assert_live(self, name, font):
+        """Checks that the pack <name> using <font> is installed."""
+        self.assertEqual(
+            os.listdir(os.path.join('df', 'raw', 'graphics')), [name + '.txt'])
+        self.assertEqual(os.listdir(os.path.join('df', 'data', 'art')), [font])
+        self.assertIn('[FONT:{0}]'.format(font), read_text(os.path.join(
+            'df', settings._init[0])))
+        self.assertEqual(
+            read_text(os.path.join('df', 'data', 'init', 'colors.txt')), name)
+
+    def test_install(self):
+        self.assertTrue(self.lnp.install_graphics('PackA'))
+        self.assert_live('PackA', 'a.png')
+        self.assertEqual(read_text(os.path.join(
+            'df', 'data', 'init', 'overrides.txt')), 'PackA')
+        self.assertEqual(
+            read_text(os.path.join('df', 'raw', 'objects', 'PackA.txt')), 'PackA')
+        self.assertTrue(self.lnp.install_graphics('PackB'))
+        self.assert_live('PackB', 'b.png')
+        self.assertEqual(self.errors, [])
+
+    def test_install_incomplete(self):
+        shutil.rmtree(os.path.join('LNP', 'Graphics', 'PackA', 'raw'))
+        self.assertIsNone(self.lnp.install_graphics('PackA'))
+        self.assertIsNone(self.lnp.install_graphics('Missing'))
+
+    def test_install_slots_not_linked(self):
+        # Staged trees are copies, so editing live files leaves slots alone
+        self.assertTrue(self.lnp.install_graphics('PackA'))
+        slot = self.lnp.pack_slots().rollback_slot()
+        self.assertFalse(os.path.samefile(
+            os.path.join('df', 'raw', 'graphics', 'PackA.txt'),
+            os.path.join('LNP', 'Graphics', 'PackA', 'raw', 'graphics',
+                         'PackA.txt')))
+        self.assertEqual(read_text(os.path.join(
+            slot, packslots.TREES[0], 'live.txt')), 'live')
+
+    def test_stage_copies_pack_only(self):
+        # Without reflinks, the live trees are not copied into the slot
+        write(os.path.join('df', 'data', 'art', 'big.png'), 'x' * 65536)
+        methods = fileops.METHODS
+        fileops.METHODS = [m for m in methods if m != 'reflink']
+        enabled = tracing.enabled
+        tracing.enable()
+        try:
+            pack = os.path.join('LNP', 'Graphics', 'PackA')
+            sources = [
+                self.lnp.load_manifest(os.path.join(pack, t))
+                for t in packslots.TREES]
+            slot = self.lnp.pack_slots().new_slot()
+            with tracing.span('stage', log=False) as span:
+                self.lnp.stage_pack(slot, sources)
+        finally:
+            tracing.enable(enabled)
+            fileops.METHODS = methods
+        self.assertEqual(span.nbytes, len('PackA') * 2)
+        self.assertEqual(
+            os.listdir(os.path.join(slot, 'data', 'art')), ['a.png'])
+
+    def test_failed_install(self):
+        def fail(*args, **kwargs):
+            """Fails patching the init files."""
+            raise IOError('Failed')
+        self.lnp.patch_inits = fail
+        self.assertFalse(self.lnp.install_graphics('PackA'))
+        self.assertEqual(len(self.errors), 1)
+        self.assertEqual(
+            os.listdir(os.path.join('df', 'raw', 'graphics')), ['live.txt'])
+        self.assertFalse(
+            os.path.exists(os.path.join('df', 'raw', 'objects', 'PackA.txt')))
+        self.assertEqual(
+            read_text(os.path.join('df', 'data', 'init', 'colors.txt')),
+            '[BLACK_R:0]')
+
+    def test_failed_cleanup(self):
+        # The pack is live once swapped in, even if cleaning up fails
+        evict = packslots.PackSlots.evict
+        def fail(self):
+            """Fails evicting slots."""
+            raise OSError('Failed')
+        packslots.PackSlots.evict = fail
+        try:
+            self.assertTrue(self.lnp.install_graphics('PackA'))
+        finally:
+            packslots.PackSlots.evict = evict
+        self.assertEqual(len(self.errors), 1)
+        self.assert_live('PackA', 'a.png')
+
+    def test_failed_dedup(self):
+        def fail(*paths):
+            """Fails sharing raw files."""
+            raise OSError('Failed')
+        self.lnp.dedup_raws = fail
+        self.lnp.userconfig['dedupRaws'] = True
+        self.assertTrue(self.lnp.install_graphics('PackA'))
+        self.assertEqual(len(self.errors), 1)
+        self.assert_live('PackA', 'a.png')
+
+    def test_undo(self):
+        self.assertIsNone(self.lnp.undo_graphics_install())
+        self.assertTrue(self.lnp.install_graphics('PackA'))
+        self.assertTrue(self.lnp.undo_graphics_install())
+        self.assertEqual(
+            os.listdir(os.path.join('df', 'raw', 'graphics')), ['live.txt'])
+        self.assertEqual(
+            os.listdir(os.path.join('df', 'data', 'art')), ['curses.png'])
+        self.assertIn('[FONT:curses.png]', read_text(os.path.join(
+            'df', settings._init[0])))
+        self.assertFalse(
+            os.path.exists(os.path.join('df', 'raw', 'objects', 'PackA.txt')))
+        self.assertFalse(os.path.exists(
+            os.path.join('df', 'data', 'init', 'overrides.txt')))
+        # Undoing again installs the pack again
+        self.assertTrue(self.lnp.undo_graphics_install())
+        self.assert_live('PackA', 'a.png')
+
+    def test_undo_keeps_option_changes(self):
+        # Changes not written yet when installing are part of the backup
+        self.lnp.set_option('popcap', '50')
+        self.assertTrue(self.lnp.install_graphics('PackA'))
+        self.assertTrue(self.lnp.undo_graphics_install())
+        self.assertIn('[POPULATION_CAP:50]', read_text(os.path.join(
+            'df', settings._dinit[0])))
+
+    def current_pack_output(self):
+        """Returns current_pack() and what it printed."""
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            return self.lnp.current_pack(), sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_current_pack_recorded(self):
+        self.assertTrue(self.lnp.install_graphics('PackA'))
+        record = self.lnp.installed_pack_record()
+        self.assertEqual(record['pack'], 'PackA')
+        self.assertEqual(
+            (record['font'], record['graphics_font']), ('a.png', 'a.png'))
+        self.assertIn(
+            os.path.join(packslots.TREES[0], 'PackA.txt'), record['check'])
+        # The pack is not identified by its fonts
+        self.lnp.pack_lookup = {}
+        self.assertEqual(self.current_pack_output(), ('PackA', ''))
+
+    def test_current_pack_drift(self):
+        self.assertTrue(self.lnp.install_graphics('PackA'))
+        self.lnp.pack_lookup = {}
+        edited = os.path.join('raw', 'graphics', 'PackA.txt')
+        write(os.path.join('df', edited), 'edited', 1000000000)
+        pack, output = self.current_pack_output()
+        self.assertEqual(pack, 'a.png/a.png')
+        self.assertIn('Graphics pack PackA was installed', output)
+        self.assertIn(edited, output)
+        # The same drift is only reported once
+        self.assertEqual(self.current_pack_output(), ('a.png/a.png', ''))
+
+    def test_current_pack_without_record(self):
+        self.assertTrue(self.lnp.install_graphics('PackA'))
+        live = os.path.join('df', 'PyLNP_slots', packslots.LIVE_FILE)
+        write(live, '{"pack": "Pa', 1000000000)
+        self.assertEqual(self.lnp.installed_pack_record(), {})
+        self.assertEqual(self.current_pack_output(), ('PackA', ''))
+        os.remove(live)
+        self.assertEqual(self.lnp.installed_pack_record(), {})
+        self.assertEqual(self.current_pack_output(), ('PackA', ''))
+        self.lnp.pack_lookup = {}
+        self.assertEqual(self.current_pack_output(), ('a.png/a.png', ''))
+
+    def test_pack_info(self):
+        header = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' +
+                  struct.pack(str('>II'), 256, 192))
+        with open(os.path.join(
+                'LNP', 'Graphics', 'PackA', 'data', 'art', 'a.png'), 'wb') as f:
+            f.write(header)
+        info = self.lnp.get_pack_info('PackA')
+        self.assertEqual(info['tile_size'], [16, 12])
+        self.assertEqual(info['files'], 9)
+        pack = os.path.join('LNP', 'Graphics', 'PackA')
+        self.assertEqual(info['bytes'], sum(
+            os.path.getsize(os.path.join(d, f))
+            for d, _, files in os.walk(pack) for f in files))
+        self.assertIsNone(self.lnp.get_pack_info('Missing'))
+
+    def test_simplify(self):
+        results = dict(self.lnp.simplify_graphics(True))
+        self.assertEqual(results, {'PackA': (2, 11), 'PackB': (2, 11)})
+        self.assertTrue(os.path.exists(
+            os.path.join('LNP', 'Graphics', 'PackA', 'readme.txt')))
+        results = dict(self.lnp.simplify_graphics())
+        self.assertEqual(results, {'PackA': (2, 11), 'PackB': (2, 11)})
+        self.assertEqual(
+            sorted(os.listdir(os.path.join('LNP', 'Graphics', 'PackA'))),
+            ['data', 'raw'])
+        self.assertTrue(self.lnp.install_graphics('PackA'))
+        self.assert_live('PackA', 'a.png')
+
+class SavegameTest(LNPTestCase):
+    """Tests for updating savegames."""
+    saves = ['region1', 'region2', 'region3']
+
+    def setUp(self):
+        super(SavegameTest, self).setUp()
+        write(os.path.join('df', 'raw', 'graphics', 'new.txt'), 'new')
+        for name in self.saves:
+            write(os.path.join('df', 'data', 'save', name, 'raw', 'graphics',
+                               'old.txt'), 'old')
+        self.lnp = self.make_lnp()
+        self.copy_tree = fileops.copy_tree
+        self.errors = []
+        self.excepthook = sys.excepthook
+        sys.excepthook = lambda *info: self.errors.append(
+            (info[1], threading.current_thread()))
+
+    def tearDown(self):
+        sys.excepthook = self.excepthook
+        fileops.copy_tree = self.copy_tree
+        lnp.SAVEGAME_WORKERS = 4
+        super(SavegameTest, self).tearDown()
+
+    def graphics(self, name):
+        """Returns the files in raw/graphics of the save <name>."""
+        return os.listdir(os.path.join(
+            'df', 'data', 'save', name, 'raw', 'graphics'))
+
+    def test_progress(self):
+        events = []
+        results = self.lnp.update_savegames(
+            lambda *args: events.append(args + (threading.current_thread(),)))
+        self.assertEqual(results, [(n, True) for n in self.saves])
+        self.assertEqual([e[:2] for e in events], [(1, 3), (2, 3), (3, 3)])
+        self.assertEqual(sorted(e[2] for e in events), self.saves)
+        self.assertEqual(set(e[4] for e in events), set(
+            [threading.current_thread()]))
+        for name in self.saves:
+            self.assertEqual(self.graphics(name), ['new.txt'])
+
+    def test_cancel(self):
+        # One worker, cancelled while updating the first save
+        cancel = threading.Event()
+        def copy_tree(*args):
+            """Copies a tree, then cancels the update."""
+            self.copy_tree(*args)
+            cancel.set()
+        fileops.copy_tree = copy_tree
+        lnp.SAVEGAME_WORKERS = 1
+        events = []
+        results = self.lnp.update_savegames(
+            lambda *args: events.append(args), cancel)
+        self.assertEqual(
+            results, [('region1', True), ('region2', None), ('region3', None)])
+        self.assertEqual(events, [
+            (1, 3, 'region1', True), (2, 3, 'region2', None),
+            (3, 3, 'region3', None)])
+        self.assertEqual(self.graphics('region1'), ['new.txt'])
+        self.assertEqual(self.graphics('region2'), ['old.txt'])
+
+    def test_worker_error(self):
+        def copy_tree(source, target):
+            """Fails copying to the second save."""
+            if 'region2' in target:
+                raise IOError('Failed')
+            self.copy_tree(source, target)
+        fileops.copy_tree = copy_tree
+        results = self.lnp.update_savegames()
+        self.assertEqual(results, [
+            ('region1', True), ('region2', False), ('region3', True)])
+        # Reported by the calling thread
+        self.assertEqual(len(self.errors), 1)
+        self.assertEqual(str(self.errors[0][0]), 'Failed')
+        self.assertIs(self.errors[0][1], threading.current_thread())
+
+    def test_progress_error(self):
+        def progress(*args):
+            """Fails handling progress."""
+            raise ValueError('Failed')
+        self.assertRaises(ValueError, self.lnp.update_savegames, progress)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab
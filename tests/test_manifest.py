@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for manifest."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+from helpers import read, write
+from manifest import Manifest, SyncReport, sync_tree
+
+class ManifestTest(unittest.TestCase):
+    """Tests for Manifest."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_scan(self):
+        write(os.path.join(self.root, 'a', 'b.txt'), b'abc')
+        m = Manifest.scan(self.root)
+        self.assertEqual(list(m.entries), [os.path.join('a', 'b.txt')])
+        self.assertEqual(m.entries[os.path.join('a', 'b.txt')][0], 3)
+        self.assertEqual(m.directories, set(['a']))
+
+    def test_hash_reused(self):
+        write(os.path.join(self.root, 'a.txt'), b'abc')
+        first = Manifest.scan(self.root)
+        first.hash('a.txt')
+        first.entries['a.txt'][2] = 'cached'
+        self.assertEqual(Manifest.scan(self.root, first).hash('a.txt'),
+                         'cached')
+
+    def test_hash_not_reused_after_rewrite(self):
+        path = os.path.join(self.root, 'a.txt')
+        write(path, b'abc', 1000000000)
+        first = Manifest.scan(self.root)
+        digest = first.hash('a.txt')
+        time.sleep(0.05)
+        # Same size and modification time, different contents
+        write(path, b'xyz', 1000000000)
+        second = Manifest.scan(self.root, first.entries)
+        if second.entries['a.txt'][3] == first.entries['a.txt'][3]:
+            self.skipTest('change time resolution too coarse')
+        self.assertNotEqual(second.hash('a.txt'), digest)
+
+    def test_digest(self):
+        write(os.path.join(self.root, 'a.txt'), b'abc', 1000000000)
+        digest = Manifest.scan(self.root).digest()
+        self.assertEqual(Manifest.scan(self.root).digest(), digest)
+        write(os.path.join(self.root, 'a.txt'), b'abc', 1000000001)
+        self.assertNotEqual(Manifest.scan(self.root).digest(), digest)
+
+class SyncTreeTest(unittest.TestCase):
+    """Tests for sync_tree."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, 'source')
+        self.target = os.path.join(self.root, 'target')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def src(self, relative, data, mtime=1000000000):
+        """Writes a file in the source folder."""
+        write(os.path.join(self.source, relative), data, mtime)
+
+    def dst(self, relative, data, mtime=1000000000):
+        """Writes a file in the target folder."""
+        write(os.path.join(self.target, relative), data, mtime)
+
+    def test_copy_new(self):
+        self.src(os.path.join('d', 'a.txt'), b'abc')
+        report, _, dst = sync_tree(self.source, self.target)
+        self.assertEqual(
+            read(os.path.join(self.target, 'd', 'a.txt')), b'abc')
+        self.assertEqual((report.copied, report.copied_bytes), (1, 3))
+        self.assertEqual(report.added, [os.path.join('d', 'a.txt')])
+        self.assertIn(os.path.join('d', 'a.txt'), dst.entries)
+
+    def test_unchanged(self):
+        self.src('a.txt', b'abc')
+        self.dst('a.txt', b'abc')
+        report, _, _ = sync_tree(self.source, self.target)
+        self.assertEqual((report.copied, report.unchanged), (0, 1))
+
+    def test_same_contents_different_time(self):
+        self.src('a.txt', b'abc', 1000000000)
+        self.dst('a.txt', b'abc', 1000000005)
+        report, _, dst = sync_tree(self.source, self.target)
+        self.assertEqual((report.copied, report.unchanged), (0, 1))
+        # The times now match, so no hash is needed next time
+        self.assertEqual(
+            os.stat(os.path.join(self.target, 'a.txt')).st_mtime, 1000000000)
+        self.assertEqual(dst.entries['a.txt'][1], 1000000000)
+
+    def test_changed_contents(self):
+        self.src('a.txt', b'abc', 1000000000)
+        self.dst('a.txt', b'xyz', 1000000005)
+        report, _, _ = sync_tree(self.source, self.target)
+        self.assertEqual(report.copied, 1)
+        self.assertEqual(report.added, [])
+        self.assertEqual(read(os.path.join(self.target, 'a.txt')), b'abc')
+
+    def test_delete(self):
+        self.src('a.txt', b'abc')
+        self.dst(os.path.join('old', 'b.txt'), b'b')
+        report, _, _ = sync_tree(self.source, self.target)
+        self.assertEqual(report.removed, 1)
+        self.assertFalse(os.path.exists(os.path.join(self.target, 'old')))
+
+    def test_delete_limited(self):
+        self.src('a.txt', b'abc')
+        self.dst(os.path.join('x', 'b.txt'), b'b')
+        self.dst(os.path.join('y', 'c.txt'), b'c')
+        sync_tree(self.source, self.target, delete=('x',))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.target, 'x', 'b.txt')))
+        self.assertTrue(
+            os.path.exists(os.path.join(self.target, 'y', 'c.txt')))
+
+    def test_exclude(self):
+        self.src(os.path.join('keep', 'a.txt'), b'new')
+        self.dst(os.path.join('keep', 'a.txt'), b'old')
+        self.dst(os.path.join('keep', 'b.txt'), b'b')
+        report, _, _ = sync_tree(self.source, self.target, exclude=('keep',))
+        self.assertEqual((report.copied, report.removed), (0, 0))
+        self.assertEqual(
+            read(os.path.join(self.target, 'keep', 'a.txt')), b'old')
+
+    def test_backup(self):
+        backup = os.path.join(self.root, 'backup')
+        self.src('a.txt', b'new', 1000000005)
+        self.dst('a.txt', b'old')
+        self.dst('b.txt', b'b')
+        sync_tree(self.source, self.target, backup=backup)
+        self.assertEqual(read(os.path.join(backup, 'a.txt')), b'old')
+        self.assertEqual(read(os.path.join(backup, 'b.txt')), b'b')
+        self.assertEqual(read(os.path.join(self.target, 'a.txt')), b'new')
+        self.assertFalse(os.path.exists(os.path.join(self.target, 'b.txt')))
+
+    def test_partial_sync_reports_added(self):
+        self.src('a.txt', b'abc')
+        self.src('b.txt', b'def')
+        os.makedirs(os.path.join(self.target, 'b.txt'))
+        report = SyncReport()
+        self.assertRaises(
+            EnvironmentError, sync_tree, self.source, self.target,
+            report=report)
+        self.assertIn('a.txt', report.added)
+
+    def test_missing_source(self):
+        self.assertRaises(IOError, sync_tree, self.source, self.target)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for packarchive."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import gzip
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+from helpers import read
+from packarchive import MARKER, PackArchive, member_path
+
+class MemberPathTest(unittest.TestCase):
+    """Tests for member_path."""
+    def test_safe(self):
+        self.assertEqual(
+            member_path('Pack/data/init/init.txt'), 'Pack/data/init/init.txt')
+        self.assertEqual(
+            member_path('Pack\\raw\\a.txt'), 'Pack/raw/a.txt')
+
+    def test_unsafe(self):
+        for name in (
+                '/etc/passwd', '../a.txt', 'raw/../../a.txt',
+                '..\\a.txt', 'C:\\a.txt', 'C:/a.txt', 'C:a.txt',
+                '\\\\server\\share\\a.txt', '\\a.txt', 'raw/a.txt:stream'):
+            self.assertIsNone(member_path(name), name)
+
+class PackArchiveTest(unittest.TestCase):
+    """Tests for PackArchive."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'pack.zip')
+        self.target = os.path.join(self.root, 'df')
+        with zipfile.ZipFile(self.path, 'w') as z:
+            z.writestr('Pack/data/init/init.txt', b'[FONT:a.png]')
+            z.writestr('Pack/raw/objects/a.txt', b'new')
+            z.writestr('Pack/raw/objects/b.txt', b'added')
+            z.writestr('Pack\\raw\\objects\\c.txt', b'backslash')
+            z.writestr('Pack/../evil.txt', b'evil')
+            z.writestr('C:\\evil.txt', b'evil')
+            z.writestr('/evil.txt', b'evil')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_members(self):
+        with PackArchive(self.path) as archive:
+            self.assertEqual(archive.prefix, 'Pack/')
+            self.assertEqual(sorted(archive.members), [
+                'data/init/init.txt', 'raw/objects/a.txt',
+                'raw/objects/b.txt', 'raw/objects/c.txt'])
+
+    def test_extract(self):
+        with PackArchive(self.path) as archive:
+            archive.extract(self.target, lambda r: True)
+        self.assertEqual(read(os.path.join(
+            self.target, 'raw', 'objects', 'c.txt')), b'backslash')
+        self.assertEqual(
+            sorted(os.listdir(self.root)), ['df', 'pack.zip'])
+
+    def test_sync(self):
+        old = os.path.join(self.target, 'raw', 'objects', 'a.txt')
+        os.makedirs(os.path.dirname(old))
+        with open(old, 'wb') as f:
+            f.write(b'old')
+        os.utime(old, (1000000000, 1000000000))
+        backup = os.path.join(self.root, 'backup')
+        with PackArchive(self.path) as archive:
+            report = archive.sync(
+                self.target, lambda r: r.startswith('raw/'), backup)
+        self.assertEqual(read(old), b'new')
+        self.assertEqual(read(os.path.join(
+            backup, 'raw', 'objects', 'a.txt')), b'old')
+        self.assertEqual(sorted(report.added), [
+            os.path.join('raw', 'objects', 'b.txt'),
+            os.path.join('raw', 'objects', 'c.txt')])
+        self.assertEqual(report.copied, 3)
+        # Unchanged files are not written again
+        with PackArchive(self.path) as archive:
+            report = archive.sync(self.target, lambda r: r.startswith('raw/'))
+        self.assertEqual((report.copied, report.unchanged), (0, 3))
+
+    def test_compressed_tar(self):
+        path = os.path.join(self.root, 'pack.tar.gz')
+        with tarfile.open(path, 'w:gz') as t:
+            for name, data in ((MARKER, b'[FONT:a.png]'),
+                               ('raw/objects/a.txt', b'a')):
+                info = tarfile.TarInfo('Pack/' + name)
+                info.size = len(data)
+                t.addfile(info, io.BytesIO(data))
+        with PackArchive(path) as archive:
+            # Read from the compressed stream, without a decompressed copy
+            self.assertTrue(isinstance(archive.tar.fileobj, gzip.GzipFile))
+            self.assertEqual(sorted(archive.members), [
+                MARKER, 'raw/objects/a.txt'])
+            self.assertEqual(archive.read('raw/objects/a.txt'), b'a')
+            self.assertEqual(archive.read(MARKER), b'[FONT:a.png]')
+            self.assertEqual(archive.read_files(lambda r: True), {
+                MARKER: b'[FONT:a.png]', 'raw/objects/a.txt': b'a'})
+            archive.extract(self.target, lambda r: r.startswith('raw/'))
+        self.assertEqual(read(os.path.join(
+            self.target, 'raw', 'objects', 'a.txt')), b'a')
+        self.assertEqual(
+            sorted(os.listdir(self.root)), ['df', 'pack.tar.gz', 'pack.zip'])
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab
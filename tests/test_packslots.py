@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for packslots."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+import fileops
+import packslots
+from helpers import read, write
+from manifest import sync_tree
+from packslots import PackSlots
+
+GRAPHICS = packslots.TREES[0]
+
+class PackSlotsTest(unittest.TestCase):
+    """Tests for PackSlots."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.slots = PackSlots(self.root)
+        self.live = os.path.join(self.root, GRAPHICS, 'a.txt')
+        write(self.live, b'live', 1000000000)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_swap(self):
+        incoming = self.slots.new_slot()
+        write(os.path.join(incoming, GRAPHICS, 'a.txt'), b'new')
+        outgoing = self.slots.new_slot()
+        self.slots.swap(incoming, outgoing)
+        self.assertEqual(read(self.live), b'new')
+        self.assertEqual(
+            read(os.path.join(outgoing, GRAPHICS, 'a.txt')), b'live')
+
+    def test_restore(self):
+        slot = self.slots.new_slot()
+        self.slots.write_info(slot, {'added': ['b.txt']})
+        write(os.path.join(slot, packslots.BACKUP_DIR, 'c.txt'), b'old')
+        write(os.path.join(self.root, 'b.txt'), b'added')
+        write(os.path.join(self.root, 'c.txt'), b'changed')
+        outgoing = self.slots.new_slot()
+        self.assertEqual(self.slots.restore(slot, outgoing), [])
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'b.txt')))
+        self.assertEqual(read(os.path.join(self.root, 'c.txt')), b'old')
+        self.assertEqual(read(os.path.join(
+            outgoing, packslots.BACKUP_DIR, 'c.txt')), b'changed')
+
+    def test_evict_keeps_rollback(self):
+        rollback = self.slots.new_slot()
+        self.slots.write_info(rollback, {'used': 1})
+        self.slots.set_rollback(rollback)
+        other = self.slots.new_slot()
+        self.slots.write_info(other, {'used': 2})
+        self.assertEqual(self.slots.evict(), 1)
+        self.assertEqual(self.slots.rollback_slot(), rollback)
+
+    def test_live_info(self):
+        self.assertEqual(self.slots.live_info(), {})
+        self.slots.write_live_info({'pack': 'PackA', 'stamp': 'x'})
+        self.assertEqual(
+            self.slots.live_info(), {'pack': 'PackA', 'stamp': 'x'})
+        write(os.path.join(self.slots.root, packslots.LIVE_FILE), '{"pack"')
+        self.assertEqual(self.slots.live_info(), {})
+
+    def test_fingerprint(self):
+        live = os.path.join(GRAPHICS, 'a.txt')
+        result = self.slots.fingerprint([live, 'missing.txt'])
+        self.assertEqual(result, {live: [4, 1000000000], 'missing.txt': None})
+
+    def test_verify(self):
+        other = os.path.join(GRAPHICS, 'b.txt')
+        write(os.path.join(self.root, other), b'other', 1000000000)
+        paths = [GRAPHICS, os.path.join(GRAPHICS, 'a.txt'), other]
+        info = {'check': self.slots.fingerprint(paths)}
+        self.assertEqual(self.slots.verify(info), [])
+        self.assertEqual(self.slots.verify({}), [])
+        # Changed in place, with the same size
+        write(self.live, b'edit', 1000000005)
+        self.assertEqual(self.slots.verify(info), [paths[1]])
+        # Removing a file also changes the tree
+        os.remove(os.path.join(self.root, other))
+        self.assertEqual(self.slots.verify(info), sorted(paths))
+
+    def test_staged_copy_leaves_live_files(self):
+        # A slot is staged as a copy of the live trees, then updated from a
+        # pack; the live files must not change, including their times
+        pack = os.path.join(self.root, 'pack')
+        write(os.path.join(pack, 'a.txt'), b'live', 1000000005)
+        write(os.path.join(pack, 'b.txt'), b'pack', 1000000005)
+        write(os.path.join(self.root, GRAPHICS, 'b.txt'), b'xxxx')
+        slot = self.slots.new_slot()
+        target = os.path.join(slot, GRAPHICS)
+        fileops.copy_tree(os.path.join(self.root, GRAPHICS), target)
+        self.assertFalse(os.path.samefile(
+            os.path.join(target, 'a.txt'), self.live))
+        sync_tree(pack, target, True, link=True)
+        self.assertEqual(read(os.path.join(target, 'b.txt')), b'pack')
+        self.assertEqual(
+            read(os.path.join(self.root, GRAPHICS, 'b.txt')), b'xxxx')
+        self.assertEqual(os.stat(self.live).st_mtime, 1000000000)
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for rawindex."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+from helpers import write
+from rawindex import RawIndex
+
+class RawIndexTest(unittest.TestCase):
+    """Tests for RawIndex."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.raw_dir = os.path.join(self.root, 'objects')
+        self.stone = os.path.join(self.raw_dir, 'stone.txt')
+        write(self.stone, b'[INORGANIC:SAND]\n!AQUIFER!\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_adjacent_disabled_tokens(self):
+        # Including tokens sharing the ! between them
+        write(self.stone, b'!SOIL!!AQUIFER!OCEAN!\n[AQUIFER][SAND]!LAVA!')
+        tokens, flags = RawIndex.scan(self.stone, ['AQUIFER'])
+        self.assertEqual(
+            tokens, ['AQUIFER', 'LAVA', 'OCEAN', 'SAND', 'SOIL'])
+        self.assertEqual(flags, {'AQUIFER': [6, 22]})
+
+    def test_stored(self):
+        index_file = os.path.join(self.root, 'index.json')
+        index = RawIndex(self.raw_dir, index_file, ['AQUIFER'])
+        self.assertEqual(index.files_with('AQUIFER'), (self.stone,))
+        self.assertEqual(index.flag_offsets(self.stone, 'AQUIFER'), [17])
+        stored = RawIndex(self.raw_dir, index_file, ['AQUIFER'])
+        self.assertEqual(stored.files, index.files)
+        self.assertFalse(stored.refresh())
+
+    def test_file_removed_while_refreshing(self):
+        index = RawIndex(self.raw_dir, None, ['AQUIFER'])
+        other = os.path.join(self.raw_dir, 'other.txt')
+        write(other, b'[AQUIFER]')
+        listdir = os.listdir
+        def removing_listdir(path):
+            """Lists <path>, then removes a listed file."""
+            result = listdir(path)
+            os.remove(self.stone)
+            return result
+        os.listdir = removing_listdir
+        try:
+            self.assertTrue(index.refresh())
+        finally:
+            os.listdir = listdir
+        self.assertEqual(list(index.files), ['other.txt'])
+        self.assertEqual(index.files_with('AQUIFER'), (other,))
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab
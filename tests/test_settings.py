@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for settings."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+import settings
+from helpers import STONE, make_df, read_text, write
+from settings import (
+    DFConfiguration, TokenCache, TokenIndex, _splice, file_cache)
+
+class SpliceTest(unittest.TestCase):
+    """Tests for _splice."""
+    def test_no_edits(self):
+        self.assertEqual(_splice('abc', []), 'abc')
+
+    def test_edits_in_any_order(self):
+        text = '[A:1][B:22][C:3]'
+        self.assertEqual(
+            _splice(text, [(14, 15, 'x'), (3, 4, 'yyy'), (8, 10, '')]),
+            '[A:yyy][B:][C:x]')
+
+    def test_edits_at_ends(self):
+        self.assertEqual(_splice('abcd', [(0, 1, 'X'), (3, 4, 'Y')]), 'XbcY')
+
+class TokenCacheTest(unittest.TestCase):
+    """Tests for TokenCache."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = TokenCache(2)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def file(self, name, text, mtime=1000000000):
+        """Writes a file with the given modification time."""
+        path = os.path.join(self.root, name)
+        write(path, text)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_hit(self):
+        path = self.file('a.txt', '[A:1]')
+        first = self.cache.get(path)
+        self.assertEqual(first.get('A'), '1')
+        self.assertIs(self.cache.get(path), first)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_changed_size(self):
+        path = self.file('a.txt', '[A:1]')
+        self.cache.get(path)
+        self.file('a.txt', '[A:22]')
+        self.assertEqual(self.cache.get(path).get('A'), '22')
+
+    def test_changed_mtime(self):
+        path = self.file('a.txt', '[A:1]')
+        self.cache.get(path)
+        self.file('a.txt', '[A:2]', 1000000001)
+        self.assertEqual(self.cache.get(path).get('A'), '2')
+
+    def test_store(self):
+        path = self.file('a.txt', '[A:1]')
+        self.cache.get(path)
+        write(path, '[A:2]')
+        index = TokenIndex('[A:2]')
+        self.cache.store(path, index)
+        self.assertIs(self.cache.get(path), index)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_eviction(self):
+        paths = [self.file(n, '[A:1]') for n in ('a.txt', 'b.txt', 'c.txt')]
+        self.cache.get(paths[0])
+        self.cache.get(paths[1])
+        self.cache.get(paths[0])
+        self.cache.get(paths[2])
+        # b.txt was least recently used
+        self.assertEqual(
+            sorted(os.path.basename(k) for k in self.cache.entries),
+            ['a.txt', 'c.txt'])
+
+    def test_invalidate(self):
+        path = self.file('a.txt', '[A:1]')
+        self.cache.get(path)
+        self.cache.invalidate(path)
+        self.cache.get(path)
+        self.assertEqual(self.cache.misses, 2)
+        self.cache.invalidate()
+        self.assertEqual(len(self.cache.entries), 0)
+
+    def test_missing(self):
+        self.assertRaises(
+            IOError, self.cache.get, os.path.join(self.root, 'missing.txt'))
+
+class WriteSettingsTest(unittest.TestCase):
+    """Tests for DFConfiguration.write_settings."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        make_df(self.root)
+        file_cache.invalidate()
+        self.config = DFConfiguration(self.root)
+        self.config.read_settings()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, relative):
+        """Returns the full path of a file in the DF folder."""
+        return os.path.join(self.root, relative)
+
+    def test_only_changed_files_written(self):
+        init = self.path(settings._init[0])
+        os.utime(init, (1000000000, 1000000000))
+        self.config.set_value('popcap', '50')
+        self.config.write_settings()
+        self.assertIn(
+            '[POPULATION_CAP:50]', read_text(self.path(settings._dinit[0])))
+        self.assertEqual(os.stat(init).st_mtime, 1000000000)
+        init_text = read_text(init)
+        self.config.set_value('sound', 'NO')
+        self.config.write_settings()
+        self.assertEqual(
+            read_text(init), init_text.replace('[SOUND:YES]', '[SOUND:NO]'))
+        self.assertFalse(self.config.dirty)
+
+    def test_raw_option(self):
+        self.assertEqual(self.config.aquifers, 'NO')
+        self.config.set_value('aquifers', 'YES')
+        self.config.write_settings()
+        self.assertIn('[AQUIFER]', read_text(self.path(STONE)))
+
+    def test_raws_replaced(self):
+        self.assertEqual(self.config.aquifers, 'NO')
+        # A graphics pack install replaces the raw file
+        write(self.path(STONE), '[INORGANIC:SAND]\n[AQUIFER]\n')
+        self.config.raws_replaced()
+        self.config.write_settings()
+        self.assertIn('!AQUIFER!', read_text(self.path(STONE)))
+        self.assertEqual(self.config.aquifers, 'NO')
+
+    def test_raws_replaced_before_read(self):
+        config = DFConfiguration(self.root)
+        config.read_settings(True)
+        write(self.path(STONE), '[INORGANIC:SAND]\n[AQUIFER]\n')
+        config.raws_replaced()
+        config.write_settings()
+        # Not read before the files were replaced, so read from the new files
+        self.assertEqual(config.aquifers, 'YES')
+        self.assertIn('[AQUIFER]', read_text(self.path(STONE)))
+
+    def test_change_while_writing(self):
+        write_file = self.config.write_file
+        written = []
+
+        def change_and_write(filename, fields, values=None):
+            """Changes an option from another thread while writing."""
+            if not written:
+                t = threading.Thread(
+                    target=self.config.set_value, args=('popcap', '77'))
+                t.start()
+                t.join()
+            written.append(dict(values))
+            write_file(filename, fields, values)
+
+        self.config.write_file = change_and_write
+        self.config.set_value('popcap', '50')
+        self.config.write_settings()
+        # The value taken when the write started is written; the change is
+        # left for the next write
+        self.assertEqual(written, [{'popcap': '50'}])
+        self.assertEqual(self.config.dirty, set(['popcap']))
+        self.config.write_settings()
+        self.assertIn(
+            '[POPULATION_CAP:77]', read_text(self.path(settings._dinit[0])))
+
+class PatchFieldsTest(unittest.TestCase):
+    """Tests for patch_fields."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.pack = os.path.join(self.root, 'pack')
+        self.df = os.path.join(self.root, 'df')
+        make_df(self.pack)
+        make_df(self.df)
+        self.init = os.path.join(self.df, settings._init[0])
+        write(self.init, read_text(self.init) + '[FONT:df.png]\n')
+        file_cache.invalidate()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def patch(self, init):
+        """Sets the init.txt of the pack to <init> and patches the DF folder
+        from it. Returns the patched init.txt."""
+        write(os.path.join(self.pack, settings._init[0]), init)
+        settings.patch_fields(self.pack, self.df)
+        return read_text(self.init)
+
+    def test_changed_fields(self):
+        text = self.patch('[FONT:pack.png]\n[SOUND:NO]\n')
+        self.assertIn('[FONT:pack.png]', text)
+        self.assertIn('[SOUND:YES]', text)
+
+    def test_force_bool(self):
+        self.assertIn('[TRUETYPE:NO]', self.patch('[TRUETYPE:NO]\n'))
+        self.assertIn('[TRUETYPE:YES]', self.patch('[TRUETYPE:12]\n'))
+
+    def test_read(self):
+        write(os.path.join(self.pack, settings._init[0]), '[FONT:dir.png]')
+        settings.patch_fields(
+            self.pack, self.df, read=lambda r: '[FONT:archive.png]')
+        self.assertIn('[FONT:archive.png]', read_text(self.init))
+
+class RelativeTest(unittest.TestCase):
+    """Tests for DFConfiguration.relative."""
+    def test_relative(self):
+        config = DFConfiguration(os.path.abspath('df'))
+        self.assertEqual(
+            config.relative(os.path.join(config.base_dir, 'data', 'a.txt')),
+            os.path.join('data', 'a.txt'))
+        self.assertEqual(
+            os.path.normpath(config.path(config.relative('b.txt'))),
+            os.path.abspath('b.txt'))
+
+    def test_other_drive(self):
+        config = DFConfiguration(os.path.abspath('df'))
+        relpath = os.path.relpath
+
+        def fail(path, start=None):
+            """Fails like relpath on Windows for another drive."""
+            raise ValueError('path is on mount D:, start on mount C:')
+
+        os.path.relpath = fail
+        try:
+            self.assertEqual(
+                config.relative('other.txt'), os.path.abspath('other.txt'))
+        finally:
+            os.path.relpath = relpath
+
+class AttributeTest(unittest.TestCase):
+    """Tests for reading options as attributes of DFConfiguration."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        make_df(self.root)
+        write(os.path.join(self.root, settings._init[0]), '[SOUND:NO]\n')
+        file_cache.invalidate()
+        self.config = DFConfiguration(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_name_and_field_name(self):
+        self.config.read_settings(True)
+        self.assertEqual(self.config.sound, 'NO')
+        self.assertEqual(self.config.SOUND, 'NO')
+        self.assertEqual(self.config.__dict__['sound'], 'NO')
+        self.config.set_value('SOUND', 'YES')
+        self.assertEqual(self.config.sound, 'YES')
+        self.assertEqual(self.config.SOUND, 'YES')
+
+    def test_published_once_read(self):
+        self.config.read_settings(True)
+        self.assertNotIn('sound', self.config.__dict__)
+        self.assertNotIn('popcap', self.config.__dict__)
+        self.assertEqual(self.config.sound, 'NO')
+        self.assertIn('SOUND', self.config.__dict__)
+        self.assertNotIn('popcap', self.config.__dict__)
+
+    def test_missing(self):
+        self.config.read_settings()
+        self.assertRaises(AttributeError, getattr, self.config, 'missing')
+        self.assertFalse(hasattr(self.config, 'missing'))
+        self.assertEqual(getattr(self.config, 'missing', 'default'), 'default')
+
+class RawOptionTest(unittest.TestCase):
+    """Tests for options stored in raw files."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        make_df(self.root)
+        file_cache.invalidate()
+        self.cache = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.cache, 'index', 'raw.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.cache)
+
+    def test_index_built_on_first_use(self):
+        config = DFConfiguration(self.root, self.index_file)
+        config.read_settings(True)
+        self.assertIsNone(config.raw_index)
+        self.assertFalse(os.path.exists(self.index_file))
+        self.assertEqual(config.sound, 'YES')
+        self.assertIsNone(config.raw_index)
+        self.assertEqual(config.aquifers, 'NO')
+        self.assertTrue(os.path.exists(self.index_file))
+        self.assertEqual(config.options['aquifers'].files, (STONE,))
+
+    def test_is_loaded(self):
+        config = DFConfiguration(self.root, self.index_file)
+        config.read_settings(True)
+        self.assertFalse(config.is_loaded('sound'))
+        self.assertFalse(config.is_loaded('aquifers'))
+        self.assertEqual(config.sound, 'YES')
+        self.assertTrue(config.is_loaded('SOUND'))
+        self.assertFalse(config.is_loaded('aquifers'))
+        self.assertIsNone(config.raw_index)
+        self.assertEqual(config.aquifers, 'NO')
+        self.assertTrue(config.is_loaded('aquifers'))
+
+    def test_eager_read(self):
+        write(os.path.join(self.root, STONE), '[AQUIFER]\n')
+        config = DFConfiguration(self.root, self.index_file)
+        config.read_settings()
+        self.assertFalse(config.unloaded)
+        self.assertFalse(config.raw_pending)
+        self.assertEqual(config.aquifers, 'YES')
+
+    def test_files_added(self):
+        config = DFConfiguration(self.root, self.index_file)
+        config.read_settings()
+        config.set_value('aquifers', 'YES')
+        config.write_settings()
+        added = os.path.join('raw', 'objects', 'inorganic_other.txt')
+        write(os.path.join(self.root, added), '!AQUIFER!\n')
+        config.raws_replaced()
+        self.assertEqual(config.aquifers, 'YES')
+        self.assertEqual(
+            sorted(config.options['aquifers'].files), [added, STONE])
+        config.write_settings()
+        self.assertEqual(
+            read_text(os.path.join(self.root, added)), '[AQUIFER]\n')
+
+    def test_aquifers_in_any_raw_file(self):
+        # Not only the stone layer files: every file using the token
+        other = os.path.join('raw', 'objects', 'inorganic_other.txt')
+        plain = os.path.join('raw', 'objects', 'creature_standard.txt')
+        write(os.path.join(self.root, other), '[INORGANIC:X]\n!AQUIFER!\n')
+        write(os.path.join(self.root, plain), '[CREATURE:DOG]\n')
+        config = DFConfiguration(self.root, self.index_file)
+        config.read_settings()
+        self.assertEqual(
+            sorted(config.options['aquifers'].files), [other, STONE])
+        config.set_value('aquifers', 'YES')
+        config.write_settings()
+        self.assertIn('[AQUIFER]', read_text(os.path.join(self.root, other)))
+        self.assertEqual(
+            read_text(os.path.join(self.root, plain)), '[CREATURE:DOG]\n')
+        # The names of the tokens in each file are stored, with the offsets
+        # of the raw options' flags
+        with open(self.index_file) as f:
+            files = json.load(f)['files']
+        self.assertEqual(
+            files['inorganic_other.txt']['tokens'], ['AQUIFER', 'INORGANIC'])
+        self.assertEqual(
+            files['inorganic_other.txt']['flags'], {'AQUIFER': [14]})
+        self.assertEqual(files['creature_standard.txt']['flags'], {})
+        self.assertEqual(os.listdir(self.cache), ['index'])
+
+    def test_flags_read_at_offsets(self):
+        config = DFConfiguration(self.root, self.index_file)
+        config.read_settings()
+        stone = os.path.join(self.root, STONE)
+        self.assertEqual(config.raw_offsets(stone, 'AQUIFER'), [17])
+        scans = []
+        flag_re = settings._flag_re
+        settings._flag_re = lambda name: scans.append(name) or flag_re(name)
+        try:
+            config.set_value('aquifers', 'YES')
+            config.write_settings()
+            # Written in place, so the offsets still apply
+            self.assertEqual(config.raw_offsets(stone, 'AQUIFER'), [17])
+            config.read_settings()
+            self.assertEqual(config.aquifers, 'YES')
+        finally:
+            settings._flag_re = flag_re
+        self.assertEqual(scans, [])
+        self.assertEqual(read_text(stone), '[INORGANIC:SAND]\n[AQUIFER]\n')
+
+    def test_stale_offsets(self):
+        config = DFConfiguration(self.root, self.index_file)
+        config.read_settings()
+        stone = os.path.join(self.root, STONE)
+        self.assertFalse(settings.raw_flag_enabled(stone, 'AQUIFER', [0]))
+        settings.set_raw_flag(stone, 'AQUIFER', True, [0])
+        self.assertEqual(read_text(stone), '[INORGANIC:SAND]\n[AQUIFER]\n')
+
+    def test_refreshed_once_per_read(self):
+        config = DFConfiguration(self.root, self.index_file)
+        config.read_settings()
+        refreshes = []
+        refresh = config.raw_index.refresh
+        config.raw_index.refresh = lambda: refreshes.append(1) or refresh()
+        config.read_settings()
+        config.set_value('aquifers', 'YES')
+        config.write_settings()
+        self.assertEqual(config.aquifers, 'YES')
+        self.assertEqual(refreshes, [1])
+        config.raws_replaced()
+        self.assertEqual(config.aquifers, 'YES')
+        self.assertEqual(refreshes, [1, 1])
+
+    def test_lazy_read_error(self):
+        config = DFConfiguration(self.root, self.index_file)
+        config.read_settings(True)
+        os.remove(os.path.join(self.root, settings._dinit[0]))
+        reported = []
+        excepthook = sys.excepthook
+        sys.excepthook = lambda *args: reported.append(args[0])
+        try:
+            self.assertEqual(config.popcap, '200')
+            self.assertEqual(config.popcap, '200')
+        finally:
+            sys.excepthook = excepthook
+        self.assertEqual(len(reported), 1)
+        self.assertTrue(issubclass(reported[0], IOError))
+        self.assertEqual(config.sound, 'YES')
+
+    def test_reread(self):
+        config = DFConfiguration(self.root, self.index_file)
+        config.read_settings()
+        self.assertEqual(config.aquifers, 'NO')
+        write(os.path.join(self.root, STONE), '[AQUIFER]\n')
+        config.read_settings(True)
+        self.assertEqual(config.aquifers, 'YES')
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for tracing."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+import tracing
+
+@tracing.traced(log=False)
+def traced_function(value):
+    """Returns <value>, or raises it if it is an exception."""
+    tracing.add_io(5)
+    if isinstance(value, Exception):
+        raise value
+    return value
+
+class TracingTest(unittest.TestCase):
+    """Tests for tracing."""
+    def setUp(self):
+        self.enabled = tracing.enabled
+        tracing.reset()
+        tracing.enable()
+
+    def tearDown(self):
+        tracing.enable(self.enabled)
+        tracing.reset()
+
+    @staticmethod
+    def output(func, *args):
+        """Returns what func(*args) printed."""
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            func(*args)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_disabled(self):
+        tracing.enable(False)
+        self.assertIs(tracing.span('op'), tracing._null_span)
+        with tracing.span('op') as span:
+            self.assertIsInstance(span, tracing._NullSpan)
+            tracing.add_io(10)
+        self.assertEqual(traced_function(1), 1)
+        self.assertEqual(tracing.stats, {})
+        self.assertEqual(list(tracing.events), [])
+        self.assertEqual(tracing.report(), 'No operations traced.\n')
+
+    def test_nesting(self):
+        with tracing.span('outer', log=False, pack='PackA') as outer:
+            tracing.add_io(10)
+            with tracing.span('inner', log=False) as inner:
+                tracing.add_io(5, 2)
+        self.assertEqual((outer.nbytes, outer.files), (15, 3))
+        self.assertEqual((inner.nbytes, inner.files), (5, 2))
+        inner_event, outer_event = tracing.events
+        for event, name in ((inner_event, 'inner'), (outer_event, 'outer')):
+            self.assertEqual(event['name'], name)
+            self.assertEqual(event['ph'], 'X')
+            self.assertEqual(event['pid'], os.getpid())
+            self.assertEqual(event['tid'], threading.current_thread().ident)
+            self.assertGreaterEqual(event['dur'], 0)
+            self.assertIn(tracing.CPU_SCOPE + '_cpu_ms', event['args'])
+        self.assertEqual(outer_event['args']['pack'], 'PackA')
+        self.assertEqual(
+            (outer_event['args']['bytes'], outer_event['args']['files']),
+            (15, 3))
+        self.assertNotIn('pack', inner_event['args'])
+        # Times are rounded to 0.1 microseconds
+        self.assertGreaterEqual(inner_event['ts'], outer_event['ts'] - 0.1)
+        self.assertLessEqual(
+            inner_event['ts'] + inner_event['dur'],
+            outer_event['ts'] + outer_event['dur'] + 0.2)
+        self.assertEqual(tracing.stats['outer'][0], 1)
+        self.assertEqual(tracing.stats['outer'][3:], [15, 3])
+
+    def test_error(self):
+        self.assertRaises(ValueError, traced_function, ValueError('Failed'))
+        self.assertEqual(traced_function(2), 2)
+        first, second = tracing.events
+        self.assertEqual(first['args']['error'], 'ValueError')
+        self.assertNotIn('error', second['args'])
+        self.assertEqual(tracing.stats['traced_function'][0], 2)
+        self.assertIn('traced_function: 2 call(s)', tracing.report())
+
+    def test_log(self):
+        def nested():
+            """Traces a logged operation with a nested one."""
+            with tracing.span('outer'):
+                with tracing.span('inner'):
+                    pass
+        output = self.output(nested)
+        self.assertTrue(output.startswith('[trace] outer: 1 call(s)'))
+        self.assertNotIn('inner', output)
+        self.assertEqual(self.output(traced_function, 3), '')
+
+    def test_write_trace(self):
+        with tracing.span('op', log=False, pack='PackA'):
+            pass
+        root = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(root, 'trace.json')
+            tracing.write_trace(filename)
+            with open(filename) as f:
+                data = json.load(f)
+        finally:
+            shutil.rmtree(root)
+        self.assertEqual(data['displayTimeUnit'], 'ms')
+        self.assertEqual(data['traceEvents'], list(tracing.events))
+        self.assertEqual(data['traceEvents'][0]['name'], 'op')
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab
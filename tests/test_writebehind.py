@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for writebehind."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import subprocess
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# pylint:disable=wrong-import-position
+import writebehind
+from writebehind import WriteBehind
+
+class WriteBehindTest(unittest.TestCase):
+    """Tests for WriteBehind."""
+    def setUp(self):
+        self.writes = []
+        self.written = threading.Event()
+        self.writer = WriteBehind(self.write, delay=60)
+
+    def write(self):
+        """Records a write."""
+        self.writes.append(1)
+        self.written.set()
+
+    def tearDown(self):
+        self.writer.stop()
+
+    def test_stop(self):
+        self.writer.schedule()
+        thread = self.writer.thread
+        self.assertIn(self.writer, writebehind._writers)
+        self.writer.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(self.writer.thread)
+        # The pending write is performed by stop
+        self.assertEqual(self.writes, [1])
+        self.assertFalse(self.writer.pending())
+        self.writer.stop()
+        self.assertEqual(self.writes, [1])
+
+    def test_schedule_after_stop(self):
+        self.writer.schedule()
+        self.writer.stop()
+        self.written.clear()
+        self.writer.delay = 0
+        self.writer.schedule()
+        self.assertTrue(self.written.wait(10))
+        self.assertEqual(self.writes, [1, 1])
+
+    def test_stopped_at_exit(self):
+        # Writer threads left waiting used to fail as the interpreter shut
+        # down on Python 2
+        script = (
+            'import sys; sys.path.insert(0, {0!r}); '
+            'from writebehind import WriteBehind; '
+            'WriteBehind(lambda: sys.stdout.write("written"), 60).schedule()'
+        ).format(os.path.join(os.path.dirname(__file__), '..'))
+        process = subprocess.Popen(
+            [sys.executable, '-c', str(script)], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        self.assertEqual((out, err), (b'written', b''))
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab
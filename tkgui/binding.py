@@ -17,6 +17,8 @@ else:
 
 __controls = dict()
 __lnp = None
+# Options whose displays were left alone by update(True)
+__deferred = set()
 
 def init(lnp):
     """Connect to an LNP instance."""
@@ -36,25 +38,46 @@ def get(field):
     """Returns the value of the control known as <field>."""
     return __controls[field].get()
 
-def update():
-    """Updates configuration displays (buttons, etc.)."""
-    for key in __controls.keys():
-        try:
-            value = getattr(__lnp.settings, key)
-        except KeyError:
-            value = None
-        if hasattr(__controls[key], '__iter__'):
-            # Allow (control, func) tuples, etc. to customize value
-            control = __controls[key][0]
-            value = __controls[key][1](value)
-        else:
-            control = __controls[key]
-        if isinstance(control, Entry):
-            control.delete(0, END)
-            control.insert(0, value)
-        else:
-            control["text"] = (
-                control["text"].split(':')[0] + ': ' +
-                str(value))
+def update(defer=False):
+    """
+    Updates configuration displays (buttons, etc.).
+
+    Params:
+        defer
+            If True, options whose files have not been read yet are left
+            alone, so showing them does not wait for e.g. the raws to be
+            read. Call update_deferred later to show them.
+    """
+    for key in list(__controls.keys()):
+        if defer and not __lnp.settings.is_loaded(key):
+            __deferred.add(key)
+            continue
+        __deferred.discard(key)
+        update_control(key)
+
+def update_deferred():
+    """Updates the displays left alone by update(True), reading the files
+    their options are stored in."""
+    for key in list(__deferred):
+        if key in __controls:
+            update_control(key)
+    __deferred.clear()
+
+def update_control(key):
+    """Updates the display of the option <key>."""
+    value = __lnp.settings.get_value(key)
+    if hasattr(__controls[key], '__iter__'):
+        # Allow (control, func) tuples, etc. to customize value
+        control = __controls[key][0]
+        value = __controls[key][1](value)
+    else:
+        control = __controls[key]
+    if isinstance(control, Entry):
+        control.delete(0, END)
+        control.insert(0, value)
+    else:
+        control["text"] = (
+            control["text"].split(':')[0] + ': ' +
+            str(value))
 
 # vim:expandtab
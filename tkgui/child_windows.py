@@ -4,7 +4,7 @@
 """Contains base class used for child windows."""
 from __future__ import print_function, unicode_literals, absolute_import
 
-import sys, os, errorlog
+import sys, os, errorlog, tracing
 
 from . import controls
 
@@ -12,10 +12,12 @@ if sys.version_info[0] == 3:  # Alternate import names
     # pylint:disable=import-error
     from tkinter import *
     from tkinter.ttk import *
+    import tkinter.filedialog as filedialog
 else:
     # pylint:disable=import-error
     from Tkinter import *
     from ttk import *
+    import tkFileDialog as filedialog
 
 class ChildWindow(object):
     """Base class for child windows."""
@@ -103,20 +105,47 @@ class LogWindow(DualTextWindow):
             parent
                 Parent widget for the window.
         """
+        # Sequence numbers of the last writes shown
+        self.out_sequence = 0
+        self.err_sequence = 0
+        self.trace_enabled = BooleanVar(value=tracing.enabled)
         super(LogWindow, self).__init__(parent, 'Output log')
         self.load()
 
     def create_buttons(self, container):
         f = Frame(container)
         Button(f, text='Refresh', command=self.load).pack(side=LEFT)
+        Checkbutton(
+            f, text='Trace operations', variable=self.trace_enabled,
+            command=lambda: tracing.enable(self.trace_enabled.get())).pack(
+                side=LEFT)
+        Button(f, text='Timing report', command=self.show_report).pack(
+            side=LEFT)
+        Button(f, text='Save trace...', command=self.save_trace).pack(
+            side=LEFT)
         f.pack(side=TOP, anchor='w')
 
     def load(self):
-        """Loads log data into the text widgets."""
-        self.left.delete('1.0', END)
-        self.right.delete('1.0', END)
-        self.left.insert('1.0', '\n'.join(errorlog.out.lines))
-        self.right.insert('1.0', '\n'.join(errorlog.err.lines))
+        """Appends log data written since the last refresh to the text
+        widgets."""
+        text, self.out_sequence = errorlog.out.read_since(self.out_sequence)
+        self.left.insert(END, text)
+        text, self.err_sequence = errorlog.err.read_since(self.err_sequence)
+        self.right.insert(END, text)
+
+    def show_report(self):
+        """Prints the totals of traced operations to the output log."""
+        print('Timing report:\n' + tracing.report(), end='')
+        self.load()
+
+    def save_trace(self):
+        """Saves traced operations to a file in Chrome trace format."""
+        filename = filedialog.asksaveasfilename(
+            parent=self.top, title='Save trace', defaultextension='.json',
+            initialfile='PyLNP.trace.json',
+            filetypes=[('Trace files', '.json')])
+        if filename:
+            tracing.write_trace(filename)
 
 class InitEditor(DualTextWindow):
     """Basic editor for d_init.txt and init.txt."""
@@ -262,6 +291,69 @@ class UpdateWindow(ChildWindow):
         self.lnp.next_update(days)
         self.top.destroy()
 
+class ProgressWindow(ChildWindow):
+    """Shows the progress of a task running in the background, and allows
+    it to be cancelled."""
+    def __init__(self, parent, title, on_cancel):
+        """
+        Constructor for ProgressWindow. The window blocks input to the rest
+        of the application until it is closed with close().
+
+        Params:
+            parent
+                Parent widget for the window.
+            title
+                Title for the window.
+            on_cancel
+                Function called when the Cancel button is clicked.
+        """
+        self.status = StringVar(parent)
+        self.progress = None
+        self.cancel_button = None
+        self.on_cancel = on_cancel
+        super(ProgressWindow, self).__init__(parent, title)
+        self.top.transient(parent)
+        self.top.protocol('WM_DELETE_WINDOW', self.cancel)
+        self.top.wait_visibility()
+        self.top.grab_set()
+
+    def create_controls(self, container):
+        f = Frame(container)
+        Label(f, textvariable=self.status, width=50).pack(
+            side=TOP, fill=X, padx=4, pady=4)
+        self.progress = Progressbar(f, length=300, mode='determinate')
+        self.progress.pack(side=TOP, fill=X, padx=4)
+        self.cancel_button = Button(f, text='Cancel', command=self.cancel)
+        self.cancel_button.pack(side=TOP, pady=4)
+        f.pack(fill=BOTH, expand=Y)
+
+    def set_progress(self, done, total, text):
+        """
+        Updates the progress shown.
+
+        Params:
+            done
+                The number of steps finished.
+            total
+                The total number of steps.
+            text
+                Text describing the last step finished.
+        """
+        self.progress['maximum'] = total
+        self.progress['value'] = done
+        self.status.set(text)
+
+    def cancel(self):
+        """Called when the Cancel button is clicked."""
+        self.on_cancel()
+        self.cancel_button['state'] = 'disabled'
+        self.status.set('Cancelling...')
+
+    def close(self):
+        """Closes the window once the task is finished."""
+        self.top.grab_release()
+        self.top.destroy()
+
 class ConfirmRun(ChildWindow):
     """Confirmation dialog for already running programs."""
     def __init__(self, parent, lnp, path, is_df):
@@ -5,8 +5,10 @@
 from __future__ import print_function, unicode_literals, absolute_import
 
 from . import controls, binding
+from .child_windows import ProgressWindow
 from .tab import Tab
 import sys
+import threading
 
 if sys.version_info[0] == 3:  # Alternate import names
     # pylint:disable=import-error
@@ -14,12 +16,14 @@ if sys.version_info[0] == 3:  # Alternate import names
     from tkinter.ttk import *
     import tkinter.messagebox as messagebox
     import tkinter.simpledialog as simpledialog
+    import queue
 else:
     # pylint:disable=import-error
     from Tkinter import *
     from ttk import *
     import tkMessageBox as messagebox
     import tkSimpleDialog as simpledialog
+    import Queue as queue
 
 class GraphicsTab(Tab):
     """Graphics tab for the TKinter GUI."""
@@ -45,21 +49,25 @@ class GraphicsTab(Tab):
         listframe.grid(column=0, row=1, columnspan=2, sticky="nsew", pady=4)
         _, graphicpacks = controls.create_file_list(
             listframe, None, self.graphics, height=8)
+        self.pack_info = Label(change_graphics, text='')
+        self.pack_info.grid(column=0, row=2, columnspan=2, sticky="nsew")
+        graphicpacks.bind(
+            '<<ListboxSelect>>', lambda e: self.show_pack_info(graphicpacks))
 
         controls.create_trigger_button(
             change_graphics, 'Install Graphics',
             'Install selected graphics pack',
             lambda: self.install_graphics(graphicpacks)).grid(
-                column=0, row=2, sticky="nsew")
+                column=0, row=3, sticky="nsew")
         controls.create_trigger_button(
             change_graphics, 'Update Savegames',
             'Install current graphics pack in all savegames',
-            self.update_savegames).grid(column=1, row=2, sticky="nsew")
+            self.update_savegames).grid(column=1, row=3, sticky="nsew")
         controls.create_option_button(
             change_graphics, 'TrueType Fonts',
             'Toggles whether to use TrueType fonts or tileset for text. '
             'Only works with Print Mode set to 2D.',
-            'truetype').grid(column=0, row=3, columnspan=2, sticky="nsew")
+            'truetype').grid(column=0, row=4, columnspan=2, sticky="nsew")
 
         advanced = controls.create_control_group(
             self, 'Advanced', True)
@@ -82,6 +90,28 @@ class GraphicsTab(Tab):
             'Deletes unnecessary files from graphics packs '
             '(saves space, useful for re-packaging)',
             self.simplify_graphics).grid(column=1, row=2, sticky="nsew")
+        controls.create_trigger_option_button(
+            advanced, 'Link Graphics Art',
+            'Whether installing graphics links the tileset images to the '
+            'pack instead of copying them (saves space; do not edit the '
+            'installed images while enabled)',
+            self.toggle_link_art, 'linkArt', lambda v: ('NO', 'YES')[
+                self.lnp.userconfig.get_bool('linkArt')]).grid(
+                    column=0, row=3, columnspan=2, sticky="nsew")
+        controls.create_trigger_option_button(
+            advanced, 'Share Raw Files',
+            'Whether identical raw files in savegames and the DF folder '
+            'are shared files (stored in LNP/Store) to save space; do not '
+            'edit shared raws in place, as this changes every savegame '
+            'using them',
+            self.toggle_dedup_raws, 'dedupRaws', lambda v: ('NO', 'YES')[
+                self.lnp.userconfig.get_bool('dedupRaws')]).grid(
+                    column=0, row=4, columnspan=2, sticky="nsew")
+        controls.create_trigger_button(
+            advanced, 'Undo Graphics Install',
+            'Restores the graphics, settings and raws replaced by the last '
+            'graphics install', self.undo_graphics_install).grid(
+                column=0, row=5, columnspan=2, sticky="nsew")
 
         colors, color_files, buttons = \
             controls.create_file_list_buttons(
@@ -101,9 +131,40 @@ class GraphicsTab(Tab):
             colors, width=128, height=32, highlightthickness=0, takefocus=False)
         self.color_preview.grid(column=0, row=2)
 
+    def toggle_link_art(self):
+        """Toggle hard linking of graphics pack art."""
+        self.lnp.toggle_link_art()
+        binding.update()
+
+    def toggle_dedup_raws(self):
+        """Toggle sharing of identical raw files."""
+        self.lnp.toggle_dedup_raws()
+        binding.update()
+
     def read_graphics(self):
         """Reads list of graphics packs."""
         self.graphics.set(tuple([p[0] for p in self.lnp.read_graphics()]))
+        self.pack_info['text'] = ''
+
+    def show_pack_info(self, listbox):
+        """
+        Shows the tile size, number of files and size of the selected
+        graphics pack.
+
+        Params:
+            listbox
+                Listbox containing the list of graphics packs.
+        """
+        self.pack_info['text'] = ''
+        if len(listbox.curselection()) == 0:
+            return
+        info = self.lnp.get_pack_info(listbox.get(listbox.curselection()[0]))
+        if info is None:
+            return
+        size = info['graphics_tile_size'] or info['tile_size']
+        self.pack_info['text'] = '{0} tiles, {1} file(s), {2:.1f} MiB'.format(
+            '{0}x{1}'.format(*size) if size else 'Unknown', info['files'],
+            info['bytes'] / 1048576.0)
 
     def install_graphics(self, listbox):
         """
@@ -123,7 +184,7 @@ class GraphicsTab(Tab):
                     messagebox.showerror(
                         title='Error occurred', message='Something went wrong: '
                         'the graphics folder may be missing important files. '
-                        'Graphics may not be installed correctly.\n'
+                        'The previous graphics have been kept.\n'
                         'See the output log for error details.')
                 elif result:
                     if messagebox.askyesno(
@@ -140,37 +201,146 @@ class GraphicsTab(Tab):
                         'or folders:\n'+str(gfx_dir))
             binding.update()
 
-    def update_savegames(self):
-        """Updates saved games with new raws."""
-        count = self.lnp.update_savegames()
-        if count > 0:
+    def undo_graphics_install(self):
+        """Undoes the last graphics install."""
+        if not messagebox.askokcancel(
+                message='Your graphics, settings and raws will be restored '
+                'to what they were before the last graphics install.',
+                title='Are you sure?'):
+            return
+        result = self.lnp.undo_graphics_install()
+        if result is None:
             messagebox.showinfo(
-                title='Update complete',
-                message="{0} savegames updated!".format(count))
-        else:
+                title='Nothing to undo',
+                message='No graphics install to undo in this DF folder.')
+        elif result is False:
+            messagebox.showerror(
+                title='Error occurred',
+                message='Failed to undo the graphics install.\n'
+                'See the output log for error details.')
+        binding.update()
+
+    def update_savegames(self):
+        """Updates saved games with new raws in the background, showing
+        the progress."""
+        events = queue.Queue()
+        cancel = threading.Event()
+        results = []
+        window = ProgressWindow(self, 'Updating savegames', cancel.set)
+        window.set_progress(0, 1, 'Updating savegames...')
+
+        def work():
+            """Performs the update. Runs in a thread. The last event is None,
+            or the exception that ended the update."""
+            error = None
+            try:
+                results.extend(self.lnp.update_savegames(
+                    lambda *args: events.put(args), cancel))
+            except Exception as ex:  # pylint:disable=broad-except
+                sys.excepthook(*sys.exc_info())
+                error = ex
+            finally:
+                events.put(error)
+
+        def poll():
+            """Shows progress reported by the update."""
+            while True:
+                try:
+                    event = events.get_nowait()
+                except queue.Empty:
+                    self.after(100, poll)
+                    return
+                if not isinstance(event, tuple):
+                    break
+                done, total, name, result = event
+                if not cancel.is_set():
+                    window.set_progress(done, total, '{0} {1}'.format(
+                        name, 'updated' if result else 'failed'))
+            window.close()
+            if event is not None:
+                messagebox.showerror(
+                    title='Error occurred',
+                    message='Failed to update savegames:\n{0}\n'
+                    'See the output log for error details.'.format(event))
+                return
+            self.show_savegame_results(results)
+
+        t = threading.Thread(target=work)
+        t.daemon = True
+        t.start()
+        poll()
+
+    @staticmethod
+    def show_savegame_results(results):
+        """
+        Shows the outcome of a savegame update.
+
+        Params:
+            results
+                List of (save name, result) tuples from
+                PyLNP.update_savegames.
+        """
+        if not results:
             messagebox.showinfo(
                 title='Update skipped', message="No savegames to update.")
+            return
+        updated = [n for n, r in results if r]
+        failed = [n for n, r in results if r is False]
+        skipped = [n for n, r in results if r is None]
+        message = "{0} savegames updated!".format(len(updated))
+        if skipped:
+            message += "\n{0} skipped (cancelled).".format(len(skipped))
+        if failed:
+            messagebox.showerror(
+                title='Error occurred', message=message +
+                '\nFailed to update:\n' + '\n'.join(failed) +
+                '\nSee the output log for error details.')
+        else:
+            messagebox.showinfo(title='Update complete', message=message)
 
     def simplify_graphics(self):
         """Removes unnecessary files from graphics packs."""
         self.read_graphics()
-        for pack in self.graphics.get():
-            result = self.lnp.simplify_pack(pack)
-            if result is None:
-                messagebox.showinfo(
-                    title='Error occurrred', message='No files in: '+str(pack))
-            elif result is False:
-                messagebox.showerror(
-                    title='Error occurred',
-                    message='Error simplifying graphics folder. '
-                    'It may not have the required files.\n'+str(pack)+'\n'
-                    'See the output log for error details.')
-            else:
-                messagebox.showinfo(
-                    title='Success',
-                    message='Deleted {0} unnecessary file(s) in: {1}'.format(
-                        result, pack))
-        messagebox.showinfo(title='Success', message='Simplification complete!')
+        preview = [
+            (p, r) for p, r in self.lnp.simplify_graphics(True) if r]
+        if not any(r[0] for p, r in preview):
+            messagebox.showinfo(
+                title='Nothing to do',
+                message='No unnecessary files found in graphics packs.')
+            return
+        if not messagebox.askokcancel(
+                title='Are you sure?', message='The following will be '
+                'deleted:\n' + self.format_simplify_results(preview)):
+            return
+        results = self.lnp.simplify_graphics()
+        failed = [p for p, r in results if r is False]
+        message = self.format_simplify_results(
+            [(p, r) for p, r in results if r])
+        if failed:
+            messagebox.showerror(
+                title='Error occurred',
+                message='Error simplifying graphics folders:\n' +
+                '\n'.join(failed) + '\nSee the output log for error '
+                'details.\n\nDeleted:\n' + message)
+        else:
+            messagebox.showinfo(
+                title='Success', message='Simplification complete!\n'
+                'Deleted:\n' + message)
+        binding.update()
+
+    @staticmethod
+    def format_simplify_results(results):
+        """
+        Returns a list of the files deleted from each graphics pack.
+
+        Params:
+            results
+                List of (pack name, (files, bytes)) tuples from
+                PyLNP.simplify_graphics.
+        """
+        return '\n'.join(
+            '{0}: {1} file(s), {2:.1f} MiB'.format(
+                p, r[0], r[1] / 1048576.0) for p, r in results if r[0])
 
     def read_colors(self):
         """Reads list of color schemes."""
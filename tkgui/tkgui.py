@@ -158,7 +158,6 @@ class TkGui(object):
 
         self.create_menu(root)
 
-        self.save_size = None
         root.update()
         root.minsize(width=root.winfo_width(), height=root.winfo_height())
         root.geometry('{}x{}'.format(
@@ -168,19 +167,21 @@ class TkGui(object):
 
         if not self.ensure_df():
             return
-        binding.update()
+        # Options in files not read yet (e.g. aquifers, which needs the raws)
+        # are shown once the window is up
+        binding.update(True)
+        root.after_idle(binding.update_deferred)
         for tab in self.tabs:
             tab.on_post_df_load()
         root.bind('<<UpdateAvailable>>', lambda e: UpdateWindow(
             self.root, self.lnp, self.updateDays))
+        root.bind('<<ScanChanged>>', lambda e: self.apply_scan_results())
 
     def on_resize(self, e):
         """Called when the window is resized."""
         self.lnp.userconfig['tkgui_width'] = self.root.winfo_width()
         self.lnp.userconfig['tkgui_height'] = self.root.winfo_height()
-        if self.save_size:
-            self.root.after_cancel(self.save_size)
-        self.save_size = self.root.after(1000, self.lnp.userconfig.save_data)
+        self.lnp.userconfig.save_data()
 
     def start(self):
         """Starts the UI."""
@@ -190,6 +191,24 @@ class TkGui(object):
         """Called by the main LNP class if an update is available."""
         self.root.event_generate('<<UpdateAvailable>>', when='tail')
 
+    def on_scan_changed(self):
+        """Called by the main LNP class, from a background thread, when
+        checking the cached lists of the LNP folders found stale ones."""
+        self.root.event_generate('<<ScanChanged>>', when='tail')
+
+    def apply_scan_results(self):
+        """Stores the lists found by the background check, and shows them if
+        they changed."""
+        if self.lnp.apply_scan_results():
+            self.refresh_lists()
+
+    def refresh_lists(self):
+        """Re-reads all lists of files shown in the tabs."""
+        for tab in self.tabs:
+            tab.read_data()
+            tab.on_post_df_load()
+        binding.update()
+
     def on_program_running(self, path, is_df):
         """Called by the main LNP class if a program is already running."""
         ConfirmRun(self.root, self.lnp, path, is_df)
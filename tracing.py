@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Lightweight timing of PyLNP operations.
+
+Operations are traced with the traced decorator or the span context manager.
+While tracing is enabled, each traced operation records its wall time, CPU
+time, and the number of bytes and files it touched (reported with add_io).
+Totals per operation are available from report(), and individual calls can
+be saved with write_trace() in Chrome's trace event format (load the file in
+chrome://tracing or https://ui.perfetto.dev).
+
+CPU time is that of the calling thread where Python provides it (3.7 and
+later); otherwise it is the CPU time of the whole process, which includes
+other threads working at the same time. CPU_SCOPE tells which is measured.
+
+While tracing is disabled, a traced call costs a single flag check."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Wall and CPU clocks; fall back to what older versions offer
+_wall_clock = getattr(time, 'perf_counter', time.time)
+# pylint:disable=no-member
+_cpu_clock = getattr(time, 'thread_time', None)
+CPU_SCOPE = 'thread'
+if _cpu_clock is None:
+    _cpu_clock = getattr(time, 'process_time', None) or time.clock
+    CPU_SCOPE = 'process'
+_epoch = _wall_clock()
+
+enabled = bool(os.environ.get('PYLNP_TRACE'))
+# Operation name -> [calls, wall time, CPU time (see CPU_SCOPE), bytes, files]
+stats = {}
+# Completed spans, as Chrome trace events
+events = deque(maxlen=100000)
+lock = threading.Lock()
+_local = threading.local()
+
+def enable(value=True):
+    """
+    Enables or disables tracing. Statistics already recorded are kept.
+
+    Params:
+        value
+            True to enable tracing, False to disable it.
+    """
+    global enabled  # pylint:disable=global-statement
+    enabled = value
+
+def reset():
+    """Discards all recorded statistics and events."""
+    with lock:
+        stats.clear()
+        events.clear()
+
+def _stack():
+    """Returns the stack of active spans on the current thread."""
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+class Span(object):
+    """Records one traced operation. Use through span() or traced."""
+    __slots__ = ('name', 'args', 'log', 'nbytes', 'files', 'start', 'cpu')
+
+    def __init__(self, name, args, log):
+        self.name = name
+        self.args = args
+        self.log = log
+        self.nbytes = 0
+        self.files = 0
+        self.start = None
+        self.cpu = None
+
+    def __enter__(self):
+        _stack().append(self)
+        self.cpu = _cpu_clock()
+        self.start = _wall_clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        wall = _wall_clock() - self.start
+        cpu = _cpu_clock() - self.cpu
+        stack = _stack()
+        stack.remove(self)
+        args = dict(self.args)
+        args.update({
+            CPU_SCOPE + '_cpu_ms': round(cpu * 1000, 3), 'bytes': self.nbytes,
+            'files': self.files})
+        if exc_type is not None:
+            args['error'] = exc_type.__name__
+        with lock:
+            entry = stats.setdefault(self.name, [0, 0.0, 0.0, 0, 0])
+            entry[0] += 1
+            entry[1] += wall
+            entry[2] += cpu
+            entry[3] += self.nbytes
+            entry[4] += self.files
+            events.append({
+                'name': self.name, 'ph': 'X', 'pid': os.getpid(),
+                'tid': threading.current_thread().ident,
+                'ts': round((self.start - _epoch) * 1000000, 1),
+                'dur': round(wall * 1000000, 1), 'args': args})
+        if self.log and not stack:
+            print('[trace] {0}: {1}'.format(self.name, format_totals(
+                1, wall, cpu, self.nbytes, self.files)))
+        return False
+
+class _NullSpan(object):
+    """Stands in for Span while tracing is disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_null_span = _NullSpan()
+
+def span(name, log=True, **args):
+    """
+    Returns a context manager tracing the enclosed block as operation <name>.
+
+    Params:
+        name
+            The name of the operation.
+        log
+            If True, a summary is printed to the output log when the operation
+            finishes, unless it is nested in another traced operation.
+        args
+            Extra values to record with the trace event (e.g. a pack name).
+    """
+    if not enabled:
+        return _null_span
+    return Span(name, args, log)
+
+def traced(name=None, log=True):
+    """
+    Decorator tracing each call of a function.
+
+    Params:
+        name
+            The name of the operation. Defaults to the function name.
+        log
+            See span().
+    """
+    def decorator(func):
+        """Wraps <func>."""
+        op_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            """Traces the call if tracing is enabled."""
+            if not enabled:
+                return func(*args, **kwargs)
+            with Span(op_name, {}, log):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def add_io(nbytes=0, files=1):
+    """
+    Adds bytes and files touched to the operations being traced on the
+    current thread.
+
+    Params:
+        nbytes
+            The number of bytes read or written.
+        files
+            The number of files read, written or removed.
+    """
+    if not enabled:
+        return
+    for s in _stack():
+        s.nbytes += nbytes
+        s.files += files
+
+def format_totals(calls, wall, cpu, nbytes, files):
+    """Returns a one-line summary of recorded values."""
+    return '{0} call(s), {1:.1f} ms wall, {2:.1f} ms {5} CPU, {3} file(s), ' \
+        '{4:.1f} KiB'.format(calls, wall * 1000, cpu * 1000, files,
+                             nbytes / 1024.0, CPU_SCOPE)
+
+def report():
+    """Returns a text report of the totals for each traced operation."""
+    with lock:
+        items = sorted(stats.items(), key=lambda i: -i[1][1])
+    if not items:
+        return 'No operations traced.\n'
+    return ''.join(
+        '{0}: {1}\n'.format(n, format_totals(*s)) for n, s in items)
+
+def write_trace(filename):
+    """
+    Writes the recorded trace events to a JSON file in Chrome's trace event
+    format.
+
+    Params:
+        filename
+            The file to write.
+    """
+    with lock:
+        data = {'traceEvents': list(events), 'displayTimeUnit': 'ms'}
+    with open(filename, 'w') as f:
+        json.dump(data, f)
+
+# vim:expandtab
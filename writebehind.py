@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Deferred and atomic file writing, to keep disk I/O off the UI thread."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import weakref
+
+# Writers with a background thread, stopped at exit
+_writers = weakref.WeakSet()
+
+@atexit.register
+def _stop_all():
+    """Stops the threads of all writers at exit, before the interpreter tears
+    down the modules they use, and performs their pending writes."""
+    for writer in list(_writers):
+        try:
+            writer.stop()
+        except Exception:
+            sys.excepthook(*sys.exc_info())
+
+def replace_file(source, target):
+    """
+    Renames <source> to <target>, replacing <target> if it exists.
+
+    Params:
+        source
+            The file to rename.
+        target
+            The new name of the file.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(source, target)
+    else:  # Python 2
+        if sys.platform == 'win32' and os.path.exists(target):
+            os.remove(target)
+        os.rename(source, target)
+
+def atomic_write(filename, text, mode='w'):
+    """
+    Writes <text> to <filename>. The text is written to a temporary file in
+    the same directory, which then replaces <filename>; readers will never
+    see a partially written file. If <filename> was a hard link, the other
+    links keep the old contents.
+
+    Params:
+        filename
+            The file to write.
+        text
+            The contents of the file.
+        mode
+            The mode to open the temporary file with ('w' or 'wb').
+    """
+    directory, name = os.path.split(os.path.abspath(filename))
+    handle, tmp = tempfile.mkstemp(
+        dir=directory, prefix='.' + name + '.', suffix='.tmp')
+    try:
+        f = os.fdopen(handle, mode)
+        try:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmp)
+        replace_file(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+class WriteBehind(object):
+    """Coalesces bursts of write requests into a single call of a write
+    function, made on a background thread once no new requests have arrived
+    for a short while."""
+    def __init__(self, func, delay=0.5):
+        """
+        Constructor for WriteBehind.
+
+        Params:
+            func
+                Function that performs the write. Must be safe to call when
+                there is nothing to write.
+            delay
+                Seconds without new requests before the write is performed.
+        """
+        self.func = func
+        self.delay = delay
+        self.deadline = None
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.thread = None
+
+    def schedule(self):
+        """Requests a write, postponing any write already pending."""
+        with self.condition:
+            self.deadline = time.time() + self.delay
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+                _writers.add(self)
+            self.condition.notify()
+
+    def pending(self):
+        """Returns True if a write has been requested but not performed."""
+        return self.deadline is not None
+
+    def run(self):
+        """Waits for requests and performs writes, until stopped. Runs in a
+        thread."""
+        current = threading.current_thread()
+        while True:
+            with self.condition:
+                while self.deadline is None and self.thread is current:
+                    self.condition.wait()
+                if self.thread is not current:
+                    return
+                remaining = self.deadline - time.time()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                self.deadline = None
+            try:
+                with self.write_lock:
+                    self.func()
+            except Exception:
+                sys.excepthook(*sys.exc_info())
+
+    def stop(self):
+        """Stops the background thread, then performs any pending write on the
+        calling thread. A later request starts a new thread."""
+        with self.condition:
+            thread = self.thread
+            self.thread = None
+            self.condition.notify()
+        if thread is not None:
+            thread.join()
+        if self.pending():
+            self.flush()
+
+    def flush(self):
+        """Performs the write immediately on the calling thread, waiting for
+        any write already in progress on the background thread."""
+        with self.condition:
+            self.deadline = None
+        with self.write_lock:
+            self.func()
+
+# vim:expandtab